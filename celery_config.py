@@ -25,6 +25,7 @@ celery_app.conf.update(
     task_routes={
         'src.tasks.process_chat_stream_task': {'queue': 'chat_queue'},
         'src.tasks.organize_knotes_task': {'queue': 'background_queue'},
+        'src.tasks.summarize_conversation_task': {'queue': 'background_queue'},
     },
     task_default_queue='default',
     task_default_exchange='llm_server',
@@ -6,7 +6,7 @@ from datetime import datetime
 
 import sys
 sys.path.append('/home/kai/robot')
-from src.utils.kllm import call_api
+from src.utils.kllm import call_api_batch
 
 # system_prompt1 = """你扮演有心理障碍的用户，你需要和其他用户进行社交交流，分享自己的经历和情感。"""
 # system_prompt2 = """你扮演一名能够和有心理障碍的用户进行社交陪伴的助手，你需通过语言去陪伴用户。"""
@@ -21,9 +21,24 @@ OUTPUT_DIR = "/home/kai/robot/data/dialogues"
 # 确保输出目录存在
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-def generate_dialogue():
-    """生成一组完整的对话"""
-    dialogue = []
+def _batch_reply(system_prompt, prompts):
+    """同一轮中各组对话的发言互不依赖, 并发生成"""
+    batch = call_api_batch([
+        # 相同提示词也需要各自采样, 不合并请求
+        {"system_prompt": system_prompt, "user_prompt": prompt, "temperature": 0.8, "max_tokens": 32768, "model_name": "Qwen2.5-72B-Instruct-GGUF", "coalesce": False}
+        for prompt in prompts
+    ])
+    replies = batch.wait()
+    print(f"  本轮 {len(prompts)} 条发言, 失败 {batch.failed} 条, 耗时: {batch.wall_time:.3f}s")
+    return replies
+
+def generate_dialogues(sessions):
+    """
+    同时生成多组完整的对话
+    
+    每组对话内部逐轮依赖, 各组之间互不依赖: 按轮推进, 每轮把所有组的发言并发发给模型
+    """
+    dialogues = [[] for _ in range(sessions)]
     
     # 初始化角色
     user_state = {"emotion": "积极", "topic": "生活社交"}
@@ -31,23 +46,29 @@ def generate_dialogue():
     
     # 首轮用户发言
     user_prompt = f"当前情感状态：{user_state['emotion']}\n想讨论的话题：{user_state['topic']}"
-    user_msg = call_api(system_prompt=system_prompt1, user_prompt=user_prompt, temperature=0.8, max_tokens=32768, model_name="Qwen2.5-72B-Instruct-GGUF")
-    dialogue.append({"role": "user", "content": user_msg})
+    for dialogue, user_msg in zip(dialogues, _batch_reply(system_prompt1, [user_prompt] * sessions)):
+        dialogue.append({"role": "user", "content": user_msg})
     
     # 多轮对话
     for _ in range(DIALOGUE_ROUNDS):
         # 助手回复
-        context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in dialogue[-3:]])
-        assistant_prompt = f"对话上下文：\n{context}"
-        assistant_msg = call_api(system_prompt=system_prompt2, user_prompt=assistant_prompt, temperature=0.8, max_tokens=32768, model_name="Qwen2.5-72B-Instruct-GGUF")
-        dialogue.append({"role": "assistant", "content": assistant_msg})
+        assistant_prompts = []
+        for dialogue in dialogues:
+            context = "\n".join([f"{msg['role']}: {msg['content']}" for msg in dialogue[-3:]])
+            assistant_prompts.append(f"对话上下文：\n{context}")
+        for dialogue, assistant_msg in zip(dialogues, _batch_reply(system_prompt2, assistant_prompts)):
+            dialogue.append({"role": "assistant", "content": assistant_msg})
         
         # 用户回应
-        user_response_prompt = f"助手最后回复：{assistant_msg}"
-        user_msg = call_api(system_prompt=system_prompt1, user_prompt=user_response_prompt, temperature=0.8, max_tokens=32768, model_name="Qwen2.5-72B-Instruct-GGUF")
-        dialogue.append({"role": "user", "content": user_msg})
+        user_response_prompts = [f"助手最后回复：{dialogue[-1]['content']}" for dialogue in dialogues]
+        for dialogue, user_msg in zip(dialogues, _batch_reply(system_prompt1, user_response_prompts)):
+            dialogue.append({"role": "user", "content": user_msg})
     
-    return dialogue
+    return dialogues
+
+def generate_dialogue():
+    """生成一组完整的对话"""
+    return generate_dialogues(1)[0]
 
 def save_dialogue(session_id, dialogue):
     """保存对话数据并提取QA对"""
@@ -68,9 +89,8 @@ def save_dialogue(session_id, dialogue):
         json.dump(data, f, ensure_ascii=False, indent=2)
 
 if __name__ == "__main__":
-    for session in range(DIALOGUE_SESSIONS):
-        print(f"正在生成第{session+1}组对话...")
-        dialogue = generate_dialogue()
+    print(f"正在同时生成{DIALOGUE_SESSIONS}组对话...")
+    for session, dialogue in enumerate(generate_dialogues(DIALOGUE_SESSIONS)):
         save_dialogue(session+1, dialogue)
     print(f"所有对话已生成，保存在：{OUTPUT_DIR}")
 
@@ -1,8 +1,11 @@
 import json
 import os
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, WebSocket
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime
+from typing import Optional
 from pydantic import BaseModel
 
 import sys
@@ -13,8 +16,14 @@ from src.diary_system.knote import DiarySystem
 from celery_config import celery_app
 from src.tasks import process_chat_task, process_chat_stream_task, organize_knotes_task, get_stream_task_output
 from src.utils.file_oprator import safe_file_operation
+from src.utils.kllm import close_async_client, metrics_snapshot
+from src.utils import cancel, stream_hub
+from src.utils.chat_socket import ChatSocket
+from src.utils.metrics import render_prometheus
 
 current_day_note_path = '/mnt/projects/llm-server/src/diary_system/current_day_history.json'
+# /task/{task_id} 长轮询最多等待的毫秒数
+max_poll_wait_ms = int(os.environ.get('TASK_POLL_MAX_WAIT_MS', '30000'))
 app = FastAPI()
 agent = KAgent()
 diary = DiarySystem()
@@ -66,6 +75,8 @@ async def user_question_stream(input: user_question_format):
     print(f"对话历史：{conversation_history}")
     # 异步调用流式Celery任务
     task = process_chat_stream_task.delay(input.message, conversation_history)
+    # 登记客户端心跳, 之后每次轮询续期; 超过 STREAM_POLL_TIMEOUT_SECONDS 没有轮询时worker取消生成
+    cancel.touch(task.id)
     
     return {
         "task_id": task.id,
@@ -74,12 +85,117 @@ async def user_question_stream(input: user_question_format):
         "stream_support": True
     }
 
+def _final_status(task_result):
+    """任务已结束时返回 (状态, 最终回答), 未结束时返回None"""
+    if task_result.state == 'SUCCESS':
+        info = task_result.info if isinstance(task_result.info, dict) else {}
+        status = 'cancelled' if info.get('status') == 'cancelled' else 'completed'
+        return status, info.get('answer')
+    if task_result.state in ('FAILURE', 'REVOKED'):
+        return 'error' if task_result.state == 'FAILURE' else 'cancelled', None
+    return None
+
+
+def _finished_status(task_id):
+    return _final_status(celery_app.AsyncResult(task_id))
+
+
+async def _stream_events(task_id, offset):
+    """按SSE格式推送任务的增量, 事件ID为偏移量(已推送的段数)"""
+    yield "retry: 3000\n\n"
+    async for event, data, event_id in stream_hub.follow(task_id, offset, _finished_status):
+        if event == 'ping':
+            yield ": ping\n\n"
+        else:
+            yield stream_hub.format_event(event, data, event_id)
+
+# 流式输出推送端点(SSE)
+@app.get("/ask/stream/{task_id}/events")
+async def user_question_stream_events(task_id: str, request: Request, after: int = 0):
+    """以 text/event-stream 推送流式任务的增量; 断线重连时浏览器自动带上 Last-Event-ID, 从断点继续"""
+    last_event_id = request.headers.get('last-event-id', '')
+    offset = int(last_event_id) if last_event_id.isdigit() else max(after, 0)
+    return StreamingResponse(_stream_events(task_id, offset), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def _submit_stream_task(message):
+    """提交一轮流式任务并登记客户端心跳, 返回任务ID"""
+    conversation_history = safe_file_operation('read', current_day_note_path)
+    task = process_chat_stream_task.delay(message, conversation_history)
+    cancel.touch(task.id)
+    return task.id
+
+# WebSocket聊天端点
+@app.websocket("/ws/chat")
+async def chat_socket(websocket: WebSocket):
+    """一条连接上多个会话: 发送 ask 提交一轮, 各轮回复以 delta / done 推送, 消息格式见 src/utils/chat_socket.py"""
+    await ChatSocket(websocket, _submit_stream_task, _finished_status).serve()
+
+# 增量模式下Stream结束状态对应的任务状态
+_delta_states = {
+    'streaming': ('STREAMING', '任务处理中'),
+    'completed': ('SUCCESS', '任务已完成'),
+    'cancelled': ('SUCCESS', '任务已取消'),
+    'error': ('FAILURE', '任务失败'),
+}
+
+
+def _backend_delta(task_id, after):
+    """增量Stream不存在(尚未开始、已过期或Redis不可用)时按结果后端给出增量模式的响应"""
+    task_result = celery_app.AsyncResult(task_id)
+    state = task_result.state
+    response = {'task_id': task_id, 'state': state, 'text': '', 'offset': after, 'stream_status': None}
+    finished = _final_status(task_result)
+    if finished is not None:
+        stream_status, answer = finished
+        response['status'] = _delta_states[stream_status][1]
+        response['stream_status'] = stream_status
+        # 没有分段可对齐, 只在从头读取时给出全文
+        if after == 0 and answer:
+            response['text'] = answer
+    elif state == 'PENDING':
+        response['status'] = '任务正在等待处理'
+    else:
+        response['status'] = '任务处理中'
+    return response
+
+
+async def _task_delta(task_id, after, wait):
+    """增量模式: 只返回偏移量 after 之后的新文本, 没有新内容时最多等待 wait 毫秒"""
+    # 读取增量并续期心跳只需一次Redis往返, 不再读取结果后端
+    result = await stream_hub.hub.read(task_id, after)
+    if (wait > 0 and result is not None and not result['chunks']
+            and result['status'] in (None, 'streaming')):
+        waited = await stream_hub.hub.wait(task_id, after, min(wait, max_poll_wait_ms) / 1000)
+        if waited is not None:
+            result = waited
+    if result is None or result['status'] is None:
+        return await run_in_threadpool(_backend_delta, task_id, after)
+    state, status = _delta_states.get(result['status'], _delta_states['streaming'])
+    return {
+        'task_id': task_id,
+        'state': state,
+        'status': status,
+        'text': ''.join(result['chunks']),
+        'offset': result['offset'],
+        'stream_status': result['status'],
+    }
+
 # 任务状态查询端点
 @app.get("/task/{task_id}")
-async def get_task_status(task_id: str):
-    """查询任务状态(支持实时流式输出)"""
+async def get_task_status(task_id: str, after: Optional[int] = None, wait: int = 0):
+    """
+    查询任务状态(支持实时流式输出)
+
+    传入 after(已读取的段数)时为增量模式: 只返回之后的新文本(text)和新的偏移量(offset),
+    没有新内容时最多等待 wait 毫秒(长轮询)
+    """
+    if after is not None:
+        return await _task_delta(task_id, max(after, 0), wait)
     task_result = celery_app.AsyncResult(task_id)
     print(f"task_result: {task_result}")
+    if task_result.state in ('PENDING', 'STREAMING'):
+        cancel.touch(task_id)
     # 检查是否为流式任务并获取实时输出
     stream_output = get_stream_task_output(task_id)
     print(f"stream_output: {stream_output}")
@@ -96,13 +212,39 @@ async def get_task_status(task_id: str):
         response['result'] = task_result.info
     elif task_result.state == 'STREAMING':  # STREAMING
         response['status'] = '任务处理中'
-        response['result'] = task_result.info 
+        # 结果后端只有开始标记, 流式输出从任务的增量Stream读取
+        response['result'] = stream_output if stream_output is not None else task_result.info
     else:
         response['status'] = '任务失败'
         response['result'] = task_result.info 
     
     return response
 
+# 取消任务端点
+@app.post("/task/{task_id}/cancel")
+async def cancel_task(task_id: str):
+    """取消任务: 已开始的流式任务关闭上游连接并提前结束, 尚未开始的任务直接撤销"""
+    marked = cancel.request_cancel(task_id, 'client')
+    celery_app.control.revoke(task_id)
+    return {
+        'task_id': task_id,
+        'cancelled': marked,
+        'status': '已请求取消任务'
+    }
+
+# LLM调用指标(API进程 + 所有Celery worker)
+@app.get("/metrics", response_class=PlainTextResponse)
+def llm_metrics_prometheus():
+    """Prometheus 文本格式: 按模型的排队耗时、TTFT、token间隔、总耗时与token数直方图"""
+    return render_prometheus(metrics_snapshot())
+
+@app.get("/metrics/llm")
+def llm_metrics_summary():
+    """JSON格式的分位数汇总"""
+    snapshot = metrics_snapshot()
+    return {'processes': snapshot['processes'], 'models': snapshot['summary'], 'stages': snapshot['stage_summary'],
+            'counters': snapshot['counters']}
+
 # 同步问答端点（兼容旧版本）
 @app.post("/ask/sync")
 def user_question_sync(input: user_question_format):
@@ -135,4 +277,10 @@ def user_question_sync(input: user_question_format):
 @app.on_event("startup")
 def recovery():
     # ... existing recovery logic ...
-    print("系统启动，检查并恢复中断点...")
\ No newline at end of file
+    print("系统启动，检查并恢复中断点...")
+
+@app.on_event("shutdown")
+async def shutdown():
+    # 关闭异步LLM客户端的连接池
+    await close_async_client()
+    await stream_hub.hub.close()
\ No newline at end of file
@@ -0,0 +1,194 @@
+"""
+简单轮次的快速通道
+
+纯问候、告别这类输入("你好"、"再见，谢谢你的陪伴")不需要完整的思维链提示词和几千token的预算。
+classify() 用规则判断输入是否"确定是简单轮次": 按标点切成短句后, 每一句都必须是已知的问候/告别/致谢/语气短语,
+只要夹杂任何其他内容(情绪、提问、分享)就交给完整流程, 宁可漏判也不误判。
+
+命中后按 fast_path_mode 处理:
+- template(默认, 推荐): 从回复模板池中选一条(避开上一轮刚用过的), 不调用LLM
+- llm: 用简短的系统提示词、最近一轮历史和很小的 max_tokens 调用LLM, 失败时回落到完整流程;
+  每轮仍有一次请求, 只减少预留的token, 耗时只比完整流程少约10ms(见 fast_path_benchmark)
+- off: 关闭
+
+各去向的轮数记入 metrics 计数 chat_turns{route=template|short_prompt|full}, 即快速通道分流的LLM流量
+"""
+import os
+import random
+import re
+import threading
+import time
+
+import sys
+sys.path.append('/mnt/projects/llm-server')
+from src.utils.kllm import call_api
+from src.utils.limiter import PRIORITY_HIGH
+from src.utils import metrics
+
+fast_path_mode = os.environ.get('KAGENT_FAST_PATH', 'template')
+fast_path_max_tokens = 64
+fast_path_model_name = "qwen3-4b-instruct-2507-fp8"
+
+# 各意图的完整短句(去掉句尾语气词后比较)
+_PHRASES = {
+    'greeting': {
+        '你好', '您好', '嗨', '哈喽', 'hello', 'hi', 'hey', '早', '早上好', '早安', '上午好', '中午好', '下午好',
+        '晚上好', '在吗', '在不在', '你在吗', '好久不见',
+    },
+    'goodbye': {
+        '再见', '拜拜', '拜', 'bye', 'byebye', '晚安', '下次聊', '下次再聊', '回头聊', '明天见', '下次见', '先这样',
+        '我先走了', '我走了', '我先睡了', '我去睡了', '睡了', '先下了', '我先下了',
+    },
+}
+# 可以和问候/告别同时出现、不改变意图的短句
+_FILLERS = {
+    '谢谢', '谢谢你', '谢啦', '多谢', '感谢', '感谢你', '谢谢你的陪伴', '感谢你的陪伴', '谢谢你的倾听', '谢谢陪伴',
+    '好的', '好', '嗯', '嗯嗯', '那', '那就', '那就这样', '好吧', 'ok', '哈哈', '哈哈哈',
+}
+_SPLIT = re.compile(r'[，,。.!！?？~～、\s]+')
+_TRAILING = re.compile(r'[呀啊哇哦喔呢啦嘛吖哈]+$')
+
+# 回复模板池
+_TEMPLATES = {
+    'greeting': [
+        "你好呀！今天过得怎么样？",
+        "嗨，很高兴见到你！最近有什么新鲜事想聊聊吗？",
+        "你好！我在呢，有什么想说的都可以告诉我。",
+        "哈喽～今天心情怎么样？",
+    ],
+    'greeting_morning': [
+        "早上好！新的一天，希望你有个好心情～",
+        "早安！昨晚睡得好吗？",
+    ],
+    'greeting_evening': [
+        "晚上好！今天辛苦了，想聊点什么吗？",
+        "晚上好呀，今天过得还顺利吗？",
+    ],
+    'goodbye': [
+        "再见啦，照顾好自己，随时欢迎回来找我聊天！",
+        "好的，下次见！祝你一切顺利～",
+        "拜拜～有什么想聊的随时来找我哦。",
+    ],
+    'goodbye_night': [
+        "晚安，好好休息，做个好梦！",
+        "晚安～今天辛苦了，明天见！",
+    ],
+}
+
+_short_prompt = """
+你是一个贴心的社交陪伴助手。用户这一轮只是在{action}，请用一两句自然、温暖的话回应，不超过40字，直接输出回应内容。
+"""
+
+_stats = {'turns': 0, 'template': 0, 'short_prompt': 0, 'full': 0}
+_stats_lock = threading.Lock()
+_random = random.Random()
+
+
+def classify(user_input):
+    """
+    判断是否确定是简单轮次
+
+    返回:
+    - (intent, variant): intent 为 greeting / goodbye, variant 为模板池名; 不确定时返回 (None, None)
+    """
+    text = (user_input or '').strip().lower()
+    if not text or len(text) > 30:
+        return None, None
+    found = set()
+    variant = None
+    for part in _SPLIT.split(text):
+        part = _TRAILING.sub('', part)
+        if not part or part in _FILLERS:
+            continue
+        for intent, phrases in _PHRASES.items():
+            if part in phrases:
+                found.add(intent)
+                if part in ('早', '早上好', '早安', '上午好'):
+                    variant = 'greeting_morning'
+                elif part == '晚上好':
+                    variant = 'greeting_evening'
+                elif part == '晚安':
+                    variant = 'goodbye_night'
+                break
+        else:
+            return None, None
+    if not found:
+        return None, None
+    # 同时有问候和告别(如"你好，再见")时按告别处理
+    intent = 'goodbye' if 'goodbye' in found else 'greeting'
+    if variant is None or not variant.startswith(intent):
+        variant = intent
+    return intent, variant
+
+
+def _record(route):
+    with _stats_lock:
+        _stats['turns'] += 1
+        _stats[route] += 1
+    metrics.increment('chat_turns', route)
+
+
+def _template_reply(variant, conversation_history):
+    pool = _TEMPLATES[variant]
+    last = next((msg.get('content') for msg in reversed(conversation_history or [])
+                 if msg.get('role') == 'assistant'), None)
+    choices = [reply for reply in pool if reply != last] or pool
+    return _random.choice(choices)
+
+
+def _short_prompt_reply(intent, user_input, conversation_history):
+    history = [
+        {'role': msg['role'], 'content': msg['content']}
+        for msg in (conversation_history or [])[-2:]
+        if msg.get('role') in ('user', 'assistant') and msg.get('content')
+    ]
+    return call_api(
+        system_prompt=_short_prompt.format(action='打招呼' if intent == 'greeting' else '告别'),
+        user_prompt=user_input,
+        temperature=0.7,
+        max_tokens=fast_path_max_tokens,
+        model_name=fast_path_model_name,
+        priority=PRIORITY_HIGH,
+        coalesce=False,
+        history=history
+    )
+
+
+def respond(user_input, conversation_history):
+    """
+    尝试用快速通道回复
+
+    返回:
+    - 回复文本; 不是简单轮次、已关闭或调用失败时返回None, 由调用方走完整流程(并计入 full)
+    """
+    if fast_path_mode == 'off':
+        return None
+    intent, variant = classify(user_input)
+    if intent is None:
+        return None
+    start = time.perf_counter()
+    if fast_path_mode == 'llm':
+        reply = _short_prompt_reply(intent, user_input, conversation_history)
+        route = 'short_prompt'
+    else:
+        reply = _template_reply(variant, conversation_history)
+        route = 'template'
+    if not reply:
+        return None
+    metrics.observe_stage('fast_path', time.perf_counter() - start)
+    _record(route)
+    return reply
+
+
+def record_full():
+    """记录一轮走完整流程的对话"""
+    _record('full')
+
+
+def stats():
+    """本进程内各去向的轮数与被快速通道分流的比例"""
+    with _stats_lock:
+        result = dict(_stats)
+    absorbed = result['template'] + result['short_prompt']
+    result['absorbed_ratio'] = absorbed / result['turns'] if result['turns'] else 0.0
+    return result
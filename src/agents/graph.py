@@ -0,0 +1,249 @@
+"""
+进程内的Agent执行图
+
+graph.mmd 描述的拓扑(receive_input → analyze_intent → (handle_special_case) → generate_response)由 AgentGraph 执行:
+- 节点声明依赖(after)与执行条件(when); 依赖全部结束(完成、跳过、超时或降级)后判断条件并执行,
+  互不依赖的节点(如记忆检索与意图分析)在线程池中并发执行, 上下文(截止时间、请求钩子、取消范围)随节点带入线程
+- 每个节点可设置超时与降级结果(fallback): 超时或出错时用降级结果继续, 慢节点不拖住关键路径
+- 每个节点可设置缓存(cache_key + cache_ttl), 按键缓存节点的输出
+- done(state) 为真时(如特殊情况已经给出回复)立即返回, 仍在执行的节点在后台完成, 结果丢弃
+- 节点耗时记入 metrics 阶段 node:{name}; 各节点的结果(ok / cached / skipped / timeout / error / abandoned)计入计数 graph_nodes{route=name:结果}
+节点函数接收状态的快照(dict), 返回要合并进状态的dict(或None)
+"""
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import sys
+sys.path.append('/mnt/projects/llm-server')
+from src.utils import metrics
+
+
+class Node:
+    """
+    参数:
+    - fn: 节点函数 fn(state) -> dict
+    - after: 依赖的节点名
+    - when: 可选的条件 when(state) -> bool, 为False时跳过该节点
+    - label: 条件边在图上的标注
+    - ends: 节点可能直接给出最终结果(下游随之跳过), 图上画出到 __end__ 的边
+    - timeout: 超时(秒), None表示不限
+    - fallback: 超时或出错时合并进状态的结果, dict 或 fallback(state) -> dict; 为None时出错直接抛出
+    - cache_key: 可选的 cache_key(state) -> 可哈希的键, 返回None时不缓存
+    - cache_ttl / max_cache_entries: 缓存过期时间(秒)与容量
+    """
+
+    def __init__(self, name, fn, after=(), when=None, label=None, ends=False, timeout=None, fallback=None,
+                 cache_key=None, cache_ttl=60, max_cache_entries=1024):
+        self.name = name
+        self.fn = fn
+        self.after = tuple(after)
+        self.when = when
+        self.label = label
+        self.ends = ends
+        self.timeout = timeout
+        self.fallback = fallback
+        self.cache_key = cache_key
+        self.cache_ttl = cache_ttl
+        self.max_cache_entries = max_cache_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        with self._lock:
+            item = self._cache.get(key)
+            if item is None:
+                return None
+            if item[0] <= time.monotonic():
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return item[1]
+
+    def store(self, key, updates):
+        with self._lock:
+            self._cache[key] = (time.monotonic() + self.cache_ttl, updates)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_cache_entries:
+                self._cache.popitem(last=False)
+
+    def degrade(self, state):
+        if callable(self.fallback):
+            return self.fallback(state)
+        return dict(self.fallback)
+
+
+class AgentGraph:
+    """
+    参数:
+    - name: 图名称(日志用)
+    - done: 可选的 done(state) -> bool, 为真时不再等待其余节点
+    - max_workers: 并发执行节点的线程数
+    - parallel: False时按添加顺序在调用线程中逐个执行(不限超时), 用于对比和排查
+    """
+
+    def __init__(self, name, done=None, max_workers=8, parallel=True):
+        self.name = name
+        self.done = done
+        self.max_workers = max_workers
+        self.parallel = parallel
+        self._nodes = OrderedDict()
+        self._executor = None
+        self._executor_pid = None
+        self._executor_lock = threading.Lock()
+
+    def add_node(self, name, fn, **options):
+        """添加节点, 依赖的节点必须已经添加(保证无环); 选项见 Node"""
+        if name in self._nodes:
+            raise ValueError(f"节点已存在: {name}")
+        for dep in options.get('after', ()):
+            if dep not in self._nodes:
+                raise ValueError(f"未知的依赖节点: {dep}")
+        self._nodes[name] = Node(name, fn, **options)
+        return self._nodes[name]
+
+    def _pool(self):
+        pid = os.getpid()
+        with self._executor_lock:
+            if self._executor is None or self._executor_pid != pid:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                                    thread_name_prefix=f"graph-{self.name}")
+                self._executor_pid = pid
+            return self._executor
+
+    def _excluded(self, stop_before):
+        """stop_before 中的节点及其所有下游节点"""
+        excluded = set(stop_before)
+        for name, node in self._nodes.items():
+            if any(dep in excluded for dep in node.after):
+                excluded.add(name)
+        return excluded
+
+    def _finish(self, node, state, result, status, elapsed, timings):
+        timings[node.name] = elapsed
+        metrics.observe_stage(f"node:{node.name}", elapsed)
+        metrics.increment('graph_nodes', f"{node.name}:{status}")
+        if result:
+            state.update(result)
+        return status
+
+    def _outcome(self, node, state, key, call):
+        """执行节点函数(或取出其结果), 返回 (合并结果, 状态)"""
+        try:
+            result = call()
+        except Exception as e:
+            if node.fallback is None:
+                raise
+            print(f"图 {self.name} 节点 {node.name} 执行失败, 使用降级结果: {e}")
+            return node.degrade(state), 'error'
+        if key is not None:
+            node.store(key, result or {})
+        return result, 'ok'
+
+    def run(self, state, stop_before=()):
+        """
+        执行图
+
+        参数:
+        - state: 初始状态
+        - stop_before: 不执行的节点名(及其下游), 如流式接口自行执行最后的生成节点
+
+        返回:
+        - 合并了各节点输出的新状态; state['node_timings'] 为本次各节点耗时(秒)
+        """
+        state = dict(state)
+        timings = {}
+        finished = {}
+        excluded = self._excluded(stop_before)
+        pending = [name for name in self._nodes if name not in excluded]
+        running = {}
+
+        while pending or running:
+            if self.done is not None and self.done(state):
+                for future, (node, started, _) in running.items():
+                    future.cancel()
+                    metrics.increment('graph_nodes', f"{node.name}:abandoned")
+                break
+            progressed = False
+            ready = [name for name in pending if all(dep in finished for dep in self._nodes[name].after)]
+            for name in ready:
+                node = self._nodes[name]
+                pending.remove(name)
+                if node.when is not None and not node.when(state):
+                    finished[name] = self._finish(node, state, None, 'skipped', 0.0, timings)
+                    progressed = True
+                    continue
+                key = node.cache_key(state) if node.cache_key is not None else None
+                hit = node.lookup(key) if key is not None else None
+                if hit is not None:
+                    finished[name] = self._finish(node, state, hit, 'cached', 0.0, timings)
+                    progressed = True
+                    continue
+                if not self.parallel or (node.timeout is None and not running and len(ready) == 1):
+                    # 唯一可执行且不限时的节点直接在调用线程中执行, 省去线程切换
+                    start = time.perf_counter()
+                    result, status = self._outcome(node, state, key, lambda: node.fn(dict(state)))
+                    finished[name] = self._finish(node, state, result, status, time.perf_counter() - start, timings)
+                    progressed = True
+                    continue
+                future = self._pool().submit(contextvars.copy_context().run, node.fn, dict(state))
+                running[future] = (node, time.perf_counter(), key)
+            if progressed:
+                continue
+            if not running:
+                break
+
+            now = time.perf_counter()
+            waits = [started + node.timeout - now for node, started, _ in running.values() if node.timeout is not None]
+            done, _ = wait(list(running), timeout=max(0.0, min(waits)) if waits else None,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                node, started, key = running.pop(future)
+                result, status = self._outcome(node, state, key, future.result)
+                finished[node.name] = self._finish(node, state, result, status, time.perf_counter() - started,
+                                                   timings)
+            now = time.perf_counter()
+            for future, (node, started, key) in list(running.items()):
+                if node.timeout is not None and now - started >= node.timeout:
+                    # 超时的节点在后台继续执行完, 结果丢弃
+                    del running[future]
+                    future.cancel()
+                    if node.fallback is None:
+                        raise TimeoutError(f"图 {self.name} 节点 {node.name} 超时 {node.timeout}s")
+                    print(f"图 {self.name} 节点 {node.name} 超时 {node.timeout}s, 使用降级结果")
+                    finished[node.name] = self._finish(node, state, node.degrade(state), 'timeout', now - started,
+                                                       timings)
+
+        state['node_timings'] = timings
+        return state
+
+    def to_mermaid(self):
+        """按当前拓扑生成 mermaid 流程图(graph.mmd)"""
+        lines = [
+            '---', 'config:', '  flowchart:', '    curve: linear', '---', 'graph TD;',
+            '\t__start__([<p>__start__</p>]):::first',
+        ]
+        lines += [f"\t{name}({name})" for name in self._nodes]
+        lines.append('\t__end__([<p>__end__</p>]):::last')
+        downstream = {dep for node in self._nodes.values() for dep in node.after}
+        edges = []
+        for name, node in self._nodes.items():
+            if not node.after:
+                edges.append(f"\t__start__ --> {name};")
+            for dep in node.after:
+                if node.label:
+                    edges.append(f"\t{dep} -. &nbsp;{node.label}&nbsp; .-> {name};")
+                else:
+                    edges.append(f"\t{dep} --> {name};")
+            if node.ends or name not in downstream:
+                edges.append(f"\t{name} --> __end__;")
+        lines += sorted(edges)
+        lines += [
+            '\tclassDef default fill:#f2f0ff,line-height:1.2',
+            '\tclassDef first fill-opacity:0',
+            '\tclassDef last fill:#bfb6fc',
+        ]
+        return "\n".join(lines) + "\n"
@@ -1,16 +1,75 @@
 # 思维链 + 非JSON格式化输出
 from typing import Dict, Any, List, Generator, Union
 import json
+import os
 import time
 
 import sys
 sys.path.append('/mnt/projects/llm-server')
-from src.utils.kllm import call_api, call_api_stream
+from src.utils.kllm import call_api_stream, request_hooks, PRIORITY_NORMAL
+from src.utils.resilience import current_cancel
+from src.utils.tokens import count_tokens, history_window
+from src.utils.prompt_render import HistoryRenderer
+from src.agents.summary import dialogue_messages, get_summary, redis_url
+from src.agents.reply_budget import ReplyBudget, classify_intent
+from src.agents import fast_path
+from src.agents.graph import AgentGraph
+from src.diary_system.knote import index_path_for
+from src.diary_system.retrieval import MemoryIndex
+from src.utils.metrics import observe_stage, increment
+from src.utils.near_cache import NearDuplicateCache, context_key
 
 # 初始化LLM配置
 temperature = 0.01
 max_tokens = 32768
 model_name = "qwen3-4b-instruct-2507-fp8"
+# 聊天回复的最大token数上限, 每轮按意图自适应取更小的值(见 reply_budget)
+chat_max_tokens = 5000
+adaptive_reply_budget = os.environ.get('KAGENT_ADAPTIVE_REPLY_BUDGET', '1') == '1'
+# 停止序列, 用 | 分隔, \n 表示换行; 防止模型续写出下一轮的角色标记
+stop_sequences = [
+    seq.replace('\\n', '\n')
+    for seq in os.environ.get('KAGENT_STOP_SEQUENCES', '\\nuser:|\\n用户:|\\n用户：').split('|') if seq
+]
+# 单次回复的时长上限(秒), 超过后截断, 限制尾延迟
+reply_cutoff_seconds = float(os.environ.get('KAGENT_REPLY_CUTOFF_SECONDS', '20'))
+# 模型上下文长度(与vLLM的 --max-model-len 一致)
+context_tokens = int(os.environ.get('KAGENT_CONTEXT_TOKENS', '16384'))
+# 历史对话最多占用的token数, 限制每轮的prefill开销
+history_token_budget = int(os.environ.get('KAGENT_HISTORY_TOKEN_BUDGET', '6000'))
+# token估算误差的安全余量
+context_margin = 256
+# 历史渲染缓存: redis(各worker共享) / local(进程内) / off(每轮整体渲染)
+render_cache = os.environ.get('KAGENT_RENDER_CACHE', 'redis')
+history_renderer = None
+if render_cache != 'off':
+    history_renderer = HistoryRenderer(redis_url if render_cache == 'redis' else None)
+reply_budget = ReplyBudget(chat_max_tokens, redis_url=redis_url)
+# 每轮从日记中检索的记忆条数上限, 0表示不检索
+memory_top_k = int(os.environ.get('KAGENT_MEMORY_TOP_K', '5'))
+# 记忆段落的token上限; 按上限固定预留, 历史窗口不随检索结果变化
+memory_section_tokens = int(os.environ.get('KAGENT_MEMORY_TOKENS', '300'))
+# BM25得分低于该值的记忆视为不相关
+memory_min_score = float(os.environ.get('KAGENT_MEMORY_MIN_SCORE', '1.0'))
+memory_index = MemoryIndex(os.environ.get('KAGENT_MEMORY_INDEX', index_path_for('diary_data.json')))
+memory_header = "## 相关记忆\n"
+# 近似重复输入的回复缓存: n-gram相似度下限(0表示关闭)、过期时间与参与上下文哈希的最近消息数
+near_cache_threshold = float(os.environ.get('KAGENT_NEAR_CACHE_THRESHOLD', '0.85'))
+near_cache_ttl = int(os.environ.get('KAGENT_NEAR_CACHE_TTL', str(6 * 3600)))
+near_cache_context_turns = int(os.environ.get('KAGENT_NEAR_CACHE_CONTEXT_TURNS', '2'))
+# 流式回放缓存回复时每段的字符数
+near_cache_chunk_chars = 8
+reply_cache = None
+if near_cache_threshold > 0:
+    reply_cache = NearDuplicateCache(threshold=near_cache_threshold, ttl=near_cache_ttl)
+# 执行图: 关闭并发时各节点在调用线程中逐个执行
+graph_parallel = os.environ.get('KAGENT_GRAPH_PARALLEL', '1') == '1'
+# 节点超时(秒), 超时后降级: 意图分析按 other 意图和最大预算, 记忆检索不附记忆, 快速通道转完整流程
+intent_timeout = float(os.environ.get('KAGENT_INTENT_TIMEOUT', '1.0'))
+memory_timeout = float(os.environ.get('KAGENT_MEMORY_TIMEOUT', '0.3'))
+special_case_timeout = float(os.environ.get('KAGENT_SPECIAL_CASE_TIMEOUT', '5.0'))
+# 相同输入的记忆检索结果缓存时间(秒); 日记索引每天整理一次
+memory_cache_ttl = 60
 
 class KAgent:
     """
@@ -58,103 +117,290 @@ class KAgent:
 
 ## 输出格式
 请基于以上分析直接输出最终回应内容，要自然、温暖、人性化，不要包含任何JSON格式或其他额外信息。
+
+## 处理要求
+之前的消息是历史对话，最后一条用户消息是当前输入。
+当前输入前如果附有"相关记忆"，那是从用户的长期记忆中检索到的信息，仅在相关时自然地参考，不要逐条复述。
+请严格按照思维链步骤分析对话，确保情绪分析和意图识别准确。
+最终回应要自然、温暖、人性化，展现同理心。
 """
+        self.cod_prompt_tokens = count_tokens(self.cod_prompt)
+        self.graph = self._build_graph()
+
+    def _build_graph(self) -> AgentGraph:
+        """
+        按 graph.mmd 的拓扑构建执行图
+        
+        记忆检索只依赖输入, 与意图分析、提示词构建并发执行;
+        特殊情况(快速通道、近似输入缓存)给出回复后立即返回, 不等待记忆检索
+        """
+        graph = AgentGraph('kagent', done=lambda state: state.get('reply') is not None, parallel=graph_parallel)
+        graph.add_node('receive_input', self._receive_input)
+        graph.add_node('analyze_intent', self._analyze_intent, after=('receive_input',), timeout=intent_timeout,
+                       fallback=lambda state: {'route': 'normal', 'intent': 'other',
+                                               'max_reply_tokens': chat_max_tokens, 'context': None})
+        graph.add_node('retrieve_memory', self._retrieve_memory, after=('receive_input',), timeout=memory_timeout,
+                       fallback=lambda state: {'user_prompt': state['user_input']},
+                       cache_key=lambda state: state['user_input'], cache_ttl=memory_cache_ttl)
+        graph.add_node('handle_special_case', self._handle_special_case, after=('analyze_intent',),
+                       when=lambda state: state['route'] == 'special', label='special', ends=True,
+                       timeout=special_case_timeout, fallback={})
+        graph.add_node('build_prompt', self._prepare_prompt, after=('analyze_intent', 'handle_special_case'),
+                       when=lambda state: state.get('reply') is None, label='normal')
+        graph.add_node('generate_response', self._generate_response, after=('build_prompt', 'retrieve_memory'),
+                       when=lambda state: state.get('reply') is None)
+        return graph
     
-    def _build_conversation_context(self, user_input: str, conversation_history: List[Dict]) -> str:
-        """构建对话上下文"""
-        if not conversation_history:
-            return f"当前用户输入: {user_input}\n历史对话: 无"
+    def _build_prompt(self, user_input: str, conversation_history: List[Dict], reply_tokens: int,
+                      conversation_id: str):
+        """
+        构建系统提示词与历史消息
+        
+        历史对话按原样作为独立的 user/assistant 消息放在系统提示词之后, 当前输入作为最后一条消息,
+        每轮只在末尾追加内容, 前缀(系统提示词 + 之前的轮次)不变, vLLM可直接复用其KV缓存
         
-        # 只保留最近对话以减少token消耗
-        recent_history = conversation_history[:]  # XX全轮次的对话
-        history_str = "\n".join([
-            f"{msg['role']}: {msg['content']}" 
-            # (f" [情绪: {msg.get('emotion', '未知')}]" if msg.get('emotion') else "")
-            for msg in recent_history
-        ])
+        已被后台任务压缩进滚动摘要的早期轮次不再发送, 摘要附在系统提示词末尾(摘要更新时才变化);
+        其余轮次按token预算截取最新的部分: 预算取 history_token_budget 与上下文剩余空间的较小值,
+        剩余空间 = 上下文长度 - 系统提示词(含摘要) - 当前输入 - 为回复预留的 reply_tokens
+        每条消息的token数缓存在历史记录上, 随对话历史一起保存;
+        启用渲染缓存时历史以已编码的 RenderedHistory 返回, 每轮只渲染新增的消息
         
-        return f"""当前用户输入: {user_input}
-历史对话:
-{history_str}"""
+        返回:
+        - (system_prompt, history)
+        """
+        messages = all_messages = dialogue_messages(conversation_history)
+        system_prompt = self.cod_prompt
+        system_tokens = self.cod_prompt_tokens
+        # 只读取已有摘要, 不等待正在生成的新摘要
+        summary, covered = get_summary(conversation_id, messages)
+        if summary:
+            system_prompt = f"{self.cod_prompt}\n## 早前对话摘要\n{summary}\n"
+            system_tokens += count_tokens(summary)
+            messages = messages[covered:]
+        
+        available = (context_tokens - system_tokens - count_tokens(user_input) - reply_tokens - context_margin
+                     - (memory_section_tokens if memory_top_k > 0 else 0))
+        budget = min(history_token_budget, available)
+        if history_renderer is not None:
+            # 只编码和计数上一轮之后新增的消息, 窗口选择规则与 history_window 相同
+            return system_prompt, history_renderer.render(conversation_id, all_messages, covered, max(budget, 0))
+        window = history_window(messages, budget)
+        return system_prompt, [{'role': msg['role'], 'content': msg['content']} for msg in window]
    
-    def chat(self, user_input: str, conversation_history: List[Dict]) -> Dict[str, Any]:
-        """非流式聊天接口"""
+    def _with_memories(self, user_input: str) -> str:
+        """
+        检索与当前输入相关的日记记忆, 放在当前输入之前
+        
+        记忆只附在最后一条消息上, 不进入系统提示词和保存的历史, 不影响前缀缓存;
+        段落最多 memory_top_k 条、memory_section_tokens 个token, 检索耗时单独记入 memory_retrieval 阶段
+        """
+        if memory_top_k <= 0:
+            return user_input
+        start = time.perf_counter()
+        hits = memory_index.search(user_input, memory_top_k, memory_min_score)
+        lines = []
+        used = count_tokens(memory_header)
+        for hit in hits:
+            line = f"- ({hit['date']}) {hit['text']}"
+            cost = count_tokens(line) + 1
+            if used + cost > memory_section_tokens:
+                break
+            lines.append(line)
+            used += cost
+        observe_stage('memory_retrieval', time.perf_counter() - start)
+        if not lines:
+            return user_input
+        return memory_header + "\n".join(lines) + f"\n\n## 当前输入\n{user_input}"
 
-        if conversation_history is None:
-            conversation_history = []
+    def _cached_reply(self, user_input: str, conversation_history: List[Dict]):
+        """查找近似相同输入在相同上下文下的缓存回复, 返回 (reply, context)"""
+        if reply_cache is None:
+            return None, None
+        context = context_key(conversation_history, near_cache_context_turns)
+        reply = reply_cache.get(user_input, context=context)
+        if reply is not None:
+            increment('chat_turns', 'near_cache')
+            print("命中近似输入缓存")
+        return reply, context
 
-        # 构建完整的提示词
-        context = self._build_conversation_context(user_input, conversation_history)
-        
-        user_prompt = f"""
-## 对话上下文
-{context}
+    def _reply_tokens(self, user_input: str):
+        """按预判的意图确定本轮回复的 max_tokens, 返回 (intent, max_tokens)"""
+        intent = classify_intent(user_input)
+        if not adaptive_reply_budget:
+            return intent, chat_max_tokens
+        return intent, reply_budget.budget(intent)
 
-## 处理要求
-请严格按照思维链步骤分析以上对话，确保情绪分析和意图识别准确。
-最终回应要自然、温暖、人性化，展现同理心。
+    def _observe_reply(self, intent: str, reply: str, max_reply_tokens: int, completion_tokens: int = None,
+                       cut_off: bool = False):
+        """记录回复长度; 没有 usage 时按文本估算, 接近上限即视为被截断"""
+        if not reply:
+            return
+        if completion_tokens:
+            truncated = cut_off or completion_tokens >= max_reply_tokens
+        else:
+            completion_tokens = count_tokens(reply)
+            truncated = cut_off or completion_tokens >= max_reply_tokens * 0.9
+        reply_budget.observe(intent, completion_tokens, truncated)
 
-请直接输出最终回应内容，不要包含任何JSON格式或其他额外信息。
-"""
-        
+    def _receive_input(self, state: Dict) -> Dict:
+        return {'conversation_history': state.get('conversation_history') or []}
+
+    def _analyze_intent(self, state: Dict) -> Dict:
+        """纯问候/告别或命中近似输入缓存时走特殊情况, 否则预判意图并确定回复预算"""
+        user_input = state['user_input']
+        special = fast_path.fast_path_mode != 'off' and fast_path.classify(user_input)[0] is not None
+        cached, context = (None, None) if special else self._cached_reply(user_input, state['conversation_history'])
+        intent, max_reply_tokens = self._reply_tokens(user_input)
+        return {
+            'route': 'special' if special or cached is not None else 'normal',
+            'intent': intent,
+            'max_reply_tokens': max_reply_tokens,
+            'cached_reply': cached,
+            'context': context
+        }
+
+    def _retrieve_memory(self, state: Dict) -> Dict:
+        return {'user_prompt': self._with_memories(state['user_input'])}
+
+    def _handle_special_case(self, state: Dict) -> Dict:
+        """缓存的回复直接使用(流式时按小段回放); 快速通道调用失败时回复为None, 转完整流程"""
+        if state.get('cached_reply') is not None:
+            return {'reply': state['cached_reply'], 'replay': True}
+        return {'reply': fast_path.respond(state['user_input'], state['conversation_history'])}
+
+    def _prepare_prompt(self, state: Dict) -> Dict:
+        """构建系统提示词(含滚动摘要)与历史消息, 当前输入作为最后一条消息"""
+        fast_path.record_full()
+        system_prompt, history = self._build_prompt(state['user_input'], state['conversation_history'],
+                                                    state['max_reply_tokens'], state['conversation_id'])
+        return {'system_prompt': system_prompt, 'history': history}
+
+    def _generate_response(self, state: Dict) -> Dict:
+        """非流式生成回复(失败或没有输出时为None); 流式接口在图外自行执行这一步"""
+        user_input = state['user_input']
+        intent = state['intent']
+        max_reply_tokens = state['max_reply_tokens']
         try:
-            # 使用流式API调用，只获取最终回应
             cod_time_start = time.time()
-            response = call_api(
-                system_prompt=self.cod_prompt,
-                user_prompt=user_prompt,
-                temperature=0.1,  # 较低温度保证情绪分析准确性
-                max_tokens=5000,  # 增加token以容纳情绪分析
-                model_name=model_name
-            )
+            records = []
+            parts = []
+            cut_off = False
+            # 与流式接口一致: 超过时长上限时关闭上游连接, 返回已生成的部分
+            with request_hooks(records.append):
+                stream = call_api_stream(
+                    system_prompt=state['system_prompt'],
+                    user_prompt=state['user_prompt'],
+                    temperature=0.1,  # 较低温度保证情绪分析准确性
+                    max_tokens=max_reply_tokens,
+                    model_name=model_name,
+                    priority=PRIORITY_NORMAL,
+                    history=state['history'],
+                    stop=stop_sequences
+                )
+                try:
+                    for chunk in stream:
+                        if chunk:
+                            parts.append(chunk)
+                        if time.time() - cod_time_start > reply_cutoff_seconds:
+                            cut_off = True
+                            print(f"回复超过时长上限 {reply_cutoff_seconds}s, 截断输出")
+                            break
+                finally:
+                    stream.close()
+            response = ''.join(parts)
             cod_time_end = time.time()
             cod_time_consume = cod_time_end - cod_time_start
+            if not response:
+                print(f"思维链没有输出 耗时: {cod_time_consume:.3f}s")
+                return {'reply': None}
             
-            print(f"\n====思维链流式输出完成==== 耗时: {cod_time_consume:.3f}s")
-            return response
+            usage = next((r.completion_tokens for r in records if r.completion_tokens), None)
+            self._observe_reply(intent, response, max_reply_tokens, usage, cut_off=cut_off)
+            # 被截断的回复不缓存
+            if not cut_off and state.get('context') is not None:
+                reply_cache.set(user_input, response, context=state['context'])
+            print(f"\n====思维链输出完成==== 意图: {intent} 预算: {max_reply_tokens} 耗时: {cod_time_consume:.3f}s")
+            return {'reply': response}
             
         except Exception as e:
             print(f"思维链处理失败: {e}")
-            return "思维链处理失败"
+            return {'reply': None}
+
+    def chat(self, user_input: str, conversation_history: List[Dict],
+             conversation_id: str = 'default') -> Dict[str, Any]:
+        """非流式聊天接口; 调用失败或没有任何输出时返回None, 调用方不应把它写入对话历史"""
+        state = self.graph.run({
+            'user_input': user_input,
+            'conversation_history': conversation_history,
+            'conversation_id': conversation_id
+        })
+        return state['reply']
     
-    def chat_stream(self, user_input: str, conversation_history: List[Dict] = None) -> Generator[str, None, None]:
+    def chat_stream(self, user_input: str, conversation_history: List[Dict] = None,
+                    conversation_id: str = 'default') -> Generator[str, None, None]:
         """流式聊天接口"""
-        if conversation_history is None:
-            conversation_history = []
-            
-        # 构建对话上下文
-        context = self._build_conversation_context(user_input, conversation_history)
-        
-        user_prompt = f"""
-## 对话上下文
-{context}
-
-## 处理要求
-请严格按照思维链步骤分析以上对话，确保情绪分析和意图识别准确。
-最终回应要自然、温暖、人性化，展现同理心。
-
-请直接输出最终回应内容，不要包含任何JSON格式或其他额外信息。
-"""
+        # 执行到生成之前: 意图分析、记忆检索与提示词构建并发完成
+        state = self.graph.run({
+            'user_input': user_input,
+            'conversation_history': conversation_history,
+            'conversation_id': conversation_id
+        }, stop_before=('generate_response',))
+        reply = state.get('reply')
+        if reply is not None:
+            if state.get('replay'):
+                # 缓存的回复按小段回放, 客户端仍按流式处理
+                for i in range(0, len(reply), near_cache_chunk_chars):
+                    yield reply[i:i + near_cache_chunk_chars]
+            else:
+                # 快速通道的回复整条一次输出
+                yield reply
+            return
+        intent = state['intent']
+        max_reply_tokens = state['max_reply_tokens']
         
         try:
             # 使用流式API调用
             cod_time_start = time.time()
             
             # 流式调用API
-            for chunk in call_api_stream(
-                system_prompt=self.cod_prompt,
-                user_prompt=user_prompt,
+            stream = call_api_stream(
+                system_prompt=state['system_prompt'],
+                user_prompt=state['user_prompt'],
                 temperature=0.1,  # 较低温度保证情绪分析准确性
-                max_tokens=5000,  # 增加token以容纳情绪分析
-                model_name=model_name
-            ):
-                if chunk:
-                    yield chunk
+                max_tokens=max_reply_tokens,
+                model_name=model_name,
+                history=state['history'],
+                stop=stop_sequences
+            )
+            parts = []
+            cut_off = False
+            try:
+                for chunk in stream:
+                    if chunk:
+                        parts.append(chunk)
+                        yield chunk
+                    if time.time() - cod_time_start > reply_cutoff_seconds:
+                        # 超过时长上限, 关闭上游连接让vLLM停止生成
+                        cut_off = True
+                        print(f"回复超过时长上限 {reply_cutoff_seconds}s, 截断输出")
+                        break
+            finally:
+                stream.close()
             
             cod_time_end = time.time()
             cod_time_consume = cod_time_end - cod_time_start
+            observe_stage('node:generate_response', cod_time_consume)
+            scope = current_cancel()
+            if scope is not None and scope.cancelled:
+                # 客户端已离开, 不完整的回复既不计入预算样本也不缓存
+                print(f"\n====流式输出被取消==== 原因: {scope.reason} 已输出 {len(parts)} 段 耗时: {cod_time_consume:.3f}s")
+                return
             
-            print(f"\n====思维链流式输出完成==== 耗时: {cod_time_consume:.3f}s")
+            self._observe_reply(intent, ''.join(parts), max_reply_tokens, cut_off=cut_off)
+            # 被截断的回复不缓存
+            if parts and not cut_off and state.get('context') is not None:
+                reply_cache.set(user_input, ''.join(parts), context=state['context'])
+            print(f"\n====思维链流式输出完成==== 意图: {intent} 预算: {max_reply_tokens} 耗时: {cod_time_consume:.3f}s")
             
         except Exception as e:
             print(f"思维链流式处理失败: {e}")
@@ -0,0 +1,179 @@
+"""
+聊天回复的自适应生成预算
+
+vLLM按 max_tokens 为请求预留调度与KV容量, 陪伴类回复通常只有几句话, 固定5000既浪费容量,
+也让失控的生成长时间占住流式名额。这里按意图给出 max_tokens:
+- classify_intent(): 用关键词规则预判本轮意图, 类别与思维链提示词中的意图分类一致(模型输出前就要确定预算)
+- ReplyBudget: 记录各意图实际回复的token数, 预算取近期样本的高分位数乘以余量, 向上取到固定档位;
+  样本不足时使用 default_budgets。样本写入Redis, 各worker(及重启后的worker)共享
+"""
+import os
+import re
+import threading
+import time
+from collections import deque
+
+INTENTS = ('greeting', 'question', 'sharing_feelings', 'seeking_comfort', 'small_talk', 'goodbye', 'other')
+
+# 样本不足时各意图的预算
+default_budgets = {
+    'greeting': 256,
+    'goodbye': 256,
+    'small_talk': 512,
+    'sharing_feelings': 768,
+    'seeking_comfort': 1024,
+    'question': 1024,
+    'other': 768,
+}
+# 预算档位: 取值固定, 相同输入的 max_tokens 不随样本抖动, 不影响响应缓存命中
+budget_steps = (128, 192, 256, 384, 512, 768, 1024, 1536, 2048, 3072, 4096)
+
+reply_budget_percentile = float(os.environ.get('KAGENT_REPLY_BUDGET_PERCENTILE', '0.95'))
+# 在分位数之上保留的余量倍数
+reply_budget_headroom = float(os.environ.get('KAGENT_REPLY_BUDGET_HEADROOM', '1.5'))
+
+# 按顺序匹配, 先命中的意图优先
+_RULES = (
+    ('goodbye', re.compile(r'再见|拜拜|晚安|下次(再)?聊|先(走|睡|下)了|回头聊|\bbye\b', re.I)),
+    ('greeting', re.compile(r'^\s*(你好|您好|嗨|哈喽|hello|hi|早上好|早安|中午好|下午好|晚上好|在吗)', re.I)),
+    ('seeking_comfort', re.compile(r'难过|伤心|崩溃|压力|焦虑|担心|害怕|孤独|寂寞|失眠|委屈|好累|心累|烦|想哭|哭了|怎么办|撑不住')),
+    ('question', re.compile(r'[?？]\s*$|吗\s*$|为什么|怎么|如何|什么|哪里|哪个|能不能|可不可以|是不是')),
+    ('sharing_feelings', re.compile(r'开心|高兴|兴奋|激动|感觉|觉得|心情|今天|刚刚|终于')),
+)
+# 不匹配任何规则的短句按闲聊处理
+small_talk_max_chars = 20
+
+
+def classify_intent(user_input):
+    """按关键词规则预判意图"""
+    text = (user_input or '').strip()
+    for intent, pattern in _RULES:
+        if pattern.search(text):
+            # 带问候词的长句通常还有别的内容, 不按问候处理
+            if intent == 'greeting' and len(text) > small_talk_max_chars:
+                continue
+            return intent
+    return 'small_talk' if len(text) <= small_talk_max_chars else 'other'
+
+
+def _step_up(tokens, max_budget):
+    for step in budget_steps:
+        if step >= tokens:
+            return min(step, max_budget)
+    return max_budget
+
+
+class ReplyBudget:
+    """
+    按意图学习回复长度
+
+    参数:
+    - max_budget: 预算上限(原固定的 max_tokens)
+    - min_budget: 预算下限
+    - redis_url: 共享样本的Redis地址, None表示只在进程内学习
+    - min_samples: 样本数达到该值后才使用学习到的预算
+    - window: 每个意图保留的样本数
+    - refresh_interval: 从Redis重新加载样本的间隔(秒)
+    """
+
+    def __init__(self, max_budget, min_budget=128, redis_url=None, min_samples=20, window=200,
+                 refresh_interval=30):
+        self.max_budget = max_budget
+        self.min_budget = min_budget
+        self.redis_url = redis_url
+        self.min_samples = min_samples
+        self.window = window
+        self.refresh_interval = refresh_interval
+        self._samples = {intent: deque(maxlen=window) for intent in INTENTS}
+        self._lock = threading.Lock()
+        self._loaded_at = 0.0
+        self._client = None
+        self._client_pid = None
+        self._unavailable_until = 0.0
+        self._stats = {intent: {'replies': 0, 'truncated': 0} for intent in INTENTS}
+
+    def _redis(self):
+        if self.redis_url is None or time.time() < self._unavailable_until:
+            return None
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            import redis
+            self._client = redis.Redis.from_url(self.redis_url, decode_responses=True, socket_timeout=0.5,
+                                                socket_connect_timeout=0.5)
+            self._client_pid = pid
+        return self._client
+
+    def _key(self, intent):
+        return f"kagent:reply_tokens:{intent}"
+
+    def _refresh(self):
+        """定期用Redis中所有worker的样本替换本地样本"""
+        now = time.time()
+        if now - self._loaded_at < self.refresh_interval:
+            return
+        self._loaded_at = now
+        client = self._redis()
+        if client is None:
+            return
+        try:
+            pipe = client.pipeline()
+            for intent in INTENTS:
+                pipe.lrange(self._key(intent), 0, self.window - 1)
+            loaded = pipe.execute()
+        except Exception as e:
+            print(f"读取回复长度样本失败, 30秒内只使用本地样本: {e}")
+            self._unavailable_until = now + 30
+            return
+        with self._lock:
+            for intent, values in zip(INTENTS, loaded):
+                if values:
+                    self._samples[intent] = deque((int(v) for v in reversed(values)), maxlen=self.window)
+
+    def budget(self, intent):
+        """该意图本轮的 max_tokens"""
+        if intent not in self._samples:
+            intent = 'other'
+        self._refresh()
+        with self._lock:
+            samples = sorted(self._samples[intent])
+        if len(samples) < self.min_samples:
+            return min(default_budgets.get(intent, self.max_budget), self.max_budget)
+        value = samples[min(len(samples) - 1, int(len(samples) * reply_budget_percentile))]
+        return _step_up(max(self.min_budget, int(value * reply_budget_headroom)), self.max_budget)
+
+    def observe(self, intent, tokens, truncated=False):
+        """
+        记录一次回复的token数
+
+        参数:
+        - truncated: 回复被 max_tokens 或时长上限截断, 按截断时的长度记录;
+          截断超过 1 - reply_budget_percentile 的比例时分位数落在上限上, 预算按余量逐档放宽,
+          偶发的失控生成则不会抬高预算
+        """
+        if intent not in self._samples:
+            intent = 'other'
+        value = int(tokens)
+        with self._lock:
+            self._samples[intent].append(value)
+            self._stats[intent]['replies'] += 1
+            if truncated:
+                self._stats[intent]['truncated'] += 1
+        client = self._redis()
+        if client is None:
+            return
+        try:
+            client.pipeline().lpush(self._key(intent), value).ltrim(self._key(intent), 0, self.window - 1).execute()
+        except Exception as e:
+            print(f"保存回复长度样本失败: {e}")
+            self._unavailable_until = time.time() + 30
+
+    def stats(self):
+        """各意图的当前预算、样本数与截断次数"""
+        result = {}
+        for intent in INTENTS:
+            with self._lock:
+                stats = dict(self._stats[intent])
+                stats['samples'] = len(self._samples[intent])
+            stats['budget'] = self.budget(intent)
+            result[intent] = stats
+        return result
@@ -0,0 +1,186 @@
+"""
+对话滚动摘要
+
+对话历史较长时, 由后台Celery任务把较早的轮次压缩成摘要, KAgent用摘要代替这些原始轮次:
+- 摘要状态保存在Redis: {'summary': 摘要, 'covered': 已被摘要覆盖的历史消息数, 'anchor': 覆盖范围最后一条消息的指纹}
+- 聊天路径只读取已有摘要, 从不等待摘要生成; 新摘要生成期间继续使用旧摘要
+- 历史被改写(如整理长期记忆后清空)时指纹不再匹配, 旧摘要自动失效
+"""
+import hashlib
+import json
+import os
+import time
+
+import sys
+sys.path.append('/mnt/projects/llm-server')
+from src.utils.kllm import call_api
+from src.utils.limiter import PRIORITY_LOW
+from src.utils.tokens import count_tokens, message_tokens
+
+# 状态共用的Redis地址: KAGENT_REDIS_URL, 未设置时取 KLLM_REDIS_URL(与kllm一致)
+redis_url = os.environ.get('KAGENT_REDIS_URL') or os.environ.get('KLLM_REDIS_URL', 'redis://localhost:6379/0')
+# 未被摘要覆盖的历史超过该token数时触发摘要任务
+summary_trigger_tokens = int(os.environ.get('KAGENT_SUMMARY_TRIGGER_TOKENS', '4000'))
+# 摘要后保留的最近原始轮次的token数
+summary_keep_tokens = int(os.environ.get('KAGENT_SUMMARY_KEEP_TOKENS', '1500'))
+# 摘要的最大token数
+summary_max_tokens = int(os.environ.get('KAGENT_SUMMARY_MAX_TOKENS', '800'))
+# 同一对话的摘要任务互斥时长(秒), 任务异常退出时锁自动过期
+summary_lock_ttl = 300
+summary_model_name = "qwen3-4b-instruct-2507-fp8"
+
+summary_prompt = """
+## 角色
+你负责为社交陪伴助手维护对话摘要
+
+## 说明
+- 输入包含已有摘要(可能为空)和之后新增的对话
+- 输出合并后的新摘要, 保留用户的情绪变化、关心的话题、提到的人和事、做过的决定和助手给出的建议
+- 按时间顺序组织, 省略寒暄和重复内容
+- 摘要不超过500字
+
+## 输出格式要求
+- 直接输出摘要正文, 仅使用纯文本书写
+"""
+
+_client = None
+_client_pid = None
+# Redis不可用时暂停读取摘要的截止时刻, 避免每轮聊天都等待连接失败
+_unavailable_until = 0.0
+
+
+def _redis():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        import redis
+        # 聊天路径会读取摘要, Redis异常时要快速失败而不是卡住请求
+        _client = redis.Redis.from_url(redis_url, decode_responses=True, socket_timeout=0.5,
+                                       socket_connect_timeout=0.5)
+        _client_pid = pid
+    return _client
+
+
+def _key(conversation_id):
+    return f"kagent:summary:{conversation_id}"
+
+
+def dialogue_messages(conversation_history):
+    """对话历史中的有效轮次(摘要覆盖的消息数按该列表计算)"""
+    return [
+        msg for msg in conversation_history
+        if msg.get('role') in ('user', 'assistant') and msg.get('content')
+    ]
+
+
+def _anchor(messages, covered):
+    """覆盖范围最后一条消息的指纹"""
+    if covered <= 0:
+        return ''
+    msg = messages[covered - 1]
+    return hashlib.sha1(f"{covered}:{msg.get('role')}:{msg.get('content')}".encode('utf-8')).hexdigest()
+
+
+def get_summary(conversation_id, messages):
+    """
+    读取对话的当前摘要
+
+    返回:
+    - (summary, covered): 摘要文本与其覆盖的消息数; 没有摘要、Redis不可用或历史已被改写时返回 (None, 0)
+    """
+    global _unavailable_until
+    if time.time() < _unavailable_until:
+        return None, 0
+    try:
+        raw = _redis().get(_key(conversation_id))
+    except Exception as e:
+        print(f"读取对话摘要失败, 30秒内不再尝试: {e}")
+        _unavailable_until = time.time() + 30
+        return None, 0
+    if not raw:
+        return None, 0
+    state = json.loads(raw)
+    covered = state.get('covered', 0)
+    if covered > len(messages) or state.get('anchor') != _anchor(messages, covered):
+        return None, 0
+    return state.get('summary'), covered
+
+
+def clear_summary(conversation_id):
+    try:
+        _redis().delete(_key(conversation_id))
+    except Exception as e:
+        print(f"清除对话摘要失败: {e}")
+
+
+def needs_summary(conversation_id, messages):
+    """未被摘要覆盖的历史是否超过触发阈值"""
+    _, covered = get_summary(conversation_id, messages)
+    pending = sum(message_tokens(msg) for msg in messages[covered:])
+    return pending > summary_trigger_tokens
+
+
+def try_lock(conversation_id):
+    """抢占该对话的摘要任务, 已有任务在执行时返回False"""
+    try:
+        return bool(_redis().set(_key(conversation_id) + ':building', 1, nx=True, ex=summary_lock_ttl))
+    except Exception as e:
+        print(f"摘要任务加锁失败: {e}")
+        return False
+
+
+def unlock(conversation_id):
+    try:
+        _redis().delete(_key(conversation_id) + ':building')
+    except Exception as e:
+        print(f"摘要任务解锁失败: {e}")
+
+
+def summarize(conversation_id, messages):
+    """
+    把 messages 中较早的轮次合并进摘要(在后台任务中执行)
+
+    保留最近约 summary_keep_tokens 个token的原始轮次, 其余未覆盖的轮次连同旧摘要一起交给模型压缩
+
+    返回:
+    - 新的覆盖消息数, 无需更新或生成失败时返回None
+    """
+    previous, covered = get_summary(conversation_id, messages)
+    # 从末尾向前保留最近的轮次, 截止点落在user消息上, 保证摘要覆盖的是完整的轮次
+    end = len(messages)
+    kept = 0
+    while end > covered and kept + message_tokens(messages[end - 1]) <= summary_keep_tokens:
+        end -= 1
+        kept += message_tokens(messages[end])
+    while end < len(messages) and messages[end].get('role') != 'user':
+        end += 1
+    if end <= covered:
+        return None
+
+    dialogue = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages[covered:end])
+    user_prompt = f"已有摘要:\n{previous or '无'}\n\n新增对话:\n{dialogue}"
+    start = time.time()
+    summary = call_api(
+        system_prompt=summary_prompt,
+        user_prompt=user_prompt,
+        temperature=0.1,
+        max_tokens=summary_max_tokens,
+        model_name=summary_model_name,
+        priority=PRIORITY_LOW
+    )
+    if not summary:
+        return None
+    state = {
+        'summary': summary.strip(),
+        'covered': end,
+        'anchor': _anchor(messages, end),
+        'tokens': count_tokens(summary),
+        'updated': time.time()
+    }
+    try:
+        _redis().set(_key(conversation_id), json.dumps(state, ensure_ascii=False))
+    except Exception as e:
+        print(f"保存对话摘要失败: {e}")
+        return None
+    print(f"对话摘要已更新: 覆盖 {end} 条消息, 耗时 {time.time() - start:.3f}s")
+    return end
@@ -1,6 +1,7 @@
 import sys
 sys.path.append('/mnt/projects/llm-server')
-from src.utils.kllm import call_api
+from src.utils.kllm import call_api, call_api_batch
+from src.utils.limiter import PRIORITY_LOW
 
 activity_prompt = """
 ## 角色
@@ -68,12 +69,29 @@ profile_prompt = """
 
 def extract_activity(text: str) -> str:
     """提取活动信息"""
-    return call_api(system_prompt=activity_prompt, user_prompt=text, temperature=0.1, max_tokens=32768, model_name="Qwen2.5-72B-Instruct-GGUF")
+    return call_api(system_prompt=activity_prompt, user_prompt=text, temperature=0.1, max_tokens=32768, model_name="Qwen2.5-72B-Instruct-GGUF", use_cache=True, priority=PRIORITY_LOW)
 
 def extract_event(text: str) -> str:
     """提取重大事件信息"""
-    return call_api(system_prompt=event_prompt, user_prompt=text, temperature=0.1, max_tokens=32768, model_name="Qwen2.5-72B-Instruct-GGUF")
+    return call_api(system_prompt=event_prompt, user_prompt=text, temperature=0.1, max_tokens=32768, model_name="Qwen2.5-72B-Instruct-GGUF", use_cache=True, priority=PRIORITY_LOW)
 
 def extract_profile(text: str) -> str:
     """提取基本个人信息"""
-    return call_api(system_prompt=profile_prompt, user_prompt=text, temperature=0.1, max_tokens=32768, model_name="Qwen2.5-72B-Instruct-GGUF")
+    return call_api(system_prompt=profile_prompt, user_prompt=text, temperature=0.1, max_tokens=32768, model_name="Qwen2.5-72B-Instruct-GGUF", use_cache=True, priority=PRIORITY_LOW)
+
+def extract_all(text: str):
+    """
+    并发提取活动、重大事件和基本个人信息
+
+    返回:
+    - (activity, event, profile), 提取失败的项为None
+    """
+    items = [
+        {'system_prompt': prompt, 'user_prompt': text, 'temperature': 0.1, 'max_tokens': 32768,
+         'model_name': "Qwen2.5-72B-Instruct-GGUF", 'use_cache': True}
+        for prompt in (activity_prompt, event_prompt, profile_prompt)
+    ]
+    batch = call_api_batch(items, concurrency=len(items), priority=PRIORITY_LOW)
+    activity_content, event_content, profile_content = batch.wait()
+    print(f"记忆提取完成, 耗时: {batch.wall_time:.3f}s, 失败: {batch.failed}")
+    return activity_content, event_content, profile_content
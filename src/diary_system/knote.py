@@ -3,9 +3,18 @@ import datetime
 import os
 from typing import List, Dict, Any
 
+import sys
+sys.path.append('/mnt/projects/llm-server')
+from src.diary_system.retrieval import build_index, save_index
+
+def index_path_for(data_file: str) -> str:
+    """日记数据文件对应的检索索引路径"""
+    return f"{os.path.splitext(data_file)[0]}.index.json"
+
 class DiarySystem:
     def __init__(self, data_file="diary_data.json"):
         self.data_file = data_file
+        self.index_file = index_path_for(data_file)
         self.entries = self.load_data()
     
     def load_data(self) -> List[Dict[str, Any]]:
@@ -16,9 +25,17 @@ class DiarySystem:
         return []
     
     def save_data(self):
-        """保存日记数据"""
+        """保存日记数据, 并重建供聊天检索的索引"""
         with open(self.data_file, 'w', encoding='utf-8') as f:
             json.dump(self.entries, f, ensure_ascii=False, indent=2)
+        self.rebuild_index()
+    
+    def rebuild_index(self):
+        """预先计算检索索引(见 retrieval.py), 聊天时只需加载"""
+        try:
+            save_index(build_index(self.entries), self.index_file)
+        except Exception as e:
+            print(f"重建记忆索引失败: {e}")
     
     def add_entry(self, entry_type: str, content: str):
         """添加日记条目
@@ -0,0 +1,164 @@
+"""
+日记记忆检索
+
+日记条目(活动/事件/基础信息)由整理任务提取, 每行是一条独立的事实。这里把事实逐行建成BM25倒排索引:
+- 中日韩字符按相邻两字切词, 其他字符按字母数字串切词, 不依赖分词库和向量模型
+- build_index() 在日记保存时预先计算词频、文档长度和IDF, 写入 index.json
+- MemoryIndex.search() 只累加查询词的倒排表, 几千条事实在CPU上检索耗时在毫秒级
+"""
+import json
+import math
+import os
+import re
+import threading
+
+# BM25参数
+bm25_k1 = 1.2
+bm25_b = 0.75
+# 几乎每条事实都有的词(如"用户")区分度接近0, 检索时跳过, 省去遍历最长的倒排表
+min_idf = 0.1
+# 各类事实的得分权重, 基础信息对陪伴回复更重要
+type_weights = {'profile': 1.2, 'event': 1.1, 'activity': 1.0}
+
+_CJK_RUN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+_WORD = re.compile(r'[a-z0-9]+')
+# 行首的列表符号与编号
+_BULLET = re.compile(r'^\s*(?:[-*•·]|\d+[.、)）])\s*')
+
+
+def terms(text):
+    """切词: 中日韩字符取相邻两字(单字片段取单字), 其他取小写字母数字串"""
+    text = (text or '').lower()
+    result = []
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            result.append(run)
+        else:
+            result.extend(run[i:i + 2] for i in range(len(run) - 1))
+    result.extend(_WORD.findall(text))
+    return result
+
+
+def split_facts(entries):
+    """把日记条目拆成逐行的事实, 相同内容只保留最新的一条"""
+    facts = {}
+    for entry in entries:
+        for line in (entry.get('content') or '').splitlines():
+            text = _BULLET.sub('', line).strip()
+            if len(text) < 2:
+                continue
+            previous = facts.get(text)
+            if previous is None or entry.get('date', '') >= previous['date']:
+                facts[text] = {'text': text, 'type': entry.get('type'), 'date': entry.get('date', ''),
+                               'entry': entry.get('id')}
+    return list(facts.values())
+
+
+def build_index(entries):
+    """
+    预先计算倒排索引
+
+    返回:
+    - 可JSON序列化的索引字典
+    """
+    docs = split_facts(entries)
+    postings = {}
+    lengths = []
+    for doc_id, doc in enumerate(docs):
+        counts = {}
+        for term in terms(doc['text']):
+            counts[term] = counts.get(term, 0) + 1
+        lengths.append(sum(counts.values()))
+        for term, tf in counts.items():
+            postings.setdefault(term, []).append([doc_id, tf])
+    total = len(docs)
+    idf = {
+        term: math.log(1 + (total - len(plist) + 0.5) / (len(plist) + 0.5))
+        for term, plist in postings.items()
+    }
+    avgdl = (sum(lengths) / total if total else 0.0) or 1.0
+    return {
+        'version': 1,
+        'docs': docs,
+        # BM25中只与文档长度有关的部分
+        'norms': [bm25_k1 * (1 - bm25_b + bm25_b * length / avgdl) for length in lengths],
+        'idf': idf,
+        'postings': postings
+    }
+
+
+def save_index(index, path):
+    """先写临时文件再替换, 读取方不会读到写了一半的索引"""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+class MemoryIndex:
+    """
+    加载预计算的索引并检索
+
+    参数:
+    - path: 索引文件路径; 文件更新(修改时间变化)后下次检索时自动重新加载
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._index = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def _current(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    try:
+                        with open(self.path, 'r', encoding='utf-8') as f:
+                            index = json.load(f)
+                    except (OSError, ValueError) as e:
+                        print(f"加载记忆索引失败: {e}")
+                        return self._index
+                    self._index = index
+                    self._mtime = mtime
+        return self._index
+
+    def __len__(self):
+        index = self._current()
+        return len(index['docs']) if index else 0
+
+    def search(self, query, k=5, min_score=1.0):
+        """
+        检索与 query 最相关的 k 条事实
+
+        返回:
+        - [{'text', 'type', 'date', 'entry', 'score'}], 按得分从高到低
+        """
+        index = self._current()
+        if not index or not index['docs'] or k <= 0:
+            return []
+        postings = index['postings']
+        idf = index['idf']
+        norms = index['norms']
+        scores = {}
+        for term in set(terms(query)):
+            plist = postings.get(term)
+            if not plist or idf[term] < min_idf:
+                continue
+            weight = idf[term] * (bm25_k1 + 1)
+            for doc_id, tf in plist:
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight * tf / (tf + norms[doc_id])
+        docs = index['docs']
+        ranked = sorted(
+            ((score * type_weights.get(docs[doc_id]['type'], 1.0), docs[doc_id]['date'], doc_id)
+             for doc_id, score in scores.items()),
+            reverse=True
+        )
+        return [
+            dict(docs[doc_id], score=round(score, 3))
+            for score, _, doc_id in ranked[:k] if score >= min_score
+        ]
@@ -7,19 +7,28 @@ import sys
 from datetime import datetime
 from celery import current_app
 from celery.result import AsyncResult
+from celery.signals import task_postrun, worker_process_init, worker_process_shutdown, worker_shutdown
 
 # 添加项目路径
 sys.path.append('/mnt/projects/llm-server')
 
-from src.agents.kagentv1 import KAgent
-from src.diary_system.extract import extract_activity, extract_event, extract_profile
+from src.agents.kagentv1 import KAgent, history_renderer
+from src.agents import summary
+from src.diary_system.extract import extract_all
 from src.diary_system.knote import DiarySystem
 from src.utils.file_oprator import safe_file_operation
+from src.utils.resilience import deadline
+from src.utils.kllm import request_hooks, start_metrics_publisher, stop_metrics_publisher
+from src.utils import cancel, stream_store
 
 # 全局变量
 current_day_note_path = '/mnt/projects/llm-server/src/diary_system/current_day_history.json'
+# 当前只有一个对话(当天的对话历史文件)
+conversation_id = 'default'
 agent = KAgent()
 diary = DiarySystem()
+# 单个任务内LLM调用的截止时间(秒), 小于 task_soft_time_limit(50s), 留出保存结果的余量
+llm_deadline_seconds = int(os.environ.get('LLM_DEADLINE_SECONDS', '45'))
 
 @current_app.task(name='src.tasks.process_chat_task')
 def process_chat_task(message, conversation_history):
@@ -30,15 +39,35 @@ def process_chat_task(message, conversation_history):
         print(f"[{datetime.now()}] 处理聊天任务: {message[:50]}...")
         
         # 调用KAgent进行聊天处理
-        answer = agent.chat(message, conversation_history)
-        # 保存到文件
+        llm_calls = []
+        with deadline(llm_deadline_seconds), request_hooks(lambda record: llm_calls.append(record.to_dict())):
+            answer = agent.chat(message, conversation_history, conversation_id)
+        if not answer:
+            # 回复生成失败时不写入对话历史, 只报告错误
+            return {
+                'status': 'error',
+                'error': '没有生成回复',
+                'timestamp': datetime.now().isoformat(),
+                'llm_metrics': llm_calls
+            }
+        # 追加本轮对话后保存到文件, 下一轮请求的前缀与本轮一致
+        conversation_history.append({
+            'role': 'user',
+            'content': message
+        })
+        conversation_history.append({
+            'role': 'assistant',
+            'content': answer
+        })
         safe_file_operation('write', current_day_note_path, conversation_history)
+        schedule_summary(conversation_history)
         
         return {
             'status': 'success',
             'answer': answer,
             'timestamp': datetime.now().isoformat(),
-            'stream_processed': False
+            'stream_processed': False,
+            'llm_metrics': llm_calls
         }
     except Exception as e:
         return {
@@ -51,43 +80,54 @@ def process_chat_task(message, conversation_history):
 def process_chat_stream_task(message, conversation_history):
     """
     处理聊天任务的异步任务(流式)
+
+    增量合并后追加到任务的Redis Stream(见 stream_store), 结果后端只保存开始状态和精简的最终结果
     """
+    task_id = process_chat_stream_task.request.id
+    answer_chunks = []
+    # 首段立即写入, 之后按时间间隔/字节数合并写入
+    writer = stream_store.StreamWriter(task_id)
     try:
         print(f"[{datetime.now()}] 处理流式聊天任务: {message[:50]}...")
-        task_id = process_chat_stream_task.request.id
-        # 使用Celery结果后端存储流式输出
+        # 结果后端只标记任务进入流式状态, 增量由 stream_store 传输
         current_app.backend.store_result(
             task_id,
             {
-                'current_text': '',
-                'chunks': [],
                 'last_update': datetime.now().isoformat(),
                 'status': 'streaming'
             },
             'STREAMING'
         )
 
-        # 调用KAgent进行流式聊天处理
-        stream_response = agent.chat_stream(message, conversation_history)
-        # 收集所有流式响应片段并实时更新
-        answer_chunks = []
-        for chunk in stream_response:
-            if chunk:
-                answer_chunks.append(chunk)
-                # 实时更新流式输出到结果后端
-                current_app.backend.store_result(
-                    task_id,
-                    {
-                        'current_text': ''.join(answer_chunks),
-                        'chunks': answer_chunks.copy(),
-                        'last_update': datetime.now().isoformat(),
-                        'status': 'streaming'
-                    },
-                    'STREAMING'
-                )
+        # 调用KAgent进行流式聊天处理, 截止时间覆盖整个流式读取过程;
+        # 客户端停止轮询或主动取消时, watch 取消范围, 上游连接随即关闭, chat_stream 提前结束
+        llm_calls = []
+        with deadline(llm_deadline_seconds), request_hooks(lambda record: llm_calls.append(record.to_dict())), \
+                cancel.watch(task_id) as scope:
+            stream_response = agent.chat_stream(message, conversation_history, conversation_id)
+            # 收集所有流式响应片段并实时更新
+            for chunk in stream_response:
+                if scope.cancelled:
+                    break
+                if chunk:
+                    answer_chunks.append(chunk)
+                    writer.write(chunk)
+            stream_response.close()
+        writer.close('cancelled' if scope.cancelled else 'completed')
         
         # 合并所有片段
         full_answer = ''.join(answer_chunks)
+        if scope.cancelled:
+            # 客户端已离开, 本轮不写入对话历史
+            print(f"[{datetime.now()}] 流式任务已取消({scope.reason}), 已输出 {len(full_answer)} 字")
+            return {
+                'status': 'cancelled',
+                'reason': scope.reason,
+                'answer': full_answer,
+                'timestamp': datetime.now().isoformat(),
+                'stream_processed': True,
+                'llm_metrics': llm_calls
+            }
         
         # 保存到文件
         conversation_history.append({
@@ -100,14 +140,17 @@ def process_chat_stream_task(message, conversation_history):
         })
         print(f"[{datetime.now()}] 保存对话历史, 长度：{len(conversation_history)}...")
         safe_file_operation('write', current_day_note_path, conversation_history)
+        schedule_summary(conversation_history)
 
         return {
             'status': 'success',
             'answer': full_answer,
             'timestamp': datetime.now().isoformat(),
-            'stream_processed': True
+            'stream_processed': True,
+            'llm_metrics': llm_calls
         }
     except Exception as e:
+        writer.close('error')
         return {
             'status': 'error',
             'error': str(e),
@@ -127,24 +170,26 @@ def organize_knotes_task():
             return {'status': 'error', 'error': '对话历史文件不存在'}
         
         # 读取对话历史
-        safe_file_operation('read', current_day_note_path, None)
+        conversation_history = safe_file_operation('read', current_day_note_path, None)
         
         if len(conversation_history) == 0:
             return {'status': 'success', 'message': '没有需要整理的对话历史'}
         
         # 提取信息
         user_prompt = "对话：\n" + "\n".join([f"{item['role']}: {item['content']}" for item in conversation_history])
-        activity_content = extract_activity(user_prompt)
-        event_content = extract_event(user_prompt)
-        profile_content = extract_profile(user_prompt)
+        # 三类信息互不依赖, 并发提取
+        activity_content, event_content, profile_content = extract_all(user_prompt)
         
         # 添加到日记系统
         diary.add_entry('activity', activity_content)
         diary.add_entry('event', event_content)
         diary.add_entry('profile', profile_content)
         
-        # 清空当天的对话历史
+        # 清空当天的对话历史及其摘要、渲染缓存
         safe_file_operation('write', current_day_note_path, [])
+        summary.clear_summary(conversation_id)
+        if history_renderer is not None:
+            history_renderer.invalidate(conversation_id)
         
         return {
             'status': 'success',
@@ -159,21 +204,82 @@ def organize_knotes_task():
         }
 
 
-def get_stream_task_output(task_id: str):
+def schedule_summary(conversation_history):
+    """历史超过阈值时提交后台摘要任务(不等待结果), 同一对话同时只有一个摘要任务"""
+    try:
+        messages = summary.dialogue_messages(conversation_history)
+        if summary.needs_summary(conversation_id, messages) and summary.try_lock(conversation_id):
+            summarize_conversation_task.delay(conversation_id)
+    except Exception as e:
+        print(f"提交摘要任务失败: {e}")
+
+@current_app.task(name='src.tasks.summarize_conversation_task')
+def summarize_conversation_task(target_conversation_id):
+    """
+    把对话较早的轮次压缩进滚动摘要的异步任务
+    """
+    try:
+        print(f"[{datetime.now()}] 开始更新对话摘要: {target_conversation_id}")
+        conversation_history = safe_file_operation('read', current_day_note_path, None)
+        messages = summary.dialogue_messages(conversation_history)
+        with deadline(llm_deadline_seconds):
+            covered = summary.summarize(target_conversation_id, messages)
+        return {
+            'status': 'success',
+            'covered': covered,
+            'timestamp': datetime.now().isoformat()
+        }
+    except Exception as e:
+        return {
+            'status': 'error',
+            'error': str(e),
+            'timestamp': datetime.now().isoformat()
+        }
+    finally:
+        summary.unlock(target_conversation_id)
+
+@worker_process_init.connect
+def start_llm_metrics(**kwargs):
+    """worker子进程启动后定期把本进程的LLM调用统计写入Redis, 由API进程的 /metrics 汇总"""
+    start_metrics_publisher()
+
+@task_postrun.connect
+def ensure_llm_metrics(**kwargs):
+    """没有子进程的执行池(solo/threads)不触发 worker_process_init, 在第一个任务结束后启动"""
+    start_metrics_publisher()
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_llm_metrics(**kwargs):
+    """进程退出前写入最终统计(只对启动过发布线程的进程生效, 重复触发无影响)"""
+    stop_metrics_publisher()
+
+
+def get_stream_task_output(task_id: str, offset: int = 0):
     """
     获取流式任务的实时输出
+
+    参数:
+    - offset: 已读取的段数, 流式中只返回之后的增量(0表示从头读取完整文本)
     """
     try:
-        # 从Celery结果后端获取流式输出
+        # 从Celery结果后端获取任务状态
         result = AsyncResult(task_id, app=current_app)
         
         # 检查任务状态
         if result.state == 'STREAMING':
-            # 获取流式输出数据
-            stream_data = result.result
-            if stream_data and isinstance(stream_data, dict):
-                print(f"从Celery结果后端获取流式输出成功: {stream_data.get('current_text', '')}")
-                return stream_data
+            # 从任务的增量Stream读取流式输出
+            stream_data = stream_store.read(task_id, offset)
+            if stream_data is not None:
+                meta = result.result if isinstance(result.result, dict) else {}
+                print(f"获取流式输出成功: 偏移 {offset} -> {stream_data['offset']}")
+                return {
+                    'current_text': ''.join(stream_data['chunks']),
+                    'chunks': stream_data['chunks'],
+                    'offset': stream_data['offset'],
+                    'last_update': meta.get('last_update'),
+                    'status': stream_data['status'] or 'streaming'
+                }
         elif result.state == 'SUCCESS':
             # 任务已完成，返回最终结果
             final_result = result.result
@@ -183,7 +289,7 @@ def get_stream_task_output(task_id: str):
                     'current_text': final_result.get('answer', ''),
                     'chunks': [final_result.get('answer', '')],
                     'last_update': final_result.get('timestamp', datetime.now().isoformat()),
-                    'status': 'completed'
+                    'status': 'cancelled' if final_result.get('status') == 'cancelled' else 'completed'
                 }
         
         print(f"任务状态: {result.state}")
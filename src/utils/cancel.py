@@ -0,0 +1,146 @@
+"""
+流式任务的取消
+
+/ask/stream 的客户端停止轮询或主动取消后, 继续读完整个vLLM流并逐段写入Redis只会浪费GPU和带宽。
+- API进程: 提交任务和每次轮询 /task/{task_id} 时调用 touch() 续期心跳; 客户端主动取消时调用 request_cancel()
+- worker: 用 watch() 包住流式读取, 后台线程定期检查取消标记和心跳,
+  发现取消标记或心跳过期(超过 stream_poll_timeout 秒没有轮询)时取消 cancel_scope,
+  kllm 随即从该线程关闭上游HTTP连接, vLLM中止该序列的生成
+- Redis不可用时不做任何取消(宁可多生成, 也不误杀正常任务)
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import sys
+sys.path.append('/mnt/projects/llm-server')
+from src.utils.resilience import cancel_scope
+
+# 状态共用的Redis地址: KAGENT_REDIS_URL, 未设置时取 KLLM_REDIS_URL(与kllm一致)
+redis_url = os.environ.get('KAGENT_REDIS_URL') or os.environ.get('KLLM_REDIS_URL', 'redis://localhost:6379/0')
+# 超过该秒数没有轮询即视为客户端已离开, 0表示只响应主动取消
+stream_poll_timeout = float(os.environ.get('STREAM_POLL_TIMEOUT_SECONDS', '10'))
+# worker检查取消标记和心跳的间隔(秒)
+check_interval = 0.5
+# 取消标记和"有客户端在跟踪"标记的过期时间(秒), 大于任务的硬超时
+mark_ttl = 300
+
+_client = None
+_client_pid = None
+# Redis不可用时暂停读写的截止时刻, 避免每段输出都等待连接失败
+_unavailable_until = 0.0
+
+
+def _redis():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        import redis
+        _client = redis.Redis.from_url(redis_url, decode_responses=True, socket_timeout=0.5,
+                                       socket_connect_timeout=0.5)
+        _client_pid = pid
+    return _client
+
+
+def _keys(task_id):
+    prefix = f"kchat:stream:{task_id}"
+    return f"{prefix}:seen", f"{prefix}:watched", f"{prefix}:cancel"
+
+
+def _unavailable(e, action):
+    global _unavailable_until
+    print(f"{action}失败, 30秒内不再尝试: {e}")
+    _unavailable_until = time.time() + 30
+
+
+def heartbeat(pipe, task_id):
+    """把续期心跳的命令加入管道(同步或asyncio客户端的管道均可), 由调用方执行"""
+    seen_key, watched_key, _ = _keys(task_id)
+    pipe.set(seen_key, '1', px=int(stream_poll_timeout * 1000))
+    pipe.set(watched_key, '1', ex=mark_ttl)
+    return pipe
+
+
+def touch(task_id):
+    """续期客户端心跳, 返回是否成功"""
+    if stream_poll_timeout <= 0 or time.time() < _unavailable_until:
+        return False
+    try:
+        heartbeat(_redis().pipeline(), task_id).execute()
+        return True
+    except Exception as e:
+        _unavailable(e, "写入流式任务心跳")
+        return False
+
+
+def request_cancel(task_id, reason='cancelled'):
+    """标记任务需要取消, worker在 check_interval 内响应; 返回是否成功"""
+    _, _, cancel_key = _keys(task_id)
+    try:
+        _redis().set(cancel_key, reason, ex=mark_ttl)
+        return True
+    except Exception as e:
+        print(f"标记任务取消失败: {e}")
+        return False
+
+
+def check(task_id):
+    """
+    检查任务是否应当取消
+
+    返回:
+    - 取消原因: 主动取消时为 request_cancel 的 reason, 心跳过期时为 'abandoned'; 无需取消或Redis不可用时返回None
+    """
+    if time.time() < _unavailable_until:
+        return None
+    seen_key, watched_key, cancel_key = _keys(task_id)
+    try:
+        pipe = _redis().pipeline()
+        pipe.get(cancel_key)
+        pipe.exists(seen_key)
+        pipe.exists(watched_key)
+        reason, seen, watched = pipe.execute()
+    except Exception as e:
+        _unavailable(e, "检查任务取消")
+        return None
+    if reason:
+        return reason
+    # 只有提交时登记过心跳的任务才按心跳判断, API写心跳失败时不会误判
+    if stream_poll_timeout > 0 and watched and not seen:
+        return 'abandoned'
+    return None
+
+
+def _watch_loop(task_id, scope, stop, interval):
+    while True:
+        reason = check(task_id)
+        if reason is not None:
+            print(f"流式任务 {task_id} 被取消: {reason}")
+            scope.cancel(reason)
+            return
+        if stop.wait(interval):
+            return
+
+
+@contextmanager
+def watch(task_id, interval=None):
+    """
+    在取消范围内执行流式任务, 后台线程发现取消或客户端离开时取消该范围
+
+    用法:
+        with watch(task_id) as scope:
+            for chunk in agent.chat_stream(...):
+                ...
+        if scope.cancelled:
+            ...  # scope.reason 为取消原因
+    """
+    with cancel_scope() as scope:
+        stop = threading.Event()
+        thread = threading.Thread(target=_watch_loop, args=(task_id, scope, stop, interval or check_interval),
+                                  daemon=True)
+        thread.start()
+        try:
+            yield scope
+        finally:
+            stop.set()
@@ -0,0 +1,184 @@
+"""
+WebSocket多会话聊天
+
+App客户端一个对话往往持续数分钟、发送多轮, 每轮一个POST再加一串轮询会反复建连并带上完整的HTTP头。
+ChatSocket 在一条WebSocket连接上接收各轮输入并推送回复:
+- 一条连接可以同时有多个逻辑会话(session), 每个会话同一时刻最多一轮在生成, 各会话的回复交错推送
+- 回复的增量由 stream_hub 读取, 与SSE共用同一个Redis连接
+- 背压: 发往客户端的消息经过有上限的发送队列, 客户端读得慢时队列写满, 各会话暂停从Stream读取;
+  积压的增量留在Redis中, 恢复后补读并合并成较少的消息发送, API进程的内存不随积压增长。
+  接收循环从不等待发送队列: pong和error在队列满时直接丢弃(计数 ws_dropped), accepted由该轮的推送发送,
+  因此对端不读消息时接收循环仍然按 peer_timeout 检测失联
+- 心跳: 每 ping_interval 秒发送 ping, 超过 peer_timeout 秒没有收到客户端的任何消息即视为对端已失联并关闭连接;
+  连接关闭只停止推送, 任务继续, 客户端在心跳过期(STREAM_POLL_TIMEOUT_SECONDS)前重连后可以用 resume 继续
+
+客户端消息(JSON):
+- {"type": "ask", "session": "s1", "message": "..."}: 提交一轮, 回复 accepted(带 task_id)
+- {"type": "resume", "session": "s1", "task_id": "...", "after": 12}: 从偏移量之后继续接收某轮的回复
+- {"type": "cancel", "session": "s1"}: 取消该会话正在生成的一轮
+- {"type": "ping"} / {"type": "pong"}
+服务端消息: accepted / delta(text, offset) / done(status) / error(message) / ping / pong, 除ping/pong外都带 session
+"""
+import asyncio
+import json
+import os
+
+from fastapi import WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+
+import sys
+sys.path.append('/mnt/projects/llm-server')
+from src.utils import cancel, metrics, stream_hub
+
+# 发送ping的间隔(秒), 以及多久没有收到客户端消息视为对端失联(秒)
+ping_interval = float(os.environ.get('WS_PING_SECONDS', '10'))
+peer_timeout = float(os.environ.get('WS_PEER_TIMEOUT_SECONDS', '25'))
+# 发送队列的消息数上限, 写满后暂停读取增量
+send_queue_size = int(os.environ.get('WS_SEND_QUEUE_SIZE', '32'))
+# 每条连接同时生成的会话数上限
+max_sessions = int(os.environ.get('WS_MAX_SESSIONS', '8'))
+
+
+class ChatSocket:
+    """
+    参数:
+    - websocket: FastAPI的WebSocket
+    - submit: submit(message) -> task_id, 提交一轮流式任务; 在线程池中调用
+    - finished: 可选的 finished(task_id) -> (状态, 最终回答) 或 None, 见 stream_hub.follow
+    """
+
+    def __init__(self, websocket, submit, finished=None):
+        self.websocket = websocket
+        self.submit = submit
+        self.finished = finished
+        self._outbox = asyncio.Queue(send_queue_size)
+        # session -> (task_id, 推送该轮回复的asyncio任务)
+        self._turns = {}
+
+    async def serve(self):
+        """接受连接并处理消息, 直到客户端断开或心跳超时"""
+        await self.websocket.accept()
+        loop = asyncio.get_running_loop()
+        sender = loop.create_task(self._send_loop())
+        pinger = loop.create_task(self._ping_loop())
+        reason = 'client'
+        try:
+            while True:
+                try:
+                    text = await asyncio.wait_for(self.websocket.receive_text(), peer_timeout)
+                except asyncio.TimeoutError:
+                    reason = 'timeout'
+                    print(f"WebSocket {peer_timeout}秒没有收到消息, 关闭连接")
+                    break
+                await self._handle(text)
+        except WebSocketDisconnect:
+            pass
+        finally:
+            for _, turn in self._turns.values():
+                turn.cancel()
+            sender.cancel()
+            pinger.cancel()
+            metrics.increment('ws_disconnects', reason)
+        if reason == 'timeout':
+            try:
+                await self.websocket.close(code=1001)
+            except Exception:
+                pass
+
+    async def _send(self, message):
+        # 发送队列满时等待, 调用方(各会话的推送)随之暂停; 接收循环中不能调用
+        await self._outbox.put(message)
+
+    def _reply(self, message):
+        # 接收循环的控制回复(pong/error): 发送队列满时丢弃, 不阻塞接收
+        try:
+            self._outbox.put_nowait(message)
+        except asyncio.QueueFull:
+            metrics.increment('ws_dropped', message['type'])
+
+    async def _send_loop(self):
+        while True:
+            message = await self._outbox.get()
+            try:
+                await self.websocket.send_text(json.dumps(message, ensure_ascii=False))
+            except Exception:
+                # 连接已断开, 由接收循环结束
+                return
+
+    async def _ping_loop(self):
+        while True:
+            await asyncio.sleep(ping_interval)
+            try:
+                self._outbox.put_nowait({'type': 'ping'})
+            except asyncio.QueueFull:
+                # 发送队列有积压, 无需额外的ping
+                pass
+
+    def _active(self, session):
+        turn = self._turns.get(session)
+        return turn is not None and not turn[1].done()
+
+    async def _handle(self, text):
+        try:
+            message = json.loads(text)
+            kind = message.get('type')
+        except (ValueError, AttributeError):
+            self._reply({'type': 'error', 'message': '消息格式错误, 需要JSON对象'})
+            return
+        session = str(message.get('session', 'default'))
+        if kind == 'pong':
+            return
+        if kind == 'ping':
+            self._reply({'type': 'pong'})
+        elif kind == 'ask':
+            await self._ask(session, message.get('message'))
+        elif kind == 'resume':
+            if self._active(session):
+                self._reply({'type': 'error', 'session': session, 'message': '该会话正在生成回复'})
+                return
+            try:
+                after = max(int(message.get('after', 0)), 0)
+            except (TypeError, ValueError):
+                after = 0
+            self._start(session, str(message.get('task_id')), after)
+        elif kind == 'cancel':
+            turn = self._turns.get(session)
+            if turn is not None and not turn[1].done():
+                # 推送继续, worker结束后发送 done(cancelled)
+                await run_in_threadpool(cancel.request_cancel, turn[0], 'client')
+        else:
+            self._reply({'type': 'error', 'session': session, 'message': f"未知的消息类型: {kind}"})
+
+    async def _ask(self, session, text):
+        if not text:
+            self._reply({'type': 'error', 'session': session, 'message': '消息不能为空'})
+            return
+        if self._active(session):
+            self._reply({'type': 'error', 'session': session, 'message': '该会话正在生成回复'})
+            return
+        if sum(1 for name in self._turns if self._active(name)) >= max_sessions:
+            self._reply({'type': 'error', 'session': session, 'message': f"同时生成的会话超过{max_sessions}个"})
+            return
+        task_id = await run_in_threadpool(self.submit, text)
+        self._start(session, task_id, 0, accepted=True)
+
+    def _start(self, session, task_id, offset, accepted=False):
+        turn = asyncio.get_running_loop().create_task(self._pump(session, task_id, offset, accepted))
+        self._turns[session] = (task_id, turn)
+
+    async def _pump(self, session, task_id, offset, accepted=False):
+        try:
+            if accepted:
+                # 在推送中发送, 发送队列满时等待的是该会话而不是接收循环
+                await self._send({'type': 'accepted', 'session': session, 'task_id': task_id})
+            async for event, data, event_id in stream_hub.follow(task_id, offset, self.finished):
+                if event == 'ping':
+                    continue
+                message = {'type': event, 'session': session, 'task_id': task_id, **data}
+                if event_id is not None:
+                    message['offset'] = event_id
+                await self._send(message)
+        finally:
+            turn = self._turns.get(session)
+            if turn is not None and turn[1] is asyncio.current_task():
+                del self._turns[session]
@@ -1,59 +1,886 @@
-import requests
+import os
 import json
+import queue
+import socket
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import time
+import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from src.utils.sse import SSEDeltaParser
+from src.utils.llm_cache import ResponseCache, make_cache_key
+from src.utils.singleflight import SingleFlight, RedisSingleFlight
+from src.utils.router import BackendRouter
+from src.utils.limiter import (AdaptiveLimiter, RedisAdaptiveLimiter, AdmissionTimeout,
+                               PRIORITY_HIGH, PRIORITY_NORMAL)
+from src.utils.resilience import (DeadlineExceeded, RetryBudget, HedgePolicy,
+                                  current_deadline, current_cancel, remaining)
+from src.utils.metrics import RequestMetrics, request_hooks
+from src.utils import metrics
+
+# vLLM服务地址
+base_url = os.environ.get('KLLM_BASE_URL', 'http://localhost:8080')
+# 多个vLLM后端(逗号分隔), 按最少在途请求数路由; 未设置时只使用 base_url
+backend_urls = [url.strip() for url in os.environ.get('KLLM_BACKENDS', base_url).split(',') if url.strip()]
+# 每个worker进程的keep-alive连接池大小
+pool_size = int(os.environ.get('KLLM_POOL_SIZE', '4'))
+
+# 单个进程内异步客户端允许的最大并发连接数(即同时打开的vLLM流数量)
+async_max_connections = int(os.environ.get('KLLM_ASYNC_MAX_CONNECTIONS', '512'))
+
+# 响应缓存配置(仅对 use_cache=True 的确定性调用生效)
+cache_by_default = os.environ.get('KLLM_CACHE_DEFAULT', '0') == '1'
+cache_max_entries = int(os.environ.get('KLLM_CACHE_MAX_ENTRIES', '1024'))
+cache_max_bytes = int(os.environ.get('KLLM_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+cache_ttl = int(os.environ.get('KLLM_CACHE_TTL', str(24 * 3600)))
+# 磁盘层路径, 留空则只使用进程内缓存
+cache_disk_path = os.environ.get('KLLM_CACHE_DISK_PATH', '/mnt/projects/llm-server/cache/llm_cache.sqlite3')
+
+# 相同在途请求合并: off(关闭) / local(进程内) / redis(进程内 + 跨worker)
+singleflight_mode = os.environ.get('KLLM_SINGLEFLIGHT', 'local')
+# 跨worker合并与准入控制的Redis地址, 与对话摘要、流式增量和取消共用: KAGENT_REDIS_URL, 未设置时取 KLLM_REDIS_URL
+redis_url = os.environ.get('KAGENT_REDIS_URL') or os.environ.get('KLLM_REDIS_URL', 'redis://localhost:6379/0')
+# worker进程定期把统计写入Redis的间隔(秒), 见 start_metrics_publisher
+metrics_publish_interval = float(os.environ.get('KLLM_METRICS_PUBLISH_SECONDS', '5'))
+
+# 自适应准入控制: off(关闭) / local(进程内) / redis(所有worker共享limit和等待队列)
+admission_mode = os.environ.get('KLLM_ADMISSION', 'local')
+admission_initial_limit = int(os.environ.get('KLLM_ADMISSION_INITIAL_LIMIT', '32'))
+admission_max_limit = int(os.environ.get('KLLM_ADMISSION_MAX_LIMIT', '256'))
+# 排队超时时间(秒)
+admission_timeout = float(os.environ.get('KLLM_ADMISSION_TIMEOUT', '30'))
+
+# 超时与重试: 单次请求的连接/读超时(秒), 外层 deadline() 更早时取截止时间
+connect_timeout = float(os.environ.get('KLLM_CONNECT_TIMEOUT', '5'))
+read_timeout = float(os.environ.get('KLLM_READ_TIMEOUT', '60'))
+# 后端故障(连接失败/超时/5xx)时的最大重试次数与退避基数(秒), 流式请求只在首token之前重试
+max_retries = int(os.environ.get('KLLM_MAX_RETRIES', '2'))
+retry_backoff = float(os.environ.get('KLLM_RETRY_BACKOFF', '0.2'))
+# 重试/对冲请求数占总请求数的比例上限
+retry_budget_ratio = float(os.environ.get('KLLM_RETRY_BUDGET_RATIO', '0.1'))
+# 流式请求对冲: 首token慢于最近TTFT的 hedge_percentile 分位数时向另一个后端再发一次
+hedge_enabled = os.environ.get('KLLM_HEDGE', '0') == '1'
+hedge_percentile = float(os.environ.get('KLLM_HEDGE_PERCENTILE', '0.95'))
+hedge_min_delay = float(os.environ.get('KLLM_HEDGE_MIN_DELAY', '0.2'))
+# call_api_batch 默认的并发请求数
+batch_concurrency = int(os.environ.get('KLLM_BATCH_CONCURRENCY', '8'))
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+_async_client = None
+_async_client_loop = None
+_async_client_pid = None
+
+_router = None
+_limiter = None
+_fallback_limiter = None
+_response_cache = None
+_local_flight = SingleFlight()
+_redis_flight = None
+_retry_budget = RetryBudget(ratio=retry_budget_ratio)
+_hedge_policy = HedgePolicy(percentile=hedge_percentile, min_delay=hedge_min_delay)
+
+# 当前线程正在等待响应头的请求所属的取消持有者(_ResponseHolder), 由 _open_stream 设置
+_waiting = threading.local()
+
+class _CancellableConnection(HTTPConnection):
+    """等待响应头之前把连接登记到当前线程的取消持有者, 取消时可以从其他线程中断阻塞的读取"""
 
-def call_api(system_prompt, user_prompt, temperature, max_tokens, model_name):
+    def getresponse(self, *args, **kwargs):
+        holder = getattr(_waiting, 'holder', None)
+        if holder is not None:
+            holder.append(self)
+        return super().getresponse(*args, **kwargs)
+
+class _CancellableHTTPSConnection(_CancellableConnection, HTTPSConnection):
+    pass
+
+class _CancellablePool(HTTPConnectionPool):
+    ConnectionCls = _CancellableConnection
+
+class _CancellableHTTPSPool(HTTPSConnectionPool):
+    ConnectionCls = _CancellableHTTPSConnection
+
+class _CancellableAdapter(HTTPAdapter):
+    """连接池使用 _CancellableConnection 的适配器"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _CancellablePool, 'https': _CancellableHTTPSPool}
+
+def _close_upstream(target):
     """
-    异步调用 openai形式 API
+    关闭上游请求: response直接关闭; 仍在等待响应头(prefill阶段)的连接shutdown其socket,
+    阻塞在读取上的线程随即出错返回, 连接被连接池丢弃
+    """
+    try:
+        if isinstance(target, HTTPConnection):
+            if target.sock is not None:
+                target.sock.shutdown(socket.SHUT_RDWR)
+        else:
+            target.close()
+    except Exception:
+        pass
+
+def _new_session():
+    """创建带keep-alive连接池的会话"""
+    session = requests.Session()
+    adapter = _CancellableAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=False)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_session():
+    """
+    获取进程级共享的HTTP会话
     
-    参数:
-    - prompt: 输入的提示文本
-    - temperature: 生成温度 (0.1-1.0)
-    - max_tokens: 最大生成token数
+    会话按进程id绑定，fork出的子进程(如Celery prefork worker)首次调用时会重新建连，
+    不会复用父进程的socket
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = _new_session()
+                _session_pid = pid
+    return _session
+
+def close_session():
+    """关闭当前进程的连接池"""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is not None and _session_pid == os.getpid():
+            _session.close()
+        _session = None
+        _session_pid = None
+
+def get_async_client():
+    """
+    获取当前事件循环的共享异步客户端
     
+    httpx.AsyncClient 绑定创建它的事件循环, 循环变化或fork后会重新创建
+    """
+    global _async_client, _async_client_loop, _async_client_pid
+    loop = asyncio.get_running_loop()
+    pid = os.getpid()
+    if _async_client is None or _async_client_loop is not loop or _async_client_pid != pid:
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(None, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=async_max_connections,
+                max_keepalive_connections=async_max_connections
+            )
+        )
+        _async_client_loop = loop
+        _async_client_pid = pid
+    return _async_client
+
+async def close_async_client():
+    """关闭当前进程的异步客户端"""
+    global _async_client, _async_client_loop, _async_client_pid
+    if _async_client is not None and _async_client_pid == os.getpid():
+        await _async_client.aclose()
+    _async_client = None
+    _async_client_loop = None
+    _async_client_pid = None
+
+def get_router():
+    """获取后端路由器(懒加载)"""
+    global _router
+    if _router is None:
+        _router = BackendRouter(backend_urls)
+    return _router
+
+def set_backends(urls):
+    """替换后端列表, 如 set_backends(['http://host1:8080', 'http://host2:8080'])"""
+    global _router, backend_urls
+    if _router is not None:
+        _router.close()
+    backend_urls = list(urls)
+    _router = None
+
+def backend_stats():
+    """返回各后端的在途请求数、健康状态和累计失败数"""
+    return get_router().stats()
+
+def get_limiter():
+    """获取准入控制器(懒加载), admission_mode 为 off 时返回None"""
+    global _limiter
+    if _limiter is None and admission_mode != 'off':
+        if admission_mode == 'redis':
+            _limiter = RedisAdaptiveLimiter(redis_url, initial_limit=admission_initial_limit,
+                                            max_limit=admission_max_limit)
+        else:
+            _limiter = AdaptiveLimiter(initial_limit=admission_initial_limit, max_limit=admission_max_limit)
+    return _limiter
+
+def _get_fallback_limiter():
+    """Redis不可用时退化使用的进程内限制器"""
+    global _fallback_limiter
+    if _fallback_limiter is None:
+        _fallback_limiter = AdaptiveLimiter(initial_limit=admission_initial_limit, max_limit=admission_max_limit)
+    return _fallback_limiter
+
+def _admission_timeout(deadline_at):
+    """排队超时不超过剩余截止时间"""
+    left = remaining(deadline_at)
+    return admission_timeout if left is None else max(0.0, min(admission_timeout, left))
+
+def _admit(priority, deadline_at=None):
+    """
+    申请一个上游请求名额
+
     返回:
-    - 生成的文本响应
+    - (limiter, permit), 未启用准入控制时为 (None, None)
     """
-    
-    url = "http://localhost:8080/v1/chat/completions"
-    
-    headers = {
-        "Content-Type": "application/json"
-    }
-    
+    limiter = get_limiter()
+    if limiter is None:
+        return None, None
+    timeout = _admission_timeout(deadline_at)
+    try:
+        return limiter, limiter.acquire(priority, timeout)
+    except AdmissionTimeout:
+        raise
+    except Exception as e:
+        print(f"准入控制不可用, 退化为进程内限流: {e}")
+        limiter = _get_fallback_limiter()
+        return limiter, limiter.acquire(priority, timeout)
+
+async def _admit_async(priority, deadline_at=None):
+    """asyncio版本的 _admit"""
+    limiter = get_limiter()
+    if limiter is None:
+        return None, None
+    timeout = _admission_timeout(deadline_at)
+    try:
+        return limiter, await limiter.acquire_async(priority, timeout)
+    except AdmissionTimeout:
+        raise
+    except Exception as e:
+        print(f"准入控制不可用, 退化为进程内限流: {e}")
+        limiter = _get_fallback_limiter()
+        return limiter, await limiter.acquire_async(priority, timeout)
+
+def _leave(limiter, permit, ttft=None, error=False):
+    """释放名额并反馈TTFT/错误"""
+    if limiter is None:
+        return
+    try:
+        limiter.release(permit, ttft=ttft, error=error)
+    except Exception as e:
+        print(f"释放准入名额失败: {e}")
+
+def admission_stats():
+    """返回准入控制的当前limit、在途数、排队数和排队耗时分位数"""
+    limiter = get_limiter()
+    return limiter.stats() if limiter is not None else None
+
+def _is_backend_failure(e):
+    """连接失败、超时和5xx视为后端故障, 4xx等请求本身的问题不计入"""
+    if isinstance(e, (requests.ConnectionError, requests.Timeout, httpx.TransportError, DeadlineExceeded)):
+        return True
+    if isinstance(e, (requests.HTTPError, httpx.HTTPStatusError)) and e.response is not None:
+        return e.response.status_code >= 500
+    return False
+
+def get_response_cache():
+    """获取进程内的响应缓存实例(懒加载)"""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache(
+            max_entries=cache_max_entries,
+            max_bytes=cache_max_bytes,
+            ttl=cache_ttl,
+            disk_path=cache_disk_path or None
+        )
+    return _response_cache
+
+def cache_stats():
+    """返回响应缓存的命中/未命中统计"""
+    return get_response_cache().stats()
+
+def _get_redis_flight():
+    global _redis_flight
+    if _redis_flight is None:
+        _redis_flight = RedisSingleFlight(redis_url)
+    return _redis_flight
+
+def _coalesce_call(key, fn):
+    """按 singleflight_mode 合并相同的非流式请求"""
+    if singleflight_mode == 'off':
+        return fn()
+    if singleflight_mode == 'redis':
+        def redis_fn():
+            try:
+                return _get_redis_flight().call('call:' + key, fn)
+            except Exception as e:
+                # Redis不可用时退化为进程内合并
+                print(f"跨worker请求合并失败: {e}")
+                return fn()
+        return _local_flight.call('call:' + key, redis_fn)
+    return _local_flight.call('call:' + key, fn)
+
+def _coalesce_stream(key, factory):
+    """按 singleflight_mode 合并相同的流式请求, 后加入的请求会先回放已生成的token"""
+    if singleflight_mode == 'off':
+        return factory()
+    if singleflight_mode == 'redis':
+        def redis_factory():
+            try:
+                _get_redis_flight()._redis().ping()
+            except Exception as e:
+                print(f"跨worker请求合并失败: {e}")
+                return factory()
+            return _get_redis_flight().stream('stream:' + key, factory)
+        return _local_flight.stream('stream:' + key, redis_factory)
+    return _local_flight.stream('stream:' + key, factory)
+
+def singleflight_stats():
+    """返回进程内请求合并统计: 上游调用数与被合并的请求数"""
+    return _local_flight.stats()
+
+def _reset_after_fork():
+    """fork后在子进程中丢弃继承的连接池和锁"""
+    global _session, _session_pid, _session_lock
+    global _async_client, _async_client_loop, _async_client_pid, _local_flight
+    global _limiter, _fallback_limiter, _router
+    _session = None
+    _session_pid = None
+    _session_lock = threading.Lock()
+    _async_client = None
+    _async_client_loop = None
+    _async_client_pid = None
+    _local_flight = SingleFlight()
+    # 继承的路由器带着父进程的锁、在途计数和健康检查线程的登记(线程本身不在子进程中运行), 懒加载时重建
+    _router = None
+    _limiter = None
+    _fallback_limiter = None
+
+HEADERS = {
+    "Content-Type": "application/json"
+}
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _build_payload(system_prompt, user_prompt, temperature, max_tokens, model_name, stream, history=None,
+                   stop=None):
+    """
+    构建 openai形式 chat/completions 请求体
+
+    消息顺序为 system -> history -> user, 历史对话按原样追加在固定的系统提示词之后,
+    新输入放在最后, 使相邻两轮请求的token前缀保持一致, 便于vLLM复用前缀缓存
+
+    history 可以是消息列表, 也可以是 prompt_render.RenderedHistory(已编码好的历史),
+    后者在 _encode_payload() 中直接拼进请求体, 不再逐条编码
+    """
+    messages = [
+        {
+            'role': 'system',
+            'content': system_prompt
+        }
+    ]
+    rendered = getattr(history, 'body', None)
+    if history and rendered is None:
+        messages.extend({'role': msg['role'], 'content': msg['content']} for msg in history)
+    messages.append({
+        "role": "user",
+        "content": user_prompt
+    })
     payload = {
         "model": model_name,
-        "messages": [
-            {
-                'role': 'system',
-                'content': system_prompt
-            },
-            {
-                "role": "user",
-                "content": user_prompt
-            }
-        ],
+        "messages": messages,
         "temperature": temperature,
         "max_tokens": max_tokens,
-        "stream": False
+        "stream": stream
     }
-    
+    if stop:
+        payload["stop"] = list(stop)
+    if stream:
+        # 让vLLM在最后一帧返回 usage, 用于统计token数
+        payload["stream_options"] = {"include_usage": True}
+    if rendered:
+        payload["_history_body"] = rendered
+    return payload
+
+def _encode_payload(payload):
+    """把请求体编码为JSON字节串, 已渲染的历史原样拼接在system与user消息之间"""
+    body = payload.get("_history_body")
+    if not body:
+        return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    system_message, user_message = payload["messages"]
+    rest = {k: v for k, v in payload.items() if k not in ("messages", "_history_body")}
+    return b''.join([
+        b'{"messages": [',
+        json.dumps(system_message, ensure_ascii=False).encode('utf-8'),
+        b', ',
+        body,
+        json.dumps(user_message, ensure_ascii=False).encode('utf-8'),
+        b'], ',
+        json.dumps(rest, ensure_ascii=False).encode('utf-8')[1:]
+    ])
+
+def _timeout_for(deadline_at):
+    """按剩余截止时间计算 (连接超时, 读超时), 已超时则抛出 DeadlineExceeded"""
+    left = remaining(deadline_at)
+    if left is None:
+        return (connect_timeout, read_timeout)
+    if left <= 0:
+        raise DeadlineExceeded("已超过调用截止时间")
+    return (min(connect_timeout, left), min(read_timeout, left))
+
+def _retry_delay(attempt, deadline_at):
+    """
+    判断第attempt次失败后是否重试
+
+    返回:
+    - 重试前的等待秒数, 不重试时返回None(次数用尽、截止时间不够或重试预算不足)
+    """
+    if attempt >= max_retries:
+        return None
+    delay = retry_backoff * (2 ** attempt)
+    left = remaining(deadline_at)
+    if left is not None and left <= delay:
+        return None
+    if not _retry_budget.try_spend():
+        print("重试预算不足, 放弃重试")
+        return None
+    return delay
+
+def _post_completion(payload, backend, deadline_at, record=None):
+    """向指定后端发起一次非流式请求, 返回生成文本; 出错时抛出异常"""
+    url = f"{backend.url}/v1/chat/completions"
+    response = get_session().post(url, headers=HEADERS, data=_encode_payload(payload),
+                                 timeout=_timeout_for(deadline_at))
+    response.raise_for_status()
+    result = response.json()
+    if record is not None:
+        record.set_usage(result.get('usage'))
     try:
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
-        result = response.json()
         return result['choices'][0]['message']['content']
-    except requests.RequestException as e:
-        print(f"请求错误: {e}")
-        return None
-    except KeyError as e:
-        print(f"解析响应错误: {e}")
+    except KeyError:
         print(f"完整响应: {response.text}")
+        raise
+
+def _open_stream(payload, backend, deadline_at, holder=None, record=None):
+    """
+    向指定后端发起一次流式请求, 逐个yield增量文本; 出错时抛出异常
+
+    参数:
+    - holder: 可选列表, 放入response对象, 便于其他线程提前关闭连接
+    - record: 可选 RequestMetrics, 流结束时写入 usage
+    """
+    url = f"{backend.url}/v1/chat/completions"
+    # 等待响应头期间连接登记在 holder 中, 取消时可以中断prefill阶段的等待
+    _waiting.holder = holder
+    try:
+        response = get_session().post(url, headers=HEADERS, data=_encode_payload(payload), stream=True,
+                                      timeout=_timeout_for(deadline_at))
+    finally:
+        _waiting.holder = None
+        if holder is not None:
+            # 响应头已到达(或请求失败), 连接之后可能归还连接池给其他请求使用, 不再由取消关闭
+            holder[:] = [target for target in holder if not isinstance(target, HTTPConnection)]
+    # 使用with确保流结束或生成器被提前关闭时连接归还连接池
+    with response:
+        if holder is not None:
+            holder.append(response)
+        response.raise_for_status()
+        
+        parser = SSEDeltaParser()
+        for raw in response.iter_content(chunk_size=None):
+            for content in parser.feed(raw):
+                yield content
+            if deadline_at is not None and time.monotonic() > deadline_at:
+                raise DeadlineExceeded("流式输出超过截止时间")
+        if record is not None:
+            record.set_usage(parser.usage)
+
+def _request_completion(payload, priority=PRIORITY_NORMAL, deadline_at=None, record=None):
+    """发起非流式请求(失败时按预算重试), 返回生成文本, 失败返回None"""
+    if record is None:
+        record = RequestMetrics(payload['model'], 'call')
+    record.upstream = True
+    try:
+        limiter, permit = _admit(priority, deadline_at)
+    except AdmissionTimeout as e:
+        print(f"准入排队超时: {e}")
+        record.finish('timeout')
         return None
-    except Exception as e:
-        print(f"其他错误: {e}")
+    record.admitted()
+    _retry_budget.record_request()
+    router = get_router()
+    error = False
+    status = 'error'
+    
+    try:
+        attempt = 0
+        while True:
+            backend = router.acquire()
+            record.backend = backend.url
+            failed = False
+            try:
+                content = _post_completion(payload, backend, deadline_at, record)
+                status = 'ok'
+                return content
+            except DeadlineExceeded as e:
+                print(f"请求错误: {e}")
+                error = True
+                status = 'timeout'
+                return None
+            except requests.RequestException as e:
+                failed = _is_backend_failure(e)
+                delay = _retry_delay(attempt, deadline_at) if failed else None
+                if delay is None:
+                    print(f"请求错误: {e}")
+                    error = failed
+                    if isinstance(e, requests.Timeout):
+                        status = 'timeout'
+                    return None
+                print(f"请求错误, {delay:.2f}s后重试: {e}")
+            except KeyError as e:
+                print(f"解析响应错误: {e}")
+                return None
+            except Exception as e:
+                print(f"其他错误: {e}")
+                return None
+            finally:
+                router.release(backend, failed)
+            attempt += 1
+            time.sleep(delay)
+    finally:
+        _leave(limiter, permit, error=error)
+        record.finish(status)
+
+def _retrying_stream(payload, deadline_at, record, holder=None):
+    """
+    流式请求, 首token之前的后端故障按预算重试; 已经输出后出错则直接抛出
+
+    holder: 可选的 _ResponseHolder, 每次尝试的连接和response都放入其中, 便于取消时从其他线程关闭
+    """
+    router = get_router()
+    attempt = 0
+    while True:
+        backend = router.acquire()
+        record.backend = backend.url
+        failed = False
+        emitted = False
+        try:
+            for content in _open_stream(payload, backend, deadline_at, holder, record):
+                emitted = True
+                yield content
+            return
+        except requests.RequestException as e:
+            if holder is not None and holder.scope is not None and holder.scope.cancelled:
+                # 取消时关闭连接导致的失败, 不算后端故障也不重试
+                raise
+            failed = _is_backend_failure(e)
+            delay = _retry_delay(attempt, deadline_at) if failed and not emitted else None
+            if delay is None:
+                raise
+            print(f"请求错误, {delay:.2f}s后重试: {e}")
+        finally:
+            router.release(backend, failed)
+        attempt += 1
+        time.sleep(delay)
+
+class _StreamAttempt(threading.Thread):
+    """对冲模式下的一次流式请求, 在独立线程中读取上游并把事件放入共享队列"""
+
+    def __init__(self, payload, deadline_at, record, events, exclude=None, limiter=None, permit=None):
+        super().__init__(daemon=True)
+        self.payload = payload
+        self.deadline_at = deadline_at
+        self.record = record
+        self.events = events
+        self.limiter = limiter
+        self.permit = permit
+        self.backend = get_router().acquire(exclude=exclude)
+        self.cancelled = False
+        self._holder = _ResponseHolder(self)
+
+    def run(self):
+        failed = False
+        try:
+            for content in _open_stream(self.payload, self.backend, self.deadline_at, self._holder, self.record):
+                if self.cancelled:
+                    return
+                self.events.put((self, 'chunk', content))
+            self.events.put((self, 'done', None))
+        except Exception as e:
+            if not self.cancelled:
+                failed = _is_backend_failure(e)
+                self.events.put((self, 'error', e))
+        finally:
+            get_router().release(self.backend, failed)
+            _leave(self.limiter, self.permit, error=failed)
+
+    def cancel(self):
+        """关闭上游连接, vLLM随即中止该序列的生成"""
+        self.cancelled = True
+        for target in list(self._holder):
+            _close_upstream(target)
+
+def _hedged_stream(payload, deadline_at, record, holder=None, scope=None):
+    """
+    对冲流式请求
+
+    首token在阈值(最近TTFT的分位数)内未到达时, 向另一个后端再发一次;
+    先产出首token的请求胜出, 另一个立即关闭; scope 被取消时立即结束并关闭所有请求
+    """
+    threshold = _hedge_policy.threshold()
+    if threshold is None:
+        yield from _retrying_stream(payload, deadline_at, record, holder)
+        return
+    
+    events = queue.Queue()
+
+    def interrupt():
+        events.put((None, 'cancelled', None))
+
+    if scope is not None:
+        scope.add_callback(interrupt)
+    started = time.monotonic()
+    primary = _StreamAttempt(payload, deadline_at, record, events)
+    primary.start()
+    live = [primary]
+    attempts = [primary]
+    winner = None
+    hedge = None
+    hedge_tried = False
+    retries = 0
+    
+    try:
+        while True:
+            wait = None
+            if winner is None and not hedge_tried:
+                wait = max(0.0, threshold - (time.monotonic() - started))
+            left = remaining(deadline_at)
+            if left is not None:
+                if left <= 0:
+                    raise DeadlineExceeded("已超过调用截止时间")
+                wait = left if wait is None else min(wait, left)
+            try:
+                attempt, kind, value = events.get(timeout=wait)
+            except queue.Empty:
+                if winner is None and not hedge_tried:
+                    hedge_tried = True
+                    hedge = _start_hedge(payload, deadline_at, record, events, primary.backend)
+                    if hedge is not None:
+                        live.append(hedge)
+                        attempts.append(hedge)
+                continue
+            
+            if kind == 'cancelled':
+                return
+            if winner is not None and attempt is not winner:
+                continue
+            if kind == 'chunk':
+                if winner is None:
+                    winner = attempt
+                    record.backend = attempt.backend.url
+                    _hedge_policy.record(hedge is not None, attempt is hedge)
+                    for other in attempts:
+                        if other is not attempt:
+                            other.cancel()
+                yield value
+            elif kind == 'done':
+                if winner is None or attempt is winner:
+                    return
+            elif kind == 'error':
+                live.remove(attempt)
+                if attempt is winner:
+                    raise value
+                if live:
+                    continue
+                # 所有请求都在首token之前失败: 按预算重试
+                delay = _retry_delay(retries, deadline_at) if _is_backend_failure(value) else None
+                if delay is None:
+                    raise value
+                print(f"请求错误, {delay:.2f}s后重试: {value}")
+                time.sleep(delay)
+                retries += 1
+                retry = _StreamAttempt(payload, deadline_at, record, events, exclude=attempt.backend)
+                retry.start()
+                live.append(retry)
+                attempts.append(retry)
+    finally:
+        if scope is not None:
+            scope.remove_callback(interrupt)
+        for attempt in attempts:
+            attempt.cancel()
+
+def _start_hedge(payload, deadline_at, record, events, exclude):
+    """在名额和重试预算都允许时发起对冲请求, 否则返回None"""
+    limiter = get_limiter()
+    permit = None
+    if limiter is not None:
+        try:
+            # 对冲请求不排队, 没有空闲名额就放弃; 试探失败不计入准入排队/超时统计
+            permit = limiter.try_acquire(PRIORITY_HIGH)
+        except Exception:
+            return None
+        if permit is None:
+            return None
+    if not _retry_budget.try_spend():
+        _leave(limiter, permit)
         return None
+    hedge = _StreamAttempt(payload, deadline_at, record, events, exclude=exclude, limiter=limiter, permit=permit)
+    hedge.start()
+    return hedge
+
+class _ResponseHolder(list):
+    """
+    存放流式请求等待响应头的连接和之后的response, 取消时由 _close_upstream 关闭;
+    取消之后才放入的在放入时立即关闭
+
+    scope: 有 cancelled 属性的对象(cancel_scope 或对冲的一次尝试)
+    """
+
+    def __init__(self, scope):
+        super().__init__()
+        self.scope = scope
+
+    def append(self, target):
+        super().append(target)
+        if self.scope is not None and self.scope.cancelled:
+            _close_upstream(target)
+
+def _stream_completion(payload, priority=PRIORITY_HIGH, deadline_at=None, record=None):
+    """
+    发起一次流式请求, 逐个yield增量文本, 失败时yield None
+
+    当前上下文的 cancel_scope 被取消时, 立即从取消线程关闭上游连接(vLLM随即中止该序列), 不再产出内容
+    """
+    if record is None:
+        record = RequestMetrics(payload['model'], 'stream')
+    record.upstream = True
+    scope = current_cancel()
+    try:
+        limiter, permit = _admit(priority, deadline_at)
+    except AdmissionTimeout as e:
+        print(f"准入排队超时: {e}")
+        record.finish('timeout')
+        yield None
+        return
+    record.admitted()
+    if scope is not None and scope.cancelled:
+        # 排队期间已被取消, 不再发起请求
+        _leave(limiter, permit)
+        record.finish('cancelled')
+        return
+    _retry_budget.record_request()
+    error = False
+    upstream_ttft = None
+    # 消费方提前关闭生成器时保持 cancelled
+    status = 'cancelled'
+    holder = _ResponseHolder(scope)
+    if hedge_enabled:
+        stream = _hedged_stream(payload, deadline_at, record, holder, scope)
+    else:
+        stream = _retrying_stream(payload, deadline_at, record, holder)
+
+    def abort():
+        for target in list(holder):
+            _close_upstream(target)
+
+    if scope is not None:
+        scope.add_callback(abort)
+    
+    try:
+        for content in stream:
+            if scope is not None and scope.cancelled:
+                break
+            record.token()
+            if upstream_ttft is None:
+                # 反馈给准入控制和对冲策略的TTFT不含本地排队时间
+                upstream_ttft = record.ttft - record.queue_wait
+                _hedge_policy.observe(upstream_ttft)
+            yield content
+        # 连接被取消回调关闭后读取可能直接结束, 不能记为 ok
+        if scope is None or not scope.cancelled:
+            status = 'ok'
+    except Exception as e:
+        if scope is not None and scope.cancelled:
+            # 连接被取消回调关闭导致的读取异常, 不算上游错误
+            pass
+        elif isinstance(e, DeadlineExceeded):
+            error = True
+            status = 'timeout'
+            print(f"请求错误: {e}")
+            yield None
+        elif isinstance(e, requests.RequestException):
+            error = _is_backend_failure(e)
+            status = 'timeout' if isinstance(e, requests.Timeout) else 'error'
+            print(f"请求错误: {e}")
+            yield None
+        else:
+            status = 'error'
+            print(f"其他错误: {e}")
+            yield None
+    finally:
+        if scope is not None:
+            scope.remove_callback(abort)
+        stream.close()
+        _leave(limiter, permit, ttft=upstream_ttft, error=error)
+        record.finish(status)
+
+def call_api(system_prompt, user_prompt, temperature, max_tokens, model_name, use_cache=None,
+             priority=PRIORITY_NORMAL, coalesce=True, history=None, stop=None):
+    """
+    异步调用 openai形式 API
+    
+    参数:
+    - prompt: 输入的提示文本
+    - temperature: 生成温度 (0.1-1.0)
+    - max_tokens: 最大生成token数
+    - use_cache: 是否使用响应缓存, None时取模块配置 cache_by_default
+    - priority: 准入排队优先级 (PRIORITY_HIGH / PRIORITY_NORMAL / PRIORITY_LOW)
+    - coalesce: 是否与同时在途的相同请求合并; 需要多次独立采样时传False
+    - history: 可选的历史消息列表 [{'role', 'content'}], 作为独立消息放在系统提示词与本轮输入之间
+    - stop: 可选的停止序列列表, 生成到其中任一序列时结束(不含该序列)
+    
+    截止时间取自外层 deadline() 上下文; 耗时统计见 metrics_snapshot() 与 request_hooks()
+    
+    返回:
+    - 生成的文本响应
+    """
+    
+    record = RequestMetrics(model_name, 'call')
+    request_key = make_cache_key(model_name, system_prompt, user_prompt, temperature, max_tokens, history, stop)
+    if use_cache is None:
+        use_cache = cache_by_default
+    if use_cache:
+        cached = get_response_cache().get(request_key)
+        if cached is not None:
+            record.finish('cached')
+            return cached
+    
+    payload = _build_payload(system_prompt, user_prompt, temperature, max_tokens, model_name, stream=False,
+                             history=history, stop=stop)
+    deadline_at = current_deadline()
+    if coalesce:
+        content = _coalesce_call(request_key, lambda: _request_completion(payload, priority, deadline_at, record))
+    else:
+        content = _request_completion(payload, priority, deadline_at, record)
+    # 合并到其他调用上的请求没有自己的上游计时
+    if not record.upstream:
+        record.finish('coalesced')
+    if use_cache and content is not None:
+        get_response_cache().set(request_key, content)
+    return content
 
-def call_api_stream(system_prompt, user_prompt, temperature, max_tokens, model_name):
+def call_api_stream(system_prompt, user_prompt, temperature, max_tokens, model_name, priority=PRIORITY_HIGH,
+                    history=None, stop=None):
     """
     流式调用 openai形式 API
     
@@ -61,59 +888,303 @@ def call_api_stream(system_prompt, user_prompt, temperature, max_tokens, model_n
     - prompt: 输入的提示文本
     - temperature: 生成温度 (0.1-1.0)
     - max_tokens: 最大生成token数
+    - priority: 准入排队优先级, 默认实时聊天的最高优先级
+    - history: 可选的历史消息列表, 同 call_api
+    - stop: 可选的停止序列列表, 同 call_api
+    
+    截止时间取自外层 deadline() 上下文; 开启 KLLM_HEDGE 时首token过慢会向另一后端发起对冲请求
     
     返回:
     - 生成器，每次yield一个token
     """
     
-    url = "http://localhost:8080/v1/chat/completions"
+    request_key = make_cache_key(model_name, system_prompt, user_prompt, temperature, max_tokens, history, stop)
+    payload = _build_payload(system_prompt, user_prompt, temperature, max_tokens, model_name, stream=True,
+                             history=history, stop=stop)
+    # 合并请求时上游在后台线程中拉取, contextvars不会跟过去, 这里显式取出截止时间和钩子
+    deadline_at = current_deadline()
+    record = RequestMetrics(model_name, 'stream')
+    try:
+        yield from _coalesce_stream(request_key, lambda: _stream_completion(payload, priority, deadline_at, record))
+    finally:
+        # 本调用是上游发起者时由 _stream_completion 结束记录(提前关闭时可能仍在后台收尾)
+        if not record.upstream:
+            record.finish('coalesced')
+
+class ApiBatch:
+    """
+    call_api_batch 的返回值
+
+    迭代时按完成顺序逐个返回结果, 每个结果为:
+    {'index': 在输入中的下标, 'content': 生成文本(失败为None), 'error': 失败原因, 'elapsed': 耗时, 'metrics': 调用指标}
+    迭代结束后可读取 results(按输入顺序)、failed(失败数) 和 wall_time(总耗时)
+    """
+
+    def __init__(self, items, concurrency, priority):
+        self.items = list(items)
+        self.concurrency = max(1, min(concurrency, len(self.items) or 1))
+        self.priority = priority
+        self.results = [None] * len(self.items)
+        self.failed = 0
+        self.wall_time = None
+        self._consumed = False
+
+    def _run_one(self, index, item):
+        calls = []
+        start = time.time()
+        try:
+            with request_hooks(calls.append):
+                content = call_api(priority=self.priority, **item)
+            error = None if content is not None else (calls[-1].status if calls else 'error')
+        except Exception as e:
+            content = None
+            error = str(e)
+        return {
+            'index': index,
+            'content': content,
+            'error': error,
+            'elapsed': time.time() - start,
+            'metrics': calls[-1].to_dict() if calls else None
+        }
+
+    def __iter__(self):
+        if self._consumed:
+            yield from (r for r in self.results if r is not None)
+            return
+        self._consumed = True
+        start = time.time()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='kllm-batch')
+        try:
+            # 每个任务带上调用方的上下文(截止时间、指标钩子)
+            futures = [
+                executor.submit(contextvars.copy_context().run, self._run_one, index, item)
+                for index, item in enumerate(self.items)
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                self.results[result['index']] = result
+                if result['error'] is not None:
+                    self.failed += 1
+                yield result
+        finally:
+            # 提前停止迭代时取消尚未开始的调用
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.wall_time = time.time() - start
+
+    def wait(self):
+        """等待全部完成, 按输入顺序返回生成文本列表(失败为None)"""
+        for _ in self:
+            pass
+        return [r['content'] if r is not None else None for r in self.results]
+
+def call_api_batch(items, concurrency=None, priority=PRIORITY_NORMAL):
+    """
+    并发执行一组互相独立的 call_api 调用, 让vLLM连续批处理同时处理多个请求
+    
+    参数:
+    - items: 请求列表, 每项为 call_api 的关键字参数字典
+      (system_prompt, user_prompt, temperature, max_tokens, model_name, 可选 use_cache / coalesce)
+    - concurrency: 同时在途的调用数, 默认 KLLM_BATCH_CONCURRENCY; 整体仍受准入控制约束
+    - priority: 准入排队优先级
     
-    headers = {
-        "Content-Type": "application/json"
-    }
+    返回:
+    - ApiBatch, 迭代获取先完成的结果, 或 wait() 获取按输入顺序排列的全部结果
     
-    payload = {
-        "model": model_name,
-        "messages": [
-            {
-                'role': 'system',
-                'content': system_prompt
-            },
-            {
-                "role": "user",
-                "content": user_prompt
-            }
-        ],
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "stream": True
-    }
+    用法:
+        batch = call_api_batch([{'system_prompt': p, 'user_prompt': t, 'temperature': 0.1,
+                                 'max_tokens': 512, 'model_name': model} for t in texts])
+        for result in batch:
+            print(result['index'], result['content'])
+        print(batch.wall_time, batch.failed)
+    """
+    return ApiBatch(items, concurrency or batch_concurrency, priority)
+
+def _async_timeout_for(deadline_at):
+    connect, read = _timeout_for(deadline_at)
+    return httpx.Timeout(read, connect=connect)
+
+async def call_api_async(system_prompt, user_prompt, temperature, max_tokens, model_name, priority=PRIORITY_NORMAL,
+                         history=None, stop=None):
+    """
+    异步调用 openai形式 API (asyncio版本, 参数与返回值同 call_api)
+    
+    返回:
+    - 生成的文本响应, 失败时返回None
+    """
     
+    payload = _build_payload(system_prompt, user_prompt, temperature, max_tokens, model_name, stream=False,
+                             history=history, stop=stop)
+    deadline_at = current_deadline()
+    record = RequestMetrics(model_name, 'call')
     try:
-        response = requests.post(url, headers=headers, json=payload, stream=True)
-        response.raise_for_status()
-        
-        for line in response.iter_lines():
-            if line:
-                decoded_line = line.decode('utf-8')
-                if decoded_line.startswith('data: '):
-                    data = decoded_line[6:]
-                    if data != '[DONE]':
-                        try:
-                            chunk = json.loads(data)
-                            if 'choices' in chunk and chunk['choices']:
-                                delta = chunk['choices'][0].get('delta', {})
-                                if 'content' in delta:
-                                    yield delta['content']
-                        except json.JSONDecodeError:
-                            continue
-    except requests.RequestException as e:
-        print(f"请求错误: {e}")
-        yield None
-    except Exception as e:
-        print(f"其他错误: {e}")
+        limiter, permit = await _admit_async(priority, deadline_at)
+    except AdmissionTimeout as e:
+        print(f"准入排队超时: {e}")
+        record.finish('timeout')
+        return None
+    record.admitted()
+    _retry_budget.record_request()
+    router = get_router()
+    error = False
+    status = 'cancelled'
+    
+    try:
+        attempt = 0
+        while True:
+            backend = router.acquire()
+            record.backend = backend.url
+            failed = False
+            url = f"{backend.url}/v1/chat/completions"
+            try:
+                response = await get_async_client().post(url, headers=HEADERS, content=_encode_payload(payload),
+                                                         timeout=_async_timeout_for(deadline_at))
+                response.raise_for_status()
+                result = response.json()
+                record.set_usage(result.get('usage'))
+                content = result['choices'][0]['message']['content']
+                status = 'ok'
+                return content
+            except DeadlineExceeded as e:
+                print(f"请求错误: {e}")
+                error = True
+                status = 'timeout'
+                return None
+            except httpx.HTTPError as e:
+                failed = _is_backend_failure(e)
+                delay = _retry_delay(attempt, deadline_at) if failed else None
+                if delay is None:
+                    print(f"请求错误: {e}")
+                    error = failed
+                    status = 'timeout' if isinstance(e, httpx.TimeoutException) else 'error'
+                    return None
+                print(f"请求错误, {delay:.2f}s后重试: {e}")
+            except KeyError as e:
+                print(f"解析响应错误: {e}")
+                print(f"完整响应: {response.text}")
+                status = 'error'
+                return None
+            except Exception as e:
+                print(f"其他错误: {e}")
+                status = 'error'
+                return None
+            finally:
+                router.release(backend, failed)
+            attempt += 1
+            await asyncio.sleep(delay)
+    finally:
+        _leave(limiter, permit, error=error)
+        record.finish(status)
+
+async def call_api_stream_async(system_prompt, user_prompt, temperature, max_tokens, model_name,
+                                priority=PRIORITY_HIGH, history=None, stop=None):
+    """
+    流式调用 openai形式 API (asyncio版本, 参数与返回值同 call_api_stream)
+    
+    首token之前的后端故障按预算重试, 暂不支持对冲
+    
+    返回:
+    - 异步生成器，每次yield一个token
+    """
+    
+    payload = _build_payload(system_prompt, user_prompt, temperature, max_tokens, model_name, stream=True,
+                             history=history, stop=stop)
+    deadline_at = current_deadline()
+    record = RequestMetrics(model_name, 'stream')
+    try:
+        limiter, permit = await _admit_async(priority, deadline_at)
+    except AdmissionTimeout as e:
+        print(f"准入排队超时: {e}")
+        record.finish('timeout')
         yield None
-        
+        return
+    record.admitted()
+    _retry_budget.record_request()
+    router = get_router()
+    error = False
+    ttft = None
+    status = 'cancelled'
+    
+    try:
+        attempt = 0
+        while True:
+            backend = router.acquire()
+            record.backend = backend.url
+            failed = False
+            url = f"{backend.url}/v1/chat/completions"
+            try:
+                async with get_async_client().stream('POST', url, headers=HEADERS, content=_encode_payload(payload),
+                                                     timeout=_async_timeout_for(deadline_at)) as response:
+                    response.raise_for_status()
+                    
+                    parser = SSEDeltaParser()
+                    async for raw in response.aiter_bytes():
+                        for content in parser.feed(raw):
+                            record.token()
+                            if ttft is None:
+                                ttft = record.ttft - record.queue_wait
+                            yield content
+                        if deadline_at is not None and time.monotonic() > deadline_at:
+                            raise DeadlineExceeded("流式输出超过截止时间")
+                    record.set_usage(parser.usage)
+                status = 'ok'
+                return
+            except DeadlineExceeded as e:
+                print(f"请求错误: {e}")
+                error = True
+                status = 'timeout'
+                yield None
+                return
+            except httpx.HTTPError as e:
+                failed = _is_backend_failure(e)
+                delay = _retry_delay(attempt, deadline_at) if failed and ttft is None else None
+                if delay is None:
+                    print(f"请求错误: {e}")
+                    error = failed
+                    status = 'timeout' if isinstance(e, httpx.TimeoutException) else 'error'
+                    yield None
+                    return
+                print(f"请求错误, {delay:.2f}s后重试: {e}")
+            except Exception as e:
+                print(f"其他错误: {e}")
+                status = 'error'
+                yield None
+                return
+            finally:
+                router.release(backend, failed)
+            attempt += 1
+            await asyncio.sleep(delay)
+    finally:
+        _leave(limiter, permit, ttft=ttft, error=error)
+        record.finish(status)
+
+def retry_stats():
+    """返回重试预算与对冲请求的统计"""
+    return {'retry_budget': _retry_budget.stats(), 'hedge': _hedge_policy.stats()}
+
+def metrics_snapshot(include_workers=True):
+    """
+    返回按模型名汇总的排队耗时、TTFT、token间隔、总耗时和token数分布, 以及非LLM处理阶段的耗时分布
+
+    参数:
+    - include_workers: 是否合并Celery worker通过 start_metrics_publisher() 定期写入Redis的快照(及已退出worker的累计)
+    """
+    snapshot = metrics.collect(redis_url if include_workers else None)
+    snapshot['summary'] = metrics.summarize(snapshot)
+    snapshot['stage_summary'] = metrics.summarize_stages(snapshot)
+    return snapshot
+
+def publish_metrics():
+    """把本进程的统计写入Redis, 供API进程汇总(内部按间隔限流, 可在每个任务结束后调用)"""
+    return metrics.publish(redis_url)
+
+def start_metrics_publisher():
+    """在本进程启动后台线程, 每 metrics_publish_interval 秒把统计写入Redis(空闲的worker也持续发布)"""
+    return metrics.start_publisher(redis_url, metrics_publish_interval)
+
+def stop_metrics_publisher():
+    """进程退出前停止定期发布并写入最终统计"""
+    return metrics.stop_publisher(redis_url)
+
 # 非流式使用示例
 def main():
     system_prompt = "请回答用户的问题"
@@ -0,0 +1,414 @@
+"""
+vLLM调用的自适应准入控制
+
+根据观测到的首token延迟(TTFT)和错误率动态调整允许的在途请求数(AIMD):
+- 成功且TTFT未明显高于基线: 加性增长, 每个limit次成功增长1
+- 出错或TTFT超过基线的 tolerance 倍: 乘性减少 limit *= backoff (有冷却时间, 避免一批慢请求把limit压到底)
+- 超出limit的请求在本地按优先级排队, 而不是涌入vLLM内部排队
+
+AdaptiveLimiter 在进程内生效(线程与asyncio共用);
+RedisAdaptiveLimiter 在多个Celery prefork worker间共享limit和等待队列
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+import uuid
+from collections import deque
+
+# 优先级, 数值越小越先被放行
+PRIORITY_HIGH = 0     # 实时聊天(流式)
+PRIORITY_NORMAL = 1   # 普通调用
+PRIORITY_LOW = 2      # 后台任务(长期记忆整理等)
+
+
+class AdmissionTimeout(Exception):
+    """排队等待超过超时时间"""
+
+
+class _LatencyWindow:
+    """最近N个样本, 用于计算TTFT基线(窗口最小值)和排队耗时分位数"""
+
+    def __init__(self, size):
+        self.samples = deque(maxlen=size)
+
+    def add(self, value):
+        self.samples.append(value)
+
+    def minimum(self):
+        return min(self.samples) if self.samples else None
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+class _AIMDPolicy:
+    """AIMD限流策略, 只负责计算新的limit"""
+
+    def __init__(self, min_limit, max_limit, tolerance, backoff, cooldown, window):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.ttft_window = _LatencyWindow(window)
+        self._last_decrease = 0.0
+
+    def update(self, limit, ttft, error):
+        """返回调整后的limit"""
+        now = time.time()
+        overloaded = error
+        if ttft is not None:
+            baseline = self.ttft_window.minimum()
+            self.ttft_window.add(ttft)
+            if baseline is not None and ttft > baseline * self.tolerance:
+                overloaded = True
+        if overloaded:
+            if now - self._last_decrease < self.cooldown:
+                return limit
+            self._last_decrease = now
+            return max(self.min_limit, limit * self.backoff)
+        return min(self.max_limit, limit + 1.0 / max(limit, 1.0))
+
+
+class _Waiter:
+    __slots__ = ('event', 'loop', 'future', 'granted', 'cancelled')
+
+    def __init__(self, loop=None):
+        self.loop = loop
+        self.future = loop.create_future() if loop is not None else None
+        self.event = threading.Event() if loop is None else None
+        self.granted = False
+        self.cancelled = False
+
+    def notify(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._resolve)
+        else:
+            self.event.set()
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(True)
+
+
+class AdaptiveLimiter:
+    """
+    进程内自适应并发限制器
+
+    参数:
+    - initial_limit / min_limit / max_limit: 初始、最小、最大在途请求数
+    - tolerance: TTFT超过基线多少倍视为过载
+    - backoff: 过载时limit的乘数
+    - cooldown: 两次减少之间的最短间隔(秒)
+    - window: TTFT基线窗口大小
+    """
+
+    def __init__(self, initial_limit=32, min_limit=1, max_limit=256, tolerance=2.0,
+                 backoff=0.9, cooldown=1.0, window=200):
+        self.limit = float(initial_limit)
+        self.inflight = 0
+        self.policy = _AIMDPolicy(min_limit, max_limit, tolerance, backoff, cooldown, window)
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._wait_window = _LatencyWindow(1000)
+        self._stats = {'admitted': 0, 'queued': 0, 'timeouts': 0, 'errors': 0}
+
+    def acquire(self, priority=PRIORITY_NORMAL, timeout=None):
+        """阻塞直到获得一个名额, 返回名额凭证; 超时抛出 AdmissionTimeout"""
+        start = time.time()
+        with self._lock:
+            admitted = self._try_admit_locked()
+            if not admitted:
+                waiter = _Waiter()
+                self._enqueue_locked(priority, waiter)
+        if admitted:
+            return self._admitted(start)
+        if not waiter.event.wait(timeout):
+            self._cancel(waiter)
+        if not waiter.granted:
+            raise AdmissionTimeout(f"排队超过 {timeout}s")
+        return self._admitted(start)
+
+    def try_acquire(self, priority=PRIORITY_NORMAL):
+        """
+        有空闲名额且无人排队时立即取得名额, 否则返回None
+
+        不排队(priority只为与跨worker版本接口一致), 取不到名额也不计入 queued / timeouts(如对冲请求的试探)
+        """
+        start = time.time()
+        with self._lock:
+            admitted = self._try_admit_locked()
+        return self._admitted(start) if admitted else None
+
+    async def acquire_async(self, priority=PRIORITY_NORMAL, timeout=None):
+        """asyncio版本的 acquire"""
+        start = time.time()
+        with self._lock:
+            admitted = self._try_admit_locked()
+            if not admitted:
+                waiter = _Waiter(asyncio.get_running_loop())
+                self._enqueue_locked(priority, waiter)
+        if admitted:
+            return self._admitted(start)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            self._cancel(waiter)
+            if not waiter.granted:
+                raise AdmissionTimeout(f"排队超过 {timeout}s")
+        except asyncio.CancelledError:
+            # 调用方被取消时, 若名额已分配则直接归还
+            self._cancel(waiter)
+            if waiter.granted:
+                self._give_back()
+            raise
+        return self._admitted(start)
+
+    def release(self, permit=None, ttft=None, error=False):
+        """
+        释放名额并反馈本次请求的结果
+
+        参数:
+        - permit: acquire 返回的凭证
+        - ttft: 首token延迟(秒), 非流式请求传None
+        - error: 是否出错
+        """
+        with self._lock:
+            self.inflight -= 1
+            if error:
+                self._stats['errors'] += 1
+            self.limit = self.policy.update(self.limit, ttft, error)
+            self._dispatch_locked()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'limit': round(self.limit, 2),
+                'inflight': self.inflight,
+                'waiting': sum(1 for _, _, w in self._waiters if not w.cancelled),
+                'ttft_baseline': self.policy.ttft_window.minimum(),
+                'wait_p50': self._wait_window.percentile(0.5),
+                'wait_p99': self._wait_window.percentile(0.99),
+                'wait_max': max(self._wait_window.samples, default=0.0)
+            })
+            return stats
+
+    def _try_admit_locked(self):
+        if not self._waiters and self.inflight < int(self.limit):
+            self.inflight += 1
+            return True
+        return False
+
+    def _enqueue_locked(self, priority, waiter):
+        self._stats['queued'] += 1
+        heapq.heappush(self._waiters, (priority, next(self._seq), waiter))
+        self._dispatch_locked()
+
+    def _dispatch_locked(self):
+        """按优先级放行等待者"""
+        while self._waiters and self.inflight < int(self.limit):
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.cancelled:
+                continue
+            waiter.granted = True
+            self.inflight += 1
+            waiter.notify()
+
+    def _cancel(self, waiter):
+        with self._lock:
+            if not waiter.granted:
+                waiter.cancelled = True
+                self._stats['timeouts'] += 1
+
+    def _give_back(self):
+        with self._lock:
+            self.inflight -= 1
+            self._dispatch_locked()
+
+    def _admitted(self, start):
+        with self._lock:
+            self._stats['admitted'] += 1
+            self._wait_window.add(time.time() - start)
+            return next(self._seq)
+
+
+# Redis脚本: 清理过期名额和失联的等待者, 在名额充足且排在队首时放行
+_ACQUIRE_SCRIPT = """
+local holders, waiters, seen, limit_key = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local now, token, score = tonumber(ARGV[1]), ARGV[2], tonumber(ARGV[3])
+local lease, default_limit, waiter_ttl = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+redis.call('ZREMRANGEBYSCORE', holders, '-inf', now)
+local stale = redis.call('ZRANGEBYSCORE', seen, '-inf', now - waiter_ttl)
+for _, member in ipairs(stale) do
+  redis.call('ZREM', waiters, member)
+  redis.call('ZREM', seen, member)
+end
+local limit = math.floor(tonumber(redis.call('GET', limit_key) or default_limit))
+local free = limit - redis.call('ZCARD', holders)
+if free > 0 then
+  local rank = redis.call('ZRANK', waiters, token)
+  if rank == false then
+    rank = redis.call('ZCOUNT', waiters, '-inf', '(' .. score)
+  end
+  if rank < free then
+    redis.call('ZADD', holders, now + lease, token)
+    redis.call('ZREM', waiters, token)
+    redis.call('ZREM', seen, token)
+    return 1
+  end
+end
+redis.call('ZADD', waiters, 'NX', score, token)
+redis.call('ZADD', seen, now, token)
+return 0
+"""
+
+
+class RedisAdaptiveLimiter:
+    """
+    跨worker自适应并发限制器
+
+    所有worker共享 limit、在途名额集合和按优先级排序的等待队列;
+    TTFT基线在每个进程内独立统计, limit的增减直接作用于共享值
+
+    参数:
+    - redis_url: Redis地址
+    - name: 限制器名称(区分不同的vLLM集群)
+    - lease: 单个名额的最长占用时间(秒), worker崩溃时名额自动回收
+    - poll_interval: 排队时轮询间隔(秒)
+    其余参数同 AdaptiveLimiter
+    """
+
+    def __init__(self, redis_url, name='default', initial_limit=32, min_limit=1, max_limit=256,
+                 tolerance=2.0, backoff=0.9, cooldown=1.0, window=200, lease=120, poll_interval=0.01):
+        self.redis_url = redis_url
+        self.initial_limit = initial_limit
+        self.policy = _AIMDPolicy(min_limit, max_limit, tolerance, backoff, cooldown, window)
+        self.lease = lease
+        self.poll_interval = poll_interval
+        prefix = f"kllm:admission:{name}"
+        self._keys = [f"{prefix}:holders", f"{prefix}:waiters", f"{prefix}:seen", f"{prefix}:limit"]
+        self._client = None
+        self._client_pid = None
+        self._script = None
+        self._wait_window = _LatencyWindow(1000)
+        self._stats = {'admitted': 0, 'queued': 0, 'timeouts': 0, 'errors': 0}
+        self._lock = threading.Lock()
+
+    def _redis(self):
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            import redis
+            self._client = redis.Redis.from_url(self.redis_url, decode_responses=True)
+            self._script = self._client.register_script(_ACQUIRE_SCRIPT)
+            self._client.set(self._keys[3], self.initial_limit, nx=True)
+            self._client_pid = pid
+        return self._client
+
+    def _try(self, token, score):
+        self._redis()
+        return self._script(
+            keys=self._keys,
+            args=[time.time(), token, score, self.lease, self.initial_limit, max(1.0, self.poll_interval * 100)]
+        ) == 1
+
+    def _dequeue(self, token):
+        pipe = self._redis().pipeline()
+        pipe.zrem(self._keys[1], token)
+        pipe.zrem(self._keys[2], token)
+        pipe.execute()
+
+    def acquire(self, priority=PRIORITY_NORMAL, timeout=None):
+        """阻塞直到获得一个名额, 返回名额凭证; 超时抛出 AdmissionTimeout"""
+        start = time.time()
+        token = uuid.uuid4().hex
+        # 同优先级按到达时间排序
+        score = priority * 1e13 + start * 1000
+        queued = False
+        while not self._try(token, score):
+            if not queued:
+                queued = True
+                with self._lock:
+                    self._stats['queued'] += 1
+            if timeout is not None and time.time() - start > timeout:
+                self._dequeue(token)
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise AdmissionTimeout(f"排队超过 {timeout}s")
+            time.sleep(self.poll_interval)
+        return self._admitted(token, start)
+
+    def try_acquire(self, priority=PRIORITY_NORMAL):
+        """同 AdaptiveLimiter.try_acquire; 取不到名额时从等待队列中移除"""
+        start = time.time()
+        token = uuid.uuid4().hex
+        if self._try(token, priority * 1e13 + start * 1000):
+            return self._admitted(token, start)
+        self._dequeue(token)
+        return None
+
+    async def acquire_async(self, priority=PRIORITY_NORMAL, timeout=None):
+        """asyncio版本的 acquire (Redis调用本身是同步的, 单次耗时为一次往返)"""
+        start = time.time()
+        token = uuid.uuid4().hex
+        score = priority * 1e13 + start * 1000
+        while not self._try(token, score):
+            if timeout is not None and time.time() - start > timeout:
+                self._dequeue(token)
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise AdmissionTimeout(f"排队超过 {timeout}s")
+            await asyncio.sleep(self.poll_interval)
+        return self._admitted(token, start)
+
+    def _admitted(self, token, start):
+        wait = time.time() - start
+        with self._lock:
+            self._stats['admitted'] += 1
+            self._wait_window.add(wait)
+        return token
+
+    def release(self, permit, ttft=None, error=False):
+        """释放名额并按本次结果调整共享limit"""
+        client = self._redis()
+        limit = float(client.get(self._keys[3]) or self.initial_limit)
+        new_limit = self.policy.update(limit, ttft, error)
+        pipe = client.pipeline()
+        pipe.zrem(self._keys[0], permit)
+        if new_limit != limit:
+            # 增长用增量叠加, 避免并发worker互相覆盖; 减少直接写入
+            if new_limit > limit:
+                pipe.incrbyfloat(self._keys[3], new_limit - limit)
+            else:
+                pipe.set(self._keys[3], new_limit)
+        pipe.execute()
+        if error:
+            with self._lock:
+                self._stats['errors'] += 1
+
+    def stats(self):
+        client = self._redis()
+        pipe = client.pipeline()
+        pipe.get(self._keys[3])
+        pipe.zcard(self._keys[0])
+        pipe.zcard(self._keys[1])
+        limit, inflight, waiting = pipe.execute()
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'limit': round(float(limit or self.initial_limit), 2),
+                'inflight': inflight,
+                'waiting': waiting,
+                'ttft_baseline': self.policy.ttft_window.minimum(),
+                'wait_p50': self._wait_window.percentile(0.5),
+                'wait_p99': self._wait_window.percentile(0.99),
+                'wait_max': max(self._wait_window.samples, default=0.0)
+            })
+        return stats
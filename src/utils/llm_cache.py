@@ -0,0 +1,238 @@
+"""
+LLM响应缓存
+
+用于温度固定、系统提示词固定的确定性调用(如 extract_activity / extract_event / extract_profile):
+- 内存层: 进程内LRU, 按条目数和字节数限制, 支持TTL
+- 磁盘层: sqlite文件, 多个worker进程共享, 同样按条目数/字节数/TTL淘汰
+- 命中/未命中计数通过 stats() 获取
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def make_cache_key(model_name, system_prompt, user_prompt, temperature, max_tokens, history=None, stop=None):
+    """根据 (模型, 系统提示词, 用户提示词, 温度, 最大token数, 历史消息, 停止序列) 生成缓存键"""
+    parts = [model_name, system_prompt, user_prompt, temperature, max_tokens]
+    if history:
+        # 没有历史消息时保持与旧键一致; 已渲染的历史使用其自身的摘要
+        if hasattr(history, 'cache_key'):
+            parts.append(history.cache_key())
+        else:
+            parts.append([[msg['role'], msg['content']] for msg in history])
+    if stop:
+        parts.append(['stop', list(stop)])
+    raw = json.dumps(parts, ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """
+    两级响应缓存
+
+    参数:
+    - max_entries: 内存层最大条目数
+    - max_bytes: 内存层最大字节数(按响应文本UTF-8长度计算)
+    - ttl: 过期时间(秒), None表示不过期
+    - disk_path: 磁盘层sqlite文件路径, None表示只用内存层
+    - disk_max_entries / disk_max_bytes: 磁盘层容量上限
+    """
+
+    # 每写入多少次磁盘层执行一次淘汰检查
+    DISK_EVICT_INTERVAL = 32
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024, ttl=24 * 3600,
+                 disk_path=None, disk_max_entries=100000, disk_max_bytes=1024 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.disk_max_entries = disk_max_entries
+        self.disk_max_bytes = disk_max_bytes
+
+        self._memory = OrderedDict()  # key -> (value, size, expires_at)
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._conn_pid = None
+        self._disk_writes = 0
+        self._stats = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expired': 0
+        }
+
+    # ---------- 公共接口 ----------
+
+    def get(self, key):
+        """查询缓存, 未命中返回None"""
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                value, size, expires_at = item
+                if expires_at is None or expires_at > now:
+                    self._memory.move_to_end(key)
+                    self._stats['memory_hits'] += 1
+                    return value
+                self._remove_memory(key)
+                self._stats['expired'] += 1
+
+        value = self._disk_get(key, now)
+        with self._lock:
+            if value is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['disk_hits'] += 1
+        self._memory_set(key, value, now)
+        return value
+
+    def set(self, key, value):
+        """写入缓存"""
+        if value is None:
+            return
+        now = time.time()
+        self._memory_set(key, value, now)
+        self._disk_set(key, value, now)
+        with self._lock:
+            self._stats['stores'] += 1
+
+    def clear(self):
+        """清空内存层和磁盘层"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        try:
+            conn = self._disk_conn()
+            if conn is not None:
+                with conn:
+                    conn.execute('DELETE FROM llm_cache')
+        except (OSError, sqlite3.Error) as e:
+            print(f"清空磁盘缓存失败: {e}")
+
+    def stats(self):
+        """返回命中率等统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['memory_entries'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_bytes
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
+
+    # ---------- 内存层 ----------
+
+    def _memory_set(self, key, value, now):
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        expires_at = now + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._memory:
+                self._remove_memory(key)
+            self._memory[key] = (value, size, expires_at)
+            self._memory_bytes += size
+            while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+                oldest = next(iter(self._memory))
+                self._remove_memory(oldest)
+                self._stats['evictions'] += 1
+
+    def _remove_memory(self, key):
+        _, size, _ = self._memory.pop(key)
+        self._memory_bytes -= size
+
+    # ---------- 磁盘层 ----------
+
+    def _disk_conn(self):
+        """
+        每个进程单独打开sqlite连接, fork后不复用父进程的连接
+
+        目录不可写或数据库无法打开时关闭磁盘层(只用内存层), 返回None
+        """
+        if not self.disk_path:
+            return None
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            try:
+                directory = os.path.dirname(self.disk_path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                conn = sqlite3.connect(self.disk_path, timeout=5, check_same_thread=False, isolation_level=None)
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('PRAGMA synchronous=NORMAL')
+                conn.execute(
+                    'CREATE TABLE IF NOT EXISTS llm_cache ('
+                    'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                    'expires_at REAL, accessed_at REAL NOT NULL)'
+                )
+                conn.execute('CREATE INDEX IF NOT EXISTS idx_llm_cache_accessed ON llm_cache(accessed_at)')
+            except (OSError, sqlite3.Error) as e:
+                print(f"打开磁盘缓存失败, 只使用内存缓存: {e}")
+                self.disk_path = None
+                return None
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    def _disk_get(self, key, now):
+        try:
+            conn = self._disk_conn()
+            if conn is None:
+                return None
+            with self._lock:
+                row = conn.execute('SELECT value, expires_at FROM llm_cache WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                value, expires_at = row
+                if expires_at is not None and expires_at <= now:
+                    conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                    self._stats['expired'] += 1
+                    return None
+                conn.execute('UPDATE llm_cache SET accessed_at = ? WHERE key = ?', (now, key))
+                return value
+        except (OSError, sqlite3.Error) as e:
+            print(f"读取磁盘缓存失败: {e}")
+            return None
+
+    def _disk_set(self, key, value, now):
+        expires_at = now + self.ttl if self.ttl else None
+        try:
+            conn = self._disk_conn()
+            if conn is None:
+                return
+            with self._lock:
+                conn.execute(
+                    'INSERT OR REPLACE INTO llm_cache (key, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                    (key, value, len(value.encode('utf-8')), expires_at, now)
+                )
+                self._disk_writes += 1
+                if self._disk_writes % self.DISK_EVICT_INTERVAL == 0:
+                    self._disk_evict(conn, now)
+        except (OSError, sqlite3.Error) as e:
+            print(f"写入磁盘缓存失败: {e}")
+
+    def _disk_evict(self, conn, now):
+        """删除过期条目, 超出容量时按最近访问时间淘汰"""
+        conn.execute('DELETE FROM llm_cache WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,))
+        count, total = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM llm_cache').fetchone()
+        if count <= self.disk_max_entries and total <= self.disk_max_bytes:
+            return
+        # 一次淘汰到上限的90%, 避免每次写入都触发
+        target_count = int(self.disk_max_entries * 0.9)
+        target_bytes = int(self.disk_max_bytes * 0.9)
+        removed = 0
+        for key, size in conn.execute('SELECT key, size FROM llm_cache ORDER BY accessed_at').fetchall():
+            if count <= target_count and total <= target_bytes:
+                break
+            conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+            count -= 1
+            total -= size
+            removed += 1
+        self._stats['evictions'] += removed
@@ -0,0 +1,525 @@
+"""
+LLM调用的延迟与token统计
+
+每次上游调用对应一条 RequestMetrics 记录, 包含:
+- queue_wait: 准入排队耗时
+- ttft: 首token延迟(从发起调用算起)
+- itl: 相邻token(流式增量)之间的间隔
+- duration: 总耗时
+- prompt_tokens / completion_tokens: 取自响应的 usage 字段, 流式无 usage 时按增量个数估计
+
+记录结束时写入进程内按模型名区分的直方图, 并依次调用钩子:
+- add_hook(fn): 全局钩子, 进程内所有调用都会触发
+- request_hooks(fn): 上下文钩子, 只有 with 块内发起的调用会触发, 便于上层把数据挂到自己的trace上
+
+LLM调用之外的处理阶段(如记忆检索)用 observe_stage() 单独记录耗时, 不计入任何模型的统计;
+increment() 记录按去向区分的计数(如快速通道分流了多少轮对话)
+
+多进程(Celery prefork)下每个进程各自统计, 通过 publish() 把快照写入Redis(start_publisher() 在后台线程中定期发布),
+由 collect() 合并所有进程的快照, render_prometheus() 输出 Prometheus 文本格式;
+进程退出前 stop_publisher() 把最终统计并入已退出进程的累计, 汇总的计数不会因worker退出而减少
+"""
+import contextvars
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+# 延迟直方图的桶上界(秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 处理阶段耗时直方图的桶上界(秒), 比LLM延迟细一个数量级
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# token数直方图的桶上界
+TOKEN_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+_HISTOGRAMS = (
+    ('queue_wait_seconds', LATENCY_BUCKETS),
+    ('ttft_seconds', LATENCY_BUCKETS),
+    ('itl_seconds', LATENCY_BUCKETS),
+    ('duration_seconds', LATENCY_BUCKETS),
+    ('prompt_tokens', TOKEN_BUCKETS),
+    ('completion_tokens', TOKEN_BUCKETS),
+)
+
+_hooks = []
+_context_hooks = contextvars.ContextVar('kllm_metrics_hooks', default=())
+
+
+class Histogram:
+    """固定桶直方图, 桶计数不累加(导出Prometheus时再累加)"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+def _quantile(snapshot, q):
+    """按桶线性插值估计分位数(同 Prometheus histogram_quantile), 落在最后一个桶时返回最大桶上界"""
+    if not snapshot['count']:
+        return None
+    target = snapshot['count'] * q
+    seen = 0
+    lower = 0.0
+    for bound, count in zip(snapshot['buckets'], snapshot['counts']):
+        if count and seen + count >= target:
+            return lower + (bound - lower) * (target - seen) / count
+        seen += count
+        lower = bound
+    return snapshot['buckets'][-1]
+
+
+class RequestMetrics:
+    """
+    单次上游调用的计时记录
+
+    由kllm在调用过程中依次调用 admitted() / token() / finish(),
+    钩子拿到的就是该对象, 可读取各属性或 to_dict()
+    """
+
+    __slots__ = ('model', 'kind', 'start', 'queue_wait', 'ttft', 'itl', 'duration', 'prompt_tokens',
+                 'completion_tokens', 'chunks', 'status', 'backend', 'upstream', 'finished', '_last', '_hooks')
+
+    def __init__(self, model, kind):
+        self.model = model
+        self.kind = kind
+        self.start = time.monotonic()
+        self.queue_wait = None
+        self.ttft = None
+        self.itl = []
+        self.duration = None
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.chunks = 0
+        self.status = None
+        self.backend = None
+        # 是否由本记录实际发起了上游请求(合并到其他调用上的为False)
+        self.upstream = False
+        self.finished = False
+        self._last = None
+        # 在发起调用的线程里取出上下文钩子, 上游可能在合并请求的后台线程中执行
+        self._hooks = _context_hooks.get()
+
+    def admitted(self):
+        """准入排队结束"""
+        self.queue_wait = time.monotonic() - self.start
+
+    def token(self):
+        """收到一个流式增量"""
+        now = time.monotonic()
+        if self._last is None:
+            self.ttft = now - self.start
+        else:
+            self.itl.append(now - self._last)
+        self._last = now
+        self.chunks += 1
+
+    def set_usage(self, usage):
+        if usage:
+            self.prompt_tokens = usage.get('prompt_tokens')
+            self.completion_tokens = usage.get('completion_tokens')
+
+    def finish(self, status='ok'):
+        """
+        结束记录, 写入直方图并调用钩子; 重复调用无效
+
+        参数:
+        - status: ok / error / timeout / cancelled, 以及不经过上游的 cached / coalesced
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.status = status
+        self.duration = time.monotonic() - self.start
+        if self.ttft is None and status == 'ok' and self.kind == 'call':
+            # 非流式调用的首token即完整响应
+            self.ttft = self.duration
+        if self.completion_tokens is None and self.chunks:
+            self.completion_tokens = self.chunks
+        registry.observe(self)
+        for hook in _hooks + list(self._hooks):
+            try:
+                hook(self)
+            except Exception as e:
+                print(f"指标钩子执行失败: {e}")
+
+    def to_dict(self):
+        return {
+            'model': self.model,
+            'kind': self.kind,
+            'status': self.status,
+            'backend': self.backend,
+            'queue_wait': self.queue_wait,
+            'ttft': self.ttft,
+            'itl_mean': sum(self.itl) / len(self.itl) if self.itl else None,
+            'itl_max': max(self.itl) if self.itl else None,
+            'duration': self.duration,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens
+        }
+
+
+class MetricsRegistry:
+    """进程内按模型名区分的直方图与请求计数"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+        self._stages = {}
+        self._counters = {}
+
+    def _model_locked(self, model):
+        entry = self._models.get(model)
+        if entry is None:
+            entry = {
+                'requests': {},
+                'histograms': {name: Histogram(buckets) for name, buckets in _HISTOGRAMS}
+            }
+            self._models[model] = entry
+        return entry
+
+    def observe(self, record):
+        with self._lock:
+            entry = self._model_locked(record.model)
+            entry['requests'][record.status] = entry['requests'].get(record.status, 0) + 1
+            # 只有真正到达上游并成功的调用计入延迟分布
+            if record.status != 'ok':
+                return
+            histograms = entry['histograms']
+            for name, value in (('queue_wait_seconds', record.queue_wait), ('ttft_seconds', record.ttft),
+                                ('duration_seconds', record.duration),
+                                ('prompt_tokens', record.prompt_tokens),
+                                ('completion_tokens', record.completion_tokens)):
+                if value is not None:
+                    histograms[name].observe(value)
+            itl = histograms['itl_seconds']
+            for value in record.itl:
+                itl.observe(value)
+
+    def observe_stage(self, stage, seconds):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram(STAGE_BUCKETS)
+            histogram.observe(seconds)
+
+    def increment(self, name, route, amount=1):
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[route] = counter.get(route, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            models = {
+                model: {
+                    'requests': dict(entry['requests']),
+                    'histograms': {name: h.snapshot() for name, h in entry['histograms'].items()}
+                }
+                for model, entry in self._models.items()
+            }
+            stages = {stage: h.snapshot() for stage, h in self._stages.items()}
+            counters = {name: dict(counter) for name, counter in self._counters.items()}
+        return {'pid': os.getpid(), 'host': socket.gethostname(), 'time': time.time(), 'models': models,
+                'stages': stages, 'counters': counters}
+
+    def reset(self):
+        with self._lock:
+            self._models = {}
+            self._stages = {}
+            self._counters = {}
+
+
+registry = MetricsRegistry()
+
+
+def observe_stage(stage, seconds):
+    """记录一个处理阶段的耗时(秒)"""
+    registry.observe_stage(stage, seconds)
+
+
+def increment(name, route, amount=1):
+    """计数 name{route} 加 amount, 如 increment('chat_turns', 'fast_path')"""
+    registry.increment(name, route, amount)
+
+
+def add_hook(fn):
+    """注册全局钩子, fn(record) 在每次调用结束时执行"""
+    _hooks.append(fn)
+
+
+def remove_hook(fn):
+    if fn in _hooks:
+        _hooks.remove(fn)
+
+
+@contextmanager
+def request_hooks(*fns):
+    """
+    在 with 块内发起的调用结束时执行 fn(record)
+
+    用法:
+        samples = []
+        with request_hooks(samples.append):
+            agent.chat(...)
+    """
+    token = _context_hooks.set(_context_hooks.get() + fns)
+    try:
+        yield
+    finally:
+        _context_hooks.reset(token)
+
+
+def _merge_histogram(target, name, h):
+    t = target.get(name)
+    if t is None:
+        target[name] = {'buckets': list(h['buckets']), 'counts': list(h['counts']), 'sum': h['sum'],
+                        'count': h['count']}
+    else:
+        t['counts'] = [a + b for a, b in zip(t['counts'], h['counts'])]
+        t['sum'] += h['sum']
+        t['count'] += h['count']
+
+
+def merge_snapshots(snapshots):
+    """合并多个进程的快照"""
+    merged = {}
+    stages = {}
+    counters = {}
+    for snap in snapshots:
+        for stage, h in snap.get('stages', {}).items():
+            _merge_histogram(stages, stage, h)
+        for name, counter in snap.get('counters', {}).items():
+            target = counters.setdefault(name, {})
+            for label, count in counter.items():
+                target[label] = target.get(label, 0) + count
+        for model, entry in snap.get('models', {}).items():
+            target = merged.setdefault(model, {'requests': {}, 'histograms': {}})
+            for status, count in entry['requests'].items():
+                target['requests'][status] = target['requests'].get(status, 0) + count
+            for name, h in entry['histograms'].items():
+                _merge_histogram(target['histograms'], name, h)
+    return {'processes': len(snapshots), 'models': merged, 'stages': stages, 'counters': counters}
+
+
+def _describe(h):
+    return {
+        'count': h['count'],
+        'mean': h['sum'] / h['count'] if h['count'] else None,
+        'p50': _quantile(h, 0.5),
+        'p90': _quantile(h, 0.9),
+        'p99': _quantile(h, 0.99)
+    }
+
+
+def summarize(snapshot):
+    """把快照中的直方图转换为 count / mean / p50 / p90 / p99, 便于直接查看"""
+    models = {}
+    for model, entry in snapshot['models'].items():
+        summary = {'requests': entry['requests']}
+        for name, h in entry['histograms'].items():
+            summary[name] = _describe(h)
+        models[model] = summary
+    return models
+
+
+def summarize_stages(snapshot):
+    """各处理阶段耗时的 count / mean / p50 / p90 / p99"""
+    return {stage: _describe(h) for stage, h in snapshot.get('stages', {}).items()}
+
+
+def render_prometheus(snapshot, prefix='kllm'):
+    """输出 Prometheus 文本格式"""
+    lines = [f"# TYPE {prefix}_requests_total counter"]
+    for model, entry in snapshot['models'].items():
+        for status, count in entry['requests'].items():
+            lines.append(f'{prefix}_requests_total{{model="{model}",status="{status}"}} {count}')
+    for name, _ in _HISTOGRAMS:
+        metric = f"{prefix}_{name}"
+        lines.append(f"# TYPE {metric} histogram")
+        for model, entry in snapshot['models'].items():
+            h = entry['histograms'].get(name)
+            if h is None:
+                continue
+            cumulative = 0
+            for bound, count in zip(h['buckets'], h['counts']):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{model="{model}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{model="{model}",le="+Inf"}} {h["count"]}')
+            lines.append(f'{metric}_sum{{model="{model}"}} {h["sum"]}')
+            lines.append(f'{metric}_count{{model="{model}"}} {h["count"]}')
+    stages = snapshot.get('stages', {})
+    if stages:
+        metric = f"{prefix}_stage_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for stage, h in stages.items():
+            cumulative = 0
+            for bound, count in zip(h['buckets'], h['counts']):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {h["count"]}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {h["sum"]}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {h["count"]}')
+    for name, counter in snapshot.get('counters', {}).items():
+        metric = f"{prefix}_{name}_total"
+        lines.append(f"# TYPE {metric} counter")
+        for label, count in counter.items():
+            lines.append(f'{metric}{{route="{label}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+
+_KEY_PREFIX = 'kllm:metrics:'
+# 已退出进程的累计快照, 不带过期时间; 不在 _KEY_PREFIX 下, 不计入存活进程数
+_RETIRED_KEY = 'kllm:metrics-retired'
+_redis_clients = {}
+_last_publish = 0.0
+# 本进程的定期发布线程: (pid, 线程, 停止事件)
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def _redis(redis_url):
+    pid = os.getpid()
+    client = _redis_clients.get((redis_url, pid))
+    if client is None:
+        import redis
+        client = redis.Redis.from_url(redis_url, decode_responses=True)
+        _redis_clients[(redis_url, pid)] = client
+    return client
+
+
+def _process_key():
+    return f"{_KEY_PREFIX}{socket.gethostname()}:{os.getpid()}"
+
+
+def publish(redis_url, ttl=120, min_interval=5.0):
+    """
+    把本进程的快照写入Redis(供 collect 合并), min_interval 秒内重复调用直接跳过
+
+    ttl 内没有再次发布的进程(已退出的worker)会自动从汇总中消失
+    """
+    global _last_publish
+    now = time.time()
+    if now - _last_publish < min_interval:
+        return False
+    _last_publish = now
+    try:
+        _redis(redis_url).set(_process_key(), json.dumps(registry.snapshot()), ex=ttl)
+        return True
+    except Exception as e:
+        print(f"发布LLM指标失败: {e}")
+        return False
+
+
+def collect(redis_url=None):
+    """合并本进程、Redis中其他进程发布的快照以及已退出进程的累计, redis_url为None时只返回本进程"""
+    snapshots = [registry.snapshot()]
+    retired = None
+    if redis_url:
+        try:
+            client = _redis(redis_url)
+            own = _process_key()
+            keys = [key for key in client.scan_iter(match=_KEY_PREFIX + '*') if key != own]
+            raws = client.mget(keys + [_RETIRED_KEY])
+            snapshots += [json.loads(raw) for raw in raws[:-1] if raw]
+            retired = raws[-1]
+        except Exception as e:
+            print(f"读取LLM指标失败: {e}")
+    merged = merge_snapshots(snapshots + ([json.loads(retired)] if retired else []))
+    # processes 只计存活的进程
+    merged['processes'] = len(snapshots)
+    return merged
+
+
+def _retire(redis_url):
+    # 把本进程的最终快照并入已退出进程的累计并删除本进程的快照(WATCH保证并发退出时不丢失)
+    import redis
+    snapshot = registry.snapshot()
+    with _redis(redis_url).pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(_RETIRED_KEY)
+                raw = pipe.get(_RETIRED_KEY)
+                merged = merge_snapshots([json.loads(raw), snapshot] if raw else [snapshot])
+                pipe.multi()
+                pipe.set(_RETIRED_KEY, json.dumps(merged))
+                pipe.delete(_process_key())
+                pipe.execute()
+                return
+            except redis.WatchError:
+                continue
+
+
+def _publish_loop(redis_url, interval, stop):
+    while True:
+        publish(redis_url, ttl=max(interval * 6, 30), min_interval=0)
+        if stop.wait(interval):
+            return
+
+
+def start_publisher(redis_url, interval=5.0):
+    """
+    启动后台线程每 interval 秒发布一次本进程的快照, 与是否有任务无关; 同一进程重复调用不会启动第二个线程
+
+    快照的过期时间是 interval 的6倍(至少30秒), 进程存活期间会持续续期;
+    只有没有调用 stop_publisher 就退出的进程(如被强制杀死)才会在过期后从汇总中消失
+    """
+    global _publisher
+    with _publisher_lock:
+        if _publisher is not None and _publisher[0] == os.getpid():
+            return False
+        stop = threading.Event()
+        thread = threading.Thread(target=_publish_loop, args=(redis_url, interval, stop),
+                                  name='kllm-metrics-publisher', daemon=True)
+        _publisher = (os.getpid(), thread, stop)
+        thread.start()
+        return True
+
+
+def stop_publisher(redis_url):
+    """停止定期发布, 并把本进程的最终统计并入已退出进程的累计(进程退出前调用, 只对 start_publisher 启动过的进程生效)"""
+    global _publisher
+    with _publisher_lock:
+        publisher, _publisher = _publisher, None
+    if publisher is None or publisher[0] != os.getpid():
+        # 本进程没有在发布(或已经停止过), 避免重复计入累计
+        return False
+    publisher[2].set()
+    publisher[1].join(timeout=2)
+    try:
+        _retire(redis_url)
+        return True
+    except Exception as e:
+        print(f"写入LLM最终指标失败: {e}")
+        return False
+
+
+def _reset_after_fork():
+    """fork后子进程从空白统计开始, 避免重复计入父进程的数据"""
+    global registry, _last_publish, _publisher
+    registry = MetricsRegistry()
+    _last_publish = 0.0
+    # 父进程的发布线程不会带到子进程
+    _publisher = None
+    _redis_clients.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
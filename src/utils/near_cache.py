@@ -0,0 +1,193 @@
+"""
+近似重复输入的回复缓存
+
+压测和真实用户会反复问几乎相同的问题("你好，介绍一下你自己" / "你好,介绍下你自己")。
+NearDuplicateCache 按 (归一化输入, 最近上下文的短哈希) 缓存回复:
+- 归一化: NFKC、转小写、去掉标点和空白
+- 近似匹配: 输入切成字符n-gram, 计算MinHash签名并分段(LSH)建桶, 只和同桶的候选比较;
+  候选再用n-gram集合的精确Jaccard相似度复核, 并要求长度接近, MinHash的估计误差不会造成误命中
+- 上下文哈希必须完全一致, 同样的输入在不同对话情境下不会共用回复
+- 内存LRU + TTL, 淘汰条目时同时移出LSH桶
+"""
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict
+
+_PUNCT = re.compile(r'[\W_]+', re.UNICODE)
+# MinHash使用的梅森素数与哈希函数参数(固定种子, 各进程签名一致)
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def normalize(text):
+    """NFKC、小写、去掉标点与空白"""
+    return _PUNCT.sub('', unicodedata.normalize('NFKC', text or '').lower())
+
+
+def shingles(text, n=2):
+    """字符n-gram集合, 不足n个字符时整体作为一个元素"""
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def context_key(conversation_history, turns=2):
+    """最近 turns 条有效消息的短哈希"""
+    recent = [
+        f"{msg.get('role')}:{msg.get('content')}"
+        for msg in (conversation_history or [])
+        if msg.get('role') in ('user', 'assistant') and msg.get('content')
+    ][-turns:] if turns > 0 else []
+    return hashlib.sha1("\n".join(recent).encode('utf-8')).hexdigest()[:12]
+
+
+class _Entry:
+    __slots__ = ('reply', 'text', 'grams', 'bands', 'expires_at')
+
+    def __init__(self, reply, text, grams, bands, expires_at):
+        self.reply = reply
+        self.text = text
+        self.grams = grams
+        self.bands = bands
+        self.expires_at = expires_at
+
+
+class NearDuplicateCache:
+    """
+    参数:
+    - threshold: n-gram集合Jaccard相似度下限, 达到才算命中
+    - min_chars: 归一化后短于该长度的输入只接受完全相同
+    - ngram: n-gram长度
+    - num_perm / bands: MinHash签名长度与LSH分段数(每段 num_perm // bands 行)
+    - max_entries: LRU容量
+    - ttl: 过期时间(秒)
+    """
+
+    def __init__(self, threshold=0.85, min_chars=6, ngram=2, num_perm=64, bands=16, max_entries=2048,
+                 ttl=6 * 3600):
+        self.threshold = threshold
+        self.min_chars = min_chars
+        self.ngram = ngram
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.ttl = ttl
+        seeds = [hashlib.sha256(f"minhash:{i}".encode()).digest() for i in range(num_perm)]
+        self._params = [(int.from_bytes(seed[:8], 'big') % (_PRIME - 1) + 1, int.from_bytes(seed[8:16], 'big') % _PRIME)
+                        for seed in seeds]
+        self._entries = OrderedDict()  # (context, text) -> _Entry
+        self._buckets = {}  # (context, band, band_hash) -> set of entry keys
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'near_hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0}
+
+    def _signature(self, grams):
+        hashes = [zlib.crc32(gram.encode('utf-8')) for gram in grams]
+        return [min(((a * h + b) % _PRIME) & _MAX_HASH for h in hashes) for a, b in self._params]
+
+    def _band_keys(self, context, grams):
+        signature = self._signature(grams)
+        return [
+            (context, band, hash(tuple(signature[band * self.rows:(band + 1) * self.rows])))
+            for band in range(self.bands)
+        ]
+
+    def _remove_locked(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for band_key in entry.bands:
+            members = self._buckets.get(band_key)
+            if members is not None:
+                members.discard(key)
+                if not members:
+                    del self._buckets[band_key]
+
+    def get(self, user_input, conversation_history=None, context=None):
+        """
+        查找近似相同输入的缓存回复
+
+        参数:
+        - context: 上下文哈希, None时由 conversation_history 计算
+
+        返回:
+        - 缓存的回复, 未命中时返回None
+        """
+        text = normalize(user_input)
+        if not text:
+            return None
+        if context is None:
+            context = context_key(conversation_history)
+        now = time.time()
+        with self._lock:
+            key = (context, text)
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry.expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry.reply
+                self._remove_locked(key)
+        if len(text) < self.min_chars:
+            with self._lock:
+                self._stats['misses'] += 1
+            return None
+
+        grams = shingles(text, self.ngram)
+        band_keys = self._band_keys(context, grams)
+        with self._lock:
+            candidates = set()
+            for band_key in band_keys:
+                candidates.update(self._buckets.get(band_key, ()))
+            best, best_score = None, 0.0
+            for candidate in candidates:
+                entry = self._entries.get(candidate)
+                if entry is None or entry.expires_at <= now:
+                    continue
+                shorter, longer = sorted((len(text), len(entry.text)))
+                if shorter < longer * self.threshold:
+                    continue
+                score = len(grams & entry.grams) / len(grams | entry.grams)
+                if score >= self.threshold and score > best_score:
+                    best, best_score = candidate, score
+            if best is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(best)
+            self._stats['near_hits'] += 1
+            return self._entries[best].reply
+
+    def set(self, user_input, reply, conversation_history=None, context=None):
+        text = normalize(user_input)
+        if not text or not reply:
+            return
+        if context is None:
+            context = context_key(conversation_history)
+        grams = shingles(text, self.ngram)
+        band_keys = self._band_keys(context, grams) if len(text) >= self.min_chars else []
+        key = (context, text)
+        with self._lock:
+            self._remove_locked(key)
+            self._entries[key] = _Entry(reply, text, grams, band_keys, time.time() + self.ttl)
+            for band_key in band_keys:
+                self._buckets.setdefault(band_key, set()).add(key)
+            self._stats['sets'] += 1
+            while len(self._entries) > self.max_entries:
+                self._remove_locked(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._buckets.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['near_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['near_hits']) / lookups if lookups else 0.0
+        return stats
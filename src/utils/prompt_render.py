@@ -0,0 +1,247 @@
+"""
+对话历史的增量渲染缓存
+
+每轮聊天都要把历史消息编码进请求体并统计token数, 历史越长这部分重复工作越多。
+HistoryRenderer 按对话保存已渲染的状态:
+- body: 已渲染消息的JSON编码(每条消息后跟一个逗号), 可直接拼进请求体的 messages 数组
+- offsets / tokens: 每条消息在 body 中的结束位置与累计token数, 按预算选窗口时二分查找, 无需逐条累加
+- roles: 每条消息的角色首字母, 用于让窗口从user消息开始
+新增轮次时只编码和计数新增的消息并追加到状态末尾。
+
+状态保存在Redis(所有worker共享, 不在每个进程各存一份), Redis不可用或未配置时退化为进程内缓存。
+渲染过的最后一条消息的指纹不匹配(历史被清空或改写)时整体重建, 也可调用 invalidate() 主动失效。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from src.utils.tokens import count_tokens, message_overhead, tokenizer_name
+
+
+class RenderedHistory:
+    """
+    渲染好的一段历史消息, 可直接作为 call_api 的 history 参数
+
+    - body: 消息的JSON编码, 每条后跟逗号
+    - count: 消息条数
+    - tokens: token数(含chat模板开销)
+    """
+
+    __slots__ = ('body', 'count', 'tokens', '_digest')
+
+    def __init__(self, body, count, tokens):
+        self.body = body
+        self.count = count
+        self.tokens = tokens
+        self._digest = None
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def cache_key(self):
+        """响应缓存键中代表这段历史的部分"""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.body).hexdigest()
+        return self._digest
+
+    def messages(self):
+        """解码为消息列表(调试或非HTTP场景使用)"""
+        return json.loads(b'[' + self.body[:-1] + b']') if self.body else []
+
+
+# 仅当body长度等于读取时的长度才追加, 否则删除状态
+_APPEND_SCRIPT = """
+if redis.call('STRLEN', KEYS[2]) ~= tonumber(ARGV[1]) then
+    redis.call('DEL', KEYS[1], KEYS[2])
+    return 0
+end
+redis.call('APPEND', KEYS[2], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+redis.call('SET', KEYS[1], ARGV[3], 'EX', ARGV[4])
+return 1
+"""
+
+
+def _encode(msg):
+    return json.dumps({'role': msg['role'], 'content': msg['content']}, ensure_ascii=False).encode('utf-8') + b','
+
+
+def _fingerprint(messages, index):
+    if index <= 0:
+        return ''
+    msg = messages[index - 1]
+    return hashlib.sha1(f"{index}:{msg.get('role')}:{msg.get('content')}".encode('utf-8')).hexdigest()
+
+
+def _select(state, budget, step_ratio):
+    """在累计token数上选窗口起点, 规则同 tokens.history_window"""
+    tokens = state['tokens']
+    total = tokens[-1]
+    if budget <= 0:
+        return len(tokens) - 1
+    if total <= budget:
+        return 0
+    step = max(1, int(budget * step_ratio))
+    drop = ((total - budget) // step + 1) * step
+    start = bisect_left(tokens, drop)
+    found = state['roles'].find('u', start)
+    return found if found >= 0 else len(tokens) - 1
+
+
+class HistoryRenderer:
+    """
+    参数:
+    - redis_url: 共享状态的Redis地址, None表示只用进程内缓存
+    - ttl: Redis中状态的过期时间(秒)
+    - max_local: 进程内最多缓存的对话数
+    """
+
+    def __init__(self, redis_url=None, ttl=2 * 86400, max_local=64):
+        self.redis_url = redis_url
+        self.ttl = ttl
+        self.max_local = max_local
+        self._local = {}
+        self._lock = threading.Lock()
+        self._client = None
+        self._client_pid = None
+        self._unavailable_until = 0.0
+        self._stats = {'hits': 0, 'appends': 0, 'rebuilds': 0, 'rendered_messages': 0}
+
+    def _redis(self):
+        if self.redis_url is None or time.time() < self._unavailable_until:
+            return None
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            import redis
+            self._client = redis.Redis.from_url(self.redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+            self._client_pid = pid
+        return self._client
+
+    def _key(self, conversation_id):
+        return f"kagent:render:{conversation_id}"
+
+    def _load(self, conversation_id):
+        client = self._redis()
+        if client is not None:
+            try:
+                meta, body = client.pipeline().get(self._key(conversation_id)).get(
+                    self._key(conversation_id) + ':body').execute()
+                if meta is None or body is None:
+                    return None
+                state = json.loads(meta)
+                state['body'] = body
+                return state
+            except Exception as e:
+                print(f"读取渲染缓存失败, 30秒内使用进程内缓存: {e}")
+                self._unavailable_until = time.time() + 30
+        with self._lock:
+            state = self._local.get(conversation_id)
+            if state is None:
+                return None
+            state = dict(state)
+            state['tokens'] = list(state['tokens'])
+            state['offsets'] = list(state['offsets'])
+            return state
+
+    def _save(self, conversation_id, state, delta=None):
+        """保存状态; delta 不为None时Redis中只追加新增的body部分"""
+        client = self._redis()
+        if client is not None:
+            key = self._key(conversation_id)
+            meta = {k: v for k, v in state.items() if k != 'body'}
+            try:
+                if delta is None:
+                    pipe = client.pipeline()
+                    pipe.set(key, json.dumps(meta), ex=self.ttl)
+                    pipe.set(key + ':body', state['body'], ex=self.ttl)
+                    pipe.execute()
+                else:
+                    # 其他worker已先一步追加时长度对不上, 丢弃状态由下一轮重建, 避免重复追加
+                    client.eval(_APPEND_SCRIPT, 2, key, key + ':body', len(state['body']) - len(delta),
+                                delta, json.dumps(meta), self.ttl)
+                return
+            except Exception as e:
+                print(f"保存渲染缓存失败, 30秒内使用进程内缓存: {e}")
+                self._unavailable_until = time.time() + 30
+        with self._lock:
+            self._local.pop(conversation_id, None)
+            self._local[conversation_id] = state
+            while len(self._local) > self.max_local:
+                self._local.pop(next(iter(self._local)))
+
+    def invalidate(self, conversation_id):
+        """历史被改写后丢弃缓存"""
+        with self._lock:
+            self._local.pop(conversation_id, None)
+        client = self._redis()
+        if client is not None:
+            try:
+                client.delete(self._key(conversation_id), self._key(conversation_id) + ':body')
+            except Exception as e:
+                print(f"清除渲染缓存失败: {e}")
+
+    def render(self, conversation_id, messages, base=0, budget=None, step_ratio=0.25):
+        """
+        渲染 messages[base:] 中落在token预算内的最新部分
+
+        参数:
+        - messages: 对话的全部有效消息(只在末尾追加)
+        - base: 起始下标(之前的消息已被摘要覆盖)
+        - budget: 历史可用的token数, None表示不限
+
+        返回:
+        - RenderedHistory
+        """
+        state = self._load(conversation_id)
+        name = tokenizer_name()
+        valid = (
+            state is not None
+            and state.get('base') == base
+            and state.get('tokenizer') == name
+            and base <= state.get('count', -1) <= len(messages)
+            and state.get('anchor') == _fingerprint(messages, state['count'])
+        )
+        if not valid:
+            state = {'base': base, 'count': base, 'tokenizer': name, 'anchor': _fingerprint(messages, base),
+                     'tokens': [0], 'offsets': [0], 'roles': '', 'body': b''}
+        count = state['count']
+        if count < len(messages):
+            # 只渲染新增的消息
+            parts = []
+            tokens = state['tokens']
+            offsets = state['offsets']
+            roles = []
+            for msg in messages[count:]:
+                encoded = _encode(msg)
+                parts.append(encoded)
+                offsets.append(offsets[-1] + len(encoded))
+                tokens.append(tokens[-1] + count_tokens(msg['content']) + message_overhead)
+                roles.append('u' if msg['role'] == 'user' else 'a')
+            delta = b''.join(parts)
+            state['body'] = bytes(state['body']) + delta
+            state['roles'] += ''.join(roles)
+            state['count'] = len(messages)
+            state['anchor'] = _fingerprint(messages, len(messages))
+            self._save(conversation_id, state, delta if valid else None)
+            with self._lock:
+                self._stats['appends' if valid else 'rebuilds'] += 1
+                self._stats['rendered_messages'] += len(messages) - count
+        else:
+            with self._lock:
+                self._stats['hits'] += 1
+
+        start = _select(state, budget, step_ratio) if budget is not None else 0
+        offsets = state['offsets']
+        tokens = state['tokens']
+        body = bytes(state['body'][offsets[start]:offsets[-1]])
+        return RenderedHistory(body, len(offsets) - 1 - start, tokens[-1] - tokens[start])
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
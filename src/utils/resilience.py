@@ -0,0 +1,225 @@
+"""
+LLM调用的截止时间、重试预算与对冲请求
+
+- deadline(): 为一段代码(如一次Celery任务)设置截止时间, 其中所有LLM调用共享该截止时间,
+  嵌套时取更早的那个; 通过 contextvars 传递, 跨线程时需要显式取出 current_deadline() 传入
+- CancelScope / cancel_scope(): 可从其他线程取消的范围(如客户端离开后取消Celery任务),
+  取消时执行已注册的回调, 流式调用借此立即关闭上游连接; 同样通过 contextvars 传递
+- RetryBudget: 重试预算, 重试次数不超过请求数的固定比例, 避免后端故障时重试放大流量
+- HedgePolicy: 根据最近TTFT分位数计算对冲阈值, 首token超过阈值未到达时向另一后端再发一次
+"""
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+_deadline = contextvars.ContextVar('kllm_deadline', default=None)
+_cancel = contextvars.ContextVar('kllm_cancel', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """超过调用截止时间"""
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    设置截止时间
+
+    用法:
+        with deadline(45):
+            agent.chat(...)
+    """
+    at = time.monotonic() + seconds
+    outer = _deadline.get()
+    if outer is not None:
+        at = min(at, outer)
+    token = _deadline.set(at)
+    try:
+        yield at
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline():
+    """当前上下文的截止时间(time.monotonic()时刻), 未设置时返回None"""
+    return _deadline.get()
+
+
+def remaining(deadline_at, default=None):
+    """距离截止时间的剩余秒数; deadline_at 为None时返回default"""
+    if deadline_at is None:
+        return default
+    return deadline_at - time.monotonic()
+
+
+class CancelScope:
+    """
+    可取消范围
+
+    cancel() 可在任意线程调用, 依次执行已注册的回调(如关闭上游HTTP连接、唤醒等待中的消费者);
+    取消之后再注册的回调立即执行
+    """
+
+    def __init__(self):
+        self.reason = None
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason='cancelled'):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"取消回调执行失败: {e}")
+
+    def add_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def wait(self, timeout=None):
+        """等待被取消, 返回是否已取消"""
+        return self._event.wait(timeout)
+
+
+@contextmanager
+def cancel_scope(scope=None):
+    """
+    设置当前上下文的取消范围(嵌套时内层生效)
+
+    用法:
+        with cancel_scope() as scope:
+            for chunk in agent.chat_stream(...):
+                ...
+        # 其他线程调用 scope.cancel() 后, 流式调用立即关闭上游连接并结束
+    """
+    if scope is None:
+        scope = CancelScope()
+    token = _cancel.set(scope)
+    try:
+        yield scope
+    finally:
+        _cancel.reset(token)
+
+
+def current_cancel():
+    """当前上下文的取消范围, 未设置时返回None"""
+    return _cancel.get()
+
+
+class RetryBudget:
+    """
+    重试预算(令牌桶)
+
+    每个请求存入 ratio 个令牌, 每次重试/对冲消耗1个令牌;
+    另外每秒补充 min_per_second 个令牌, 保证低流量时也能重试
+
+    参数:
+    - ratio: 重试次数占请求数的比例上限
+    - min_per_second: 每秒最少允许的重试次数
+    - max_tokens: 令牌上限
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=1.0, max_tokens=20.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._stats = {'requests': 0, 'retries': 0, 'rejected': 0}
+
+    def _refill_locked(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def record_request(self):
+        with self._lock:
+            self._refill_locked()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+            self._stats['requests'] += 1
+
+    def try_spend(self):
+        """尝试消耗一次重试机会"""
+        with self._lock:
+            self._refill_locked()
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                self._stats['retries'] += 1
+                return True
+            self._stats['rejected'] += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['tokens'] = round(self._tokens, 2)
+            return stats
+
+
+class HedgePolicy:
+    """
+    对冲阈值: 最近TTFT样本的指定分位数, 不低于 min_delay
+
+    参数:
+    - percentile: 分位数, 如0.95表示首token慢于95%的请求时发起对冲
+    - min_delay: 最小对冲等待时间(秒)
+    - min_samples: 样本不足时不对冲
+    - window: 样本窗口大小
+    """
+
+    def __init__(self, percentile=0.95, min_delay=0.2, min_samples=20, window=500):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._stats = {'hedged': 0, 'hedge_wins': 0}
+
+    def observe(self, ttft):
+        with self._lock:
+            self._samples.append(ttft)
+
+    def threshold(self):
+        """返回当前对冲阈值(秒), 样本不足时返回None"""
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            ordered = sorted(self._samples)
+        value = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+        return max(self.min_delay, value)
+
+    def record(self, hedged, hedge_won):
+        with self._lock:
+            if hedged:
+                self._stats['hedged'] += 1
+            if hedge_won:
+                self._stats['hedge_wins'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['samples'] = len(self._samples)
+        stats['threshold'] = self.threshold()
+        return stats
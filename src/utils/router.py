@@ -0,0 +1,150 @@
+"""
+多vLLM后端路由
+
+在客户端内维护一组 openai形式 后端, 按在途请求数最少(least outstanding requests)选择后端:
+- 每次请求前 acquire, 结束后 release 并上报是否失败
+- 连续失败达到阈值的后端被摘除, 由后台健康检查线程探测恢复后重新加入
+- 所有后端都被摘除时仍选择一个最早可恢复的后端, 保证请求不会直接失败
+"""
+import itertools
+import os
+import threading
+import time
+
+import requests
+
+
+class Backend:
+    """单个后端的状态"""
+
+    __slots__ = ('url', 'outstanding', 'healthy', 'failures', 'ejected_at', 'total_requests', 'total_failures')
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0
+        self.ejected_at = None
+        self.total_requests = 0
+        self.total_failures = 0
+
+    def snapshot(self):
+        return {
+            'url': self.url,
+            'outstanding': self.outstanding,
+            'healthy': self.healthy,
+            'failures': self.failures,
+            'total_requests': self.total_requests,
+            'total_failures': self.total_failures
+        }
+
+
+class BackendRouter:
+    """
+    最少在途请求路由器
+
+    参数:
+    - urls: 后端地址列表, 如 ['http://localhost:8080', 'http://10.0.0.2:8080']
+    - max_failures: 连续失败多少次后摘除
+    - health_interval: 健康检查间隔(秒)
+    - health_path: 健康检查路径
+    - health_timeout: 健康检查超时(秒)
+    """
+
+    def __init__(self, urls, max_failures=3, health_interval=5, health_path='/v1/models', health_timeout=2):
+        if not urls:
+            raise ValueError("至少需要一个后端地址")
+        self.backends = [Backend(url) for url in urls]
+        self.max_failures = max_failures
+        self.health_interval = health_interval
+        self.health_path = health_path
+        self.health_timeout = health_timeout
+        self._lock = threading.Lock()
+        self._rr = itertools.count()
+        self._health_pid = None
+        self._stop = threading.Event()
+
+    def acquire(self, exclude=None):
+        """
+        选择在途请求最少的健康后端并占用一个请求名额
+
+        参数:
+        - exclude: 尽量避开的后端(如对冲请求时避开首个后端)
+        """
+        self._ensure_health_thread()
+        with self._lock:
+            candidates = [b for b in self.backends if b.healthy and b is not exclude]
+            if not candidates:
+                candidates = [b for b in self.backends if b.healthy] or self._fallback_candidates()
+            # 在途数相同时轮询, 避免总是压到列表第一个后端
+            offset = next(self._rr)
+            count = len(candidates)
+            backend = min(
+                (candidates[(offset + i) % count] for i in range(count)),
+                key=lambda b: b.outstanding
+            )
+            backend.outstanding += 1
+            backend.total_requests += 1
+            return backend
+
+    def release(self, backend, failed=False):
+        """释放请求名额并记录结果"""
+        with self._lock:
+            backend.outstanding -= 1
+            if failed:
+                backend.failures += 1
+                backend.total_failures += 1
+                if backend.healthy and backend.failures >= self.max_failures:
+                    backend.healthy = False
+                    backend.ejected_at = time.time()
+                    print(f"后端已摘除: {backend.url} (连续失败 {backend.failures} 次)")
+            else:
+                backend.failures = 0
+
+    def stats(self):
+        with self._lock:
+            return [b.snapshot() for b in self.backends]
+
+    def close(self):
+        self._stop.set()
+
+    def _fallback_candidates(self):
+        """全部后端不可用时, 选择最早被摘除的后端继续尝试"""
+        earliest = min(self.backends, key=lambda b: b.ejected_at or 0)
+        return [earliest]
+
+    def _ensure_health_thread(self):
+        """按进程启动健康检查线程(fork后子进程需要重新启动)"""
+        pid = os.getpid()
+        if self._health_pid == pid or self.health_interval <= 0:
+            return
+        with self._lock:
+            if self._health_pid == pid:
+                return
+            self._health_pid = pid
+            self._stop = threading.Event()
+        thread = threading.Thread(target=self._health_loop, name='kllm-health', daemon=True)
+        thread.start()
+
+    def _health_loop(self):
+        session = requests.Session()
+        while not self._stop.wait(self.health_interval):
+            for backend in self.backends:
+                ok = self._probe(session, backend)
+                with self._lock:
+                    if ok and not backend.healthy:
+                        backend.healthy = True
+                        backend.failures = 0
+                        backend.ejected_at = None
+                        print(f"后端已恢复: {backend.url}")
+                    elif not ok and backend.healthy:
+                        backend.healthy = False
+                        backend.ejected_at = time.time()
+                        print(f"后端健康检查失败, 已摘除: {backend.url}")
+
+    def _probe(self, session, backend):
+        try:
+            response = session.get(f"{backend.url}{self.health_path}", timeout=self.health_timeout)
+            return response.status_code < 500
+        except requests.RequestException:
+            return False
@@ -0,0 +1,298 @@
+"""
+相同请求合并(single-flight)
+
+多个完全相同的LLM请求同时在途时, 只向上游发起一次调用, 其余请求等待并共享结果:
+- SingleFlight: 进程内合并, 流式请求由后台线程拉取上游, 所有消费者从头回放已产生的token后继续跟随
+- RedisSingleFlight: 跨worker合并, 通过 SET NX 选出leader, leader把token追加到Redis Stream,
+  其他worker的follower从头读取该Stream
+
+流式消费者可以通过 cancel_scope() 被其他线程取消; 最后一个消费者离开时立即关闭上游连接, 不等下一个token到达
+"""
+import json
+import os
+import threading
+import time
+import uuid
+
+import sys
+sys.path.append('/mnt/projects/llm-server')
+from src.utils.resilience import CancelScope, cancel_scope, current_cancel
+
+
+class _Flight:
+    """一次在途调用的共享状态"""
+
+    __slots__ = ('cond', 'chunks', 'done', 'result', 'subscribers', 'cancelled', 'upstream')
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.done = False
+        self.result = None
+        self.subscribers = 0
+        self.cancelled = False
+        # 上游拉取线程的取消范围, 所有消费者离开时取消
+        self.upstream = CancelScope()
+
+
+class SingleFlight:
+    """进程内请求合并"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._streams = {}
+        self._stats = {'upstream_calls': 0, 'coalesced': 0}
+
+    def call(self, key, fn):
+        """
+        非流式合并: 相同key在途时等待leader结果
+
+        参数:
+        - key: 请求键
+        - fn: 无参函数, 实际发起上游调用
+        """
+        with self._lock:
+            flight = self._calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._calls[key] = flight
+                self._stats['upstream_calls'] += 1
+            else:
+                self._stats['coalesced'] += 1
+
+        if not leader:
+            with flight.cond:
+                while not flight.done:
+                    flight.cond.wait()
+                return flight.result
+
+        result = None
+        try:
+            result = fn()
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            with flight.cond:
+                flight.result = result
+                flight.done = True
+                flight.cond.notify_all()
+
+    def stream(self, key, factory):
+        """
+        流式合并: 上游只拉取一次, 每个消费者都能拿到完整token序列
+
+        参数:
+        - key: 请求键
+        - factory: 无参函数, 返回上游token生成器
+
+        所有消费者都退出(或被当前上下文的 cancel_scope 取消)后, 立即取消上游并关闭上游生成器
+        """
+        with self._lock:
+            flight = self._streams.get(key)
+            if flight is None or flight.cancelled:
+                flight = _Flight()
+                self._streams[key] = flight
+                self._stats['upstream_calls'] += 1
+                threading.Thread(target=self._pump, args=(key, flight, factory), daemon=True).start()
+            else:
+                self._stats['coalesced'] += 1
+            flight.subscribers += 1
+
+        scope = current_cancel()
+
+        def wake():
+            with flight.cond:
+                flight.cond.notify_all()
+
+        if scope is not None:
+            scope.add_callback(wake)
+        index = 0
+        try:
+            while True:
+                with flight.cond:
+                    while index >= len(flight.chunks) and not flight.done:
+                        if scope is not None and scope.cancelled:
+                            return
+                        flight.cond.wait()
+                    pending = flight.chunks[index:]
+                    done = flight.done
+                index += len(pending)
+                for chunk in pending:
+                    yield chunk
+                if done and index >= len(flight.chunks):
+                    return
+                if scope is not None and scope.cancelled:
+                    return
+        finally:
+            if scope is not None:
+                scope.remove_callback(wake)
+            with self._lock:
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.done
+                if abandoned:
+                    flight.cancelled = True
+            if abandoned:
+                flight.upstream.cancel('abandoned')
+
+    def _pump(self, key, flight, factory):
+        """后台拉取上游流并广播给所有消费者"""
+        generator = None
+        try:
+            # 上游生成器在本线程内通过 current_cancel() 取到 flight.upstream
+            with cancel_scope(flight.upstream):
+                generator = factory()
+                for chunk in generator:
+                    with flight.cond:
+                        flight.chunks.append(chunk)
+                        flight.cond.notify_all()
+                    if flight.cancelled:
+                        break
+        except Exception as e:
+            print(f"合并流式请求失败: {e}")
+        finally:
+            if generator is not None:
+                generator.close()
+            with self._lock:
+                if self._streams.get(key) is flight:
+                    del self._streams[key]
+            with flight.cond:
+                flight.done = True
+                flight.cond.notify_all()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+class RedisSingleFlight:
+    """
+    跨worker请求合并
+
+    参数:
+    - redis_url: Redis地址
+    - lock_ttl: leader锁过期时间(秒), 应大于单次生成的最长耗时
+    - linger: 完成后结果Stream保留时间(秒), 供慢一步的follower读完
+    - idle_timeout: follower在多久没有新token且leader锁消失后判定leader已失效(秒)
+    """
+
+    PREFIX = 'kllm:sf:'
+
+    def __init__(self, redis_url, lock_ttl=120, linger=30, idle_timeout=5):
+        self.redis_url = redis_url
+        self.lock_ttl = lock_ttl
+        self.linger = linger
+        self.idle_timeout = idle_timeout
+        self._client = None
+        self._client_pid = None
+
+    def _redis(self):
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            import redis
+            self._client = redis.Redis.from_url(self.redis_url, decode_responses=True)
+            self._client_pid = pid
+        return self._client
+
+    def _keys(self, key):
+        return f"{self.PREFIX}{key}:lock", f"{self.PREFIX}{key}:stream"
+
+    def _acquire(self, lock_key, stream_key):
+        client = self._redis()
+        token = uuid.uuid4().hex
+        if client.set(lock_key, token, nx=True, ex=self.lock_ttl):
+            # 清理上一次同key调用残留的结果
+            client.delete(stream_key)
+            return token
+        return None
+
+    def _finish(self, lock_key, stream_key, fields):
+        client = self._redis()
+        pipe = client.pipeline()
+        pipe.xadd(stream_key, fields)
+        pipe.expire(stream_key, self.linger)
+        pipe.delete(lock_key)
+        pipe.execute()
+
+    def _follow(self, lock_key, stream_key):
+        """从头读取leader写入的Stream, 产出 (字段, 是否结束); leader失效时产出 (None, True)"""
+        client = self._redis()
+        last_id = '0'
+        idle_since = time.time()
+        while True:
+            response = client.xread({stream_key: last_id}, block=1000, count=256)
+            if response:
+                idle_since = time.time()
+                for entry_id, fields in response[0][1]:
+                    last_id = entry_id
+                    yield fields, 'done' in fields
+                    if 'done' in fields:
+                        return
+            elif time.time() - idle_since > self.idle_timeout and not client.exists(lock_key):
+                yield None, True
+                return
+
+    def call(self, key, fn):
+        """
+        leader出错或返回None(调用失败)时结束标记带 error 字段, follower不采用该结果, 自己调用
+        """
+        lock_key, stream_key = self._keys(key)
+        if self._acquire(lock_key, stream_key):
+            fields = {'done': '1', 'error': 'exception'}
+            try:
+                result = fn()
+                if result is None:
+                    fields = {'done': '1', 'error': 'empty'}
+                else:
+                    fields = {'done': '1', 'result': json.dumps(result, ensure_ascii=False)}
+                return result
+            finally:
+                self._finish(lock_key, stream_key, fields)
+
+        for fields, done in self._follow(lock_key, stream_key):
+            if fields is None or 'error' in fields:
+                # leader失效或失败, 自己调用
+                return fn()
+            if done:
+                return json.loads(fields['result'])
+
+    def stream(self, key, factory):
+        """
+        leader的结束标记区分三种结局: 正常结束只有 done; 上游出错(异常或产出None)带 error;
+        leader的消费方提前关闭(取消或截断)带 abandoned。
+        follower遇到后两者(或leader失效)时: 尚未输出则自己发起调用, 已经输出则产出None(与kllm的失败约定一致)表示回复不完整
+        """
+        lock_key, stream_key = self._keys(key)
+        if self._acquire(lock_key, stream_key):
+            client = self._redis()
+            # 生成器被提前关闭时保持 abandoned
+            ending = {'abandoned': '1'}
+            error = None
+            try:
+                for chunk in factory():
+                    if chunk is None:
+                        error = 'upstream'
+                    else:
+                        client.xadd(stream_key, {'chunk': chunk})
+                    yield chunk
+                ending = {'error': error} if error else {}
+            except Exception as e:
+                ending = {'error': type(e).__name__}
+                raise
+            finally:
+                self._finish(lock_key, stream_key, {'done': '1', **ending})
+            return
+
+        emitted = False
+        for fields, done in self._follow(lock_key, stream_key):
+            if fields is None or 'error' in fields or 'abandoned' in fields:
+                if not emitted:
+                    yield from factory()
+                else:
+                    yield None
+                return
+            if 'chunk' in fields:
+                emitted = True
+                yield fields['chunk']
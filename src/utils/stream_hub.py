@@ -0,0 +1,303 @@
+"""
+流式增量的异步推送
+
+轮询 /task/{task_id} 时每个客户端每次请求都要读取Celery结果后端和增量Stream, 客户端越多读得越频繁。
+StreamHub 在API进程的事件循环里用一个asyncio Redis连接读取所有被订阅任务的增量Stream:
+- 每轮一条 XREAD 同时读取全部被订阅的Stream(最多阻塞 block_ms 毫秒), 新条目分发给该任务的所有订阅,
+  同一任务有多个订阅(如同一回复在多个页面打开)时也只读取一次; 订阅数量只受内存限制, 不占用线程
+- 每个订阅的缓冲队列有上限, 读得慢的客户端队列满后不再接收分发, 之后自行按偏移量从Stream补读(XRANGE),
+  不会拖慢其他订阅也不会无限占用内存; 计数 stream_hub{route=lagging}
+- 订阅期间由 StreamHub 用一条管道为所有被订阅任务续期客户端心跳(见 cancel), 客户端断开后不再续期,
+  worker按 STREAM_POLL_TIMEOUT_SECONDS 判断客户端已离开; 客户端在此之前重连可以从断点继续
+- Redis不可用时等待 retry_delay 秒后重试, 订阅保持不变
+"""
+import asyncio
+import json
+import os
+import time
+
+import sys
+sys.path.append('/mnt/projects/llm-server')
+from src.utils import cancel, metrics
+from src.utils.stream_store import entry_seq, parse_entries, stream_key
+
+# 状态共用的Redis地址: KAGENT_REDIS_URL, 未设置时取 KLLM_REDIS_URL(与kllm一致)
+redis_url = os.environ.get('KAGENT_REDIS_URL') or os.environ.get('KLLM_REDIS_URL', 'redis://localhost:6379/0')
+# 每条 XREAD 最多阻塞的毫秒数, 也是新订阅最长的等待时间
+block_ms = int(os.environ.get('STREAM_HUB_BLOCK_MS', '50'))
+# 每个订阅最多缓冲的批次数(每次XREAD分发一批), 超过后该订阅改为自行补读
+queue_size = int(os.environ.get('STREAM_HUB_QUEUE_SIZE', '64'))
+# 没有新增量时保活的间隔(秒), 以及最长的空闲时间(秒)
+ping_interval = float(os.environ.get('STREAM_SSE_PING_SECONDS', '15'))
+idle_timeout = float(os.environ.get('STREAM_SSE_IDLE_SECONDS', '120'))
+# 续期客户端心跳的间隔(秒), 小于心跳过期时间
+heartbeat_interval = max(cancel.stream_poll_timeout / 3, 1.0)
+retry_delay = 1.0
+
+
+def format_event(event, data, event_id=None):
+    """按 text/event-stream 格式编码一条事件, data 编码为JSON"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+
+class Subscription:
+    """一个客户端对一个任务增量Stream的订阅, 由 StreamHub.subscribe 创建"""
+
+    def __init__(self, hub, task_id, offset):
+        self.hub = hub
+        self.task_id = task_id
+        self.offset = offset
+        self.status = 'streaming'
+        self.lagging = False
+        self._queue = asyncio.Queue(queue_size)
+
+    def _deliver(self, entries):
+        if self.lagging:
+            return
+        try:
+            self._queue.put_nowait(entries)
+        except asyncio.QueueFull:
+            # 客户端读得慢, 不再缓冲, 下次读取时从Stream补读
+            self.lagging = True
+            metrics.increment('stream_hub', 'lagging')
+
+    def _drain(self):
+        entries = []
+        while not self._queue.empty():
+            entries += self._queue.get_nowait()
+        return entries
+
+    async def next(self, timeout=None):
+        """
+        等待偏移量之后的新增量
+
+        参数:
+        - timeout: 最多等待的秒数, None表示一直等待
+
+        返回:
+        - {'chunks': 新增的段, 'offset': 新的偏移量, 'status': streaming / completed / cancelled / error};
+          超时或补读失败时返回None
+        """
+        entries = []
+        if self.lagging:
+            # 先取消标记再补读: 补读期间分发进来的条目与补读结果重复的部分按序号跳过
+            self.lagging = False
+            self._drain()
+            try:
+                entries = await self.hub.fetch(self.task_id, self.offset)
+            except Exception as e:
+                print(f"补读流式增量失败: {e}")
+                self.lagging = True
+                return None
+        if not entries:
+            try:
+                entries = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        entries += self._drain()
+        result = parse_entries(entries, self.offset)
+        self.offset = result['offset']
+        self.status = result['status']
+        return result
+
+
+class StreamHub:
+    """
+    在当前事件循环中读取并分发增量Stream; 第一个订阅创建时启动读取循环, 没有订阅时循环退出
+
+    用法:
+        sub = hub.subscribe(task_id, offset)
+        try:
+            result = await sub.next(timeout=15)
+        finally:
+            hub.unsubscribe(sub)
+    """
+
+    def __init__(self, url=None, block=None):
+        self.url = url or redis_url
+        self.block = block_ms if block is None else block
+        self._subs = {}
+        # 各任务下一次XREAD的起点(已读取的最大序号)
+        self._cursors = {}
+        self._client = None
+        self._runner = None
+        self._beat_at = 0.0
+        # 新订阅、尚未续期心跳的任务
+        self._fresh = set()
+
+    def _redis(self):
+        if self._client is None:
+            import redis.asyncio
+            # 读取超时要大于XREAD的阻塞时间
+            self._client = redis.asyncio.Redis.from_url(self.url, decode_responses=True,
+                                                        socket_timeout=self.block / 1000 + 5,
+                                                        socket_connect_timeout=0.5)
+        return self._client
+
+    @property
+    def subscriptions(self):
+        return sum(len(subs) for subs in self._subs.values())
+
+    def subscribe(self, task_id, offset=0):
+        """订阅任务在 offset(已读取的段数)之后的增量, 需在事件循环中调用"""
+        sub = Subscription(self, task_id, offset)
+        if task_id not in self._subs:
+            self._subs[task_id] = set()
+            self._fresh.add(task_id)
+        self._subs[task_id].add(sub)
+        cursor = self._cursors.get(task_id)
+        if cursor is None:
+            self._cursors[task_id] = offset
+        elif offset < cursor:
+            # 起点早于已读取位置的订阅(如断线重连)先自行补读, 之后再接收分发
+            sub.lagging = True
+        if self._runner is None or self._runner.done():
+            self._runner = asyncio.get_running_loop().create_task(self._run())
+        return sub
+
+    def unsubscribe(self, sub):
+        subs = self._subs.get(sub.task_id)
+        if subs is None:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self._subs[sub.task_id]
+            self._cursors.pop(sub.task_id, None)
+
+    async def read(self, task_id, offset=0):
+        """
+        读取 offset 之后的增量并续期客户端心跳, 只需一次往返
+
+        返回:
+        - 同 stream_store.read: Stream不存在时status为None, Redis不可用时返回None
+        """
+        key = stream_key(task_id)
+        try:
+            pipe = self._redis().pipeline(transaction=False)
+            pipe.xrange(key, min=f"(0-{offset}")
+            pipe.exists(key)
+            if cancel.stream_poll_timeout > 0:
+                cancel.heartbeat(pipe, task_id)
+            entries, exists = (await pipe.execute())[:2]
+        except Exception as e:
+            print(f"读取流式增量失败: {e}")
+            return None
+        if not entries and not exists:
+            return {'chunks': [], 'offset': offset, 'status': None}
+        return parse_entries(entries, offset)
+
+    async def wait(self, task_id, offset, timeout):
+        """等待 offset 之后的新增量(长轮询用), 超时返回None"""
+        sub = self.subscribe(task_id, offset)
+        try:
+            return await sub.next(timeout)
+        finally:
+            self.unsubscribe(sub)
+
+    async def fetch(self, task_id, offset):
+        """读取 offset 之后的全部条目(读得慢的订阅补读用)"""
+        return await self._redis().xrange(stream_key(task_id), min=f"(0-{offset}")
+
+    async def _beat(self):
+        # 每 heartbeat_interval 秒续期全部被订阅的任务, 其间只续期新订阅的任务
+        if cancel.stream_poll_timeout <= 0:
+            return
+        if time.monotonic() >= self._beat_at:
+            task_ids = list(self._subs)
+            self._beat_at = time.monotonic() + heartbeat_interval
+        else:
+            task_ids = [task_id for task_id in self._fresh if task_id in self._subs]
+        self._fresh.clear()
+        if not task_ids:
+            return
+        pipe = self._redis().pipeline(transaction=False)
+        for task_id in task_ids:
+            cancel.heartbeat(pipe, task_id)
+        await pipe.execute()
+
+    def _dispatch(self, task_id, entries):
+        last = entry_seq(entries[-1][0])
+        if task_id in self._cursors:
+            self._cursors[task_id] = max(self._cursors[task_id], last)
+        for sub in self._subs.get(task_id, ()):
+            if last > sub.offset:
+                sub._deliver(entries)
+
+    async def _run(self):
+        while self._subs:
+            tasks = {stream_key(task_id): task_id for task_id in self._cursors}
+            streams = {key: f"0-{self._cursors[task_id]}" for key, task_id in tasks.items()}
+            try:
+                await self._beat()
+                response = await self._redis().xread(streams, block=self.block)
+            except Exception as e:
+                print(f"读取流式增量失败, {retry_delay}秒后重试: {e}")
+                await asyncio.sleep(retry_delay)
+                continue
+            for key, entries in response or []:
+                if entries and tasks[key] in self._subs:
+                    self._dispatch(tasks[key], entries)
+
+    async def close(self):
+        if self._runner is not None:
+            self._runner.cancel()
+            self._runner = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# API进程共用的实例
+hub = StreamHub()
+
+
+async def follow(task_id, offset=0, finished=None):
+    """
+    跟随任务的增量直到结束(SSE与WebSocket共用)
+
+    参数:
+    - offset: 已读取的段数
+    - finished: 可选的 finished(task_id) -> (状态, 最终回答), 任务未结束时返回None; 在线程池中调用,
+      用于任务已结束而增量Stream不存在(写入失败或已过期)时按最终结果结束
+
+    产出:
+    - (事件, 数据, 偏移量): ('delta', {'text': 新增文本}, offset) / ('done', {'status': 状态}, offset);
+      没有新增量时每 ping_interval 秒产出一次 ('ping', None, None); 空闲超过 idle_timeout 秒时以 timeout 结束
+    """
+    sub = hub.subscribe(task_id, offset)
+    idle_since = time.monotonic()
+    # 首次等待较短: 任务可能早已结束而增量Stream已过期
+    wait = 1.0
+    try:
+        while True:
+            result = await sub.next(timeout=wait)
+            if result is None:
+                wait = ping_interval
+                state = None
+                if finished is not None:
+                    state = await asyncio.get_running_loop().run_in_executor(None, finished, task_id)
+                if state is not None:
+                    status, answer = state
+                    if sub.offset == 0 and answer:
+                        yield 'delta', {'text': answer}, None
+                    yield 'done', {'status': status}, None
+                    return
+                if time.monotonic() - idle_since > idle_timeout:
+                    yield 'done', {'status': 'timeout'}, None
+                    return
+                yield 'ping', None, None
+                continue
+            idle_since = time.monotonic()
+            if result['chunks']:
+                yield 'delta', {'text': ''.join(result['chunks'])}, result['offset']
+            if result['status'] != 'streaming':
+                yield 'done', {'status': result['status']}, result['offset']
+                return
+    finally:
+        # 只取消订阅, 不取消任务: 心跳过期前重连可以从断点继续
+        hub.unsubscribe(sub)
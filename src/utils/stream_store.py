@@ -0,0 +1,222 @@
+"""
+流式回复的逐段传输
+
+流式任务原先每产生一段就把完整的 current_text 和 chunks 写进Celery结果后端, 写入量随回复长度平方增长,
+每次轮询也要反序列化整个结果。现在改为:
+- worker把每段增量追加到任务专属的Redis Stream(kchat:stream:{task_id}:tokens), 第n段的条目ID为 0-n,
+  结束时再追加一个 done 条目(ID为最后一段之后), 写入量与回复长度成正比
+- Celery结果后端只在开始时写入一次 STREAMING 状态, 结束时保存精简的最终结果
+- 读取方按偏移量(已读取的段数)读取之后的增量, 偏移量同时可作为SSE的事件ID
+- StreamWriter 把相邻的增量合并成一段再写入: 首段立即写入(TTFT不变), 之后按时间间隔、缓冲字节数或流结束
+  三者先到者写入; 写入次数与合并延迟记入 metrics(stream_flushes{route=原因}、阶段 stream_flush_delay / stream_flush)
+"""
+import os
+import threading
+import time
+
+import sys
+sys.path.append('/mnt/projects/llm-server')
+from src.utils import metrics
+
+# 状态共用的Redis地址: KAGENT_REDIS_URL, 未设置时取 KLLM_REDIS_URL(与kllm一致)
+redis_url = os.environ.get('KAGENT_REDIS_URL') or os.environ.get('KLLM_REDIS_URL', 'redis://localhost:6379/0')
+# 增量Stream的保留时间(秒), 结束后客户端仍可在此期间补读
+stream_ttl = int(os.environ.get('STREAM_TTL_SECONDS', '3600'))
+# 增量合并: 最早一段缓冲超过该毫秒数即写入(0表示每段都立即写入), 或缓冲超过该字节数即写入
+flush_interval = float(os.environ.get('STREAM_FLUSH_INTERVAL_MS', '50')) / 1000
+flush_bytes = int(os.environ.get('STREAM_FLUSH_BYTES', '512'))
+
+_client = None
+_client_pid = None
+# Redis不可用时暂停写入的截止时刻, 避免每段输出都等待连接失败
+_unavailable_until = 0.0
+
+
+def _redis():
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        import redis
+        _client = redis.Redis.from_url(redis_url, decode_responses=True, socket_timeout=5,
+                                       socket_connect_timeout=0.5)
+        _client_pid = pid
+    return _client
+
+
+def stream_key(task_id):
+    """任务的增量Stream键名"""
+    return f"kchat:stream:{task_id}:tokens"
+
+
+def append(task_id, index, delta):
+    """
+    追加第 index 段增量(从1开始), 返回是否成功
+
+    第一段写入时设置过期时间
+    """
+    global _unavailable_until
+    if time.time() < _unavailable_until:
+        return False
+    key = stream_key(task_id)
+    try:
+        pipe = _redis().pipeline(transaction=False)
+        pipe.xadd(key, {'d': delta}, id=f"0-{index}")
+        if index == 1:
+            pipe.expire(key, stream_ttl)
+        pipe.execute()
+        return True
+    except Exception as e:
+        print(f"写入流式增量失败, 30秒内不再尝试: {e}")
+        _unavailable_until = time.time() + 30
+        return False
+
+
+def finish(task_id, count, status='completed'):
+    """在第 count 段之后追加结束标记, status 为 completed / cancelled / error"""
+    if time.time() < _unavailable_until:
+        return False
+    key = stream_key(task_id)
+    try:
+        pipe = _redis().pipeline(transaction=False)
+        pipe.xadd(key, {'done': status}, id=f"0-{count + 1}")
+        pipe.expire(key, stream_ttl)
+        pipe.execute()
+        return True
+    except Exception as e:
+        print(f"写入流式结束标记失败: {e}")
+        return False
+
+
+def read(task_id, offset=0, block=None):
+    """
+    读取偏移量之后的增量
+
+    参数:
+    - offset: 已读取的段数
+    - block: 没有新内容时最多等待的毫秒数, None表示不等待
+
+    返回:
+    - {'chunks': 新增的段, 'offset': 新的偏移量, 'status': streaming / completed / cancelled / error};
+      Stream不存在(尚未开始或已过期)时status为None; Redis不可用时返回None
+    """
+    key = stream_key(task_id)
+    try:
+        client = _redis()
+        if block is None:
+            entries = client.xrange(key, min=f"(0-{offset}")
+        else:
+            response = client.xread({key: f"0-{offset}"}, block=block)
+            entries = response[0][1] if response else []
+        if not entries and not client.exists(key):
+            return {'chunks': [], 'offset': offset, 'status': None}
+    except Exception as e:
+        print(f"读取流式增量失败: {e}")
+        return None
+    return parse_entries(entries, offset)
+
+
+def entry_seq(entry_id):
+    """条目ID 0-n 中的序号n"""
+    return int(entry_id.rsplit('-', 1)[1])
+
+
+def parse_entries(entries, offset):
+    """
+    把Stream条目整理成读取结果, 跳过序号不大于 offset 的条目(已读取过)
+
+    返回:
+    - {'chunks': 新增的段, 'offset': 新的偏移量, 'status': streaming / completed / cancelled / error}
+    """
+    chunks = []
+    status = 'streaming'
+    for entry_id, fields in entries:
+        if 'done' in fields:
+            status = fields['done']
+            break
+        seq = entry_seq(entry_id)
+        if seq <= offset:
+            continue
+        chunks.append(fields['d'])
+        offset = seq
+    return {'chunks': chunks, 'offset': offset, 'status': status}
+
+
+class StreamWriter:
+    """
+    合并相邻增量后追加到任务的Stream
+
+    首段立即写入; 之后的增量先缓冲, 满足以下任一条件即合并成一段写入:
+    - 缓冲中最早的增量已等待 interval 秒(由后台线程计时, 上游停顿时缓冲内容也不会滞留)
+    - 缓冲超过 max_bytes 字节
+    - 流结束(close)
+    """
+
+    def __init__(self, task_id, interval=None, max_bytes=None):
+        self.task_id = task_id
+        self.interval = flush_interval if interval is None else interval
+        self.max_bytes = flush_bytes if max_bytes is None else max_bytes
+        self.count = 0
+        self._buffer = []
+        self._size = 0
+        self._since = None
+        self._closed = False
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def write(self, delta):
+        if not delta:
+            return
+        with self._cond:
+            self._buffer.append(delta)
+            self._size += len(delta.encode('utf-8'))
+            if self._since is None:
+                self._since = time.monotonic()
+            if self.count == 0:
+                self._flush_locked('first')
+            elif self.interval <= 0:
+                self._flush_locked('immediate')
+            elif self._size >= self.max_bytes:
+                self._flush_locked('bytes')
+            elif self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            else:
+                self._cond.notify()
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                if self._since is None:
+                    self._cond.wait()
+                    continue
+                wait = self._since + self.interval - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                self._flush_locked('interval')
+
+    def _flush_locked(self, reason):
+        if not self._buffer:
+            return
+        delay = time.monotonic() - self._since
+        start = time.perf_counter()
+        self.count += 1
+        # 写入失败也推进序号, 保证之后的条目ID递增
+        append(self.task_id, self.count, ''.join(self._buffer))
+        metrics.observe_stage('stream_flush', time.perf_counter() - start)
+        metrics.observe_stage('stream_flush_delay', delay)
+        metrics.increment('stream_flushes', reason)
+        self._buffer = []
+        self._size = 0
+        self._since = None
+
+    def close(self, status='completed'):
+        """写入剩余的缓冲和结束标记, 返回写入的段数; 重复调用时不再写入"""
+        with self._cond:
+            if self._closed:
+                return self.count
+            self._flush_locked('end')
+            self._closed = True
+            self._cond.notify()
+        finish(self.task_id, self.count, status)
+        return self.count
@@ -0,0 +1,132 @@
+"""
+提示词token计数与历史窗口
+
+- count_tokens(): 优先使用本地分词器(需安装 transformers 且 KLLM_TOKENIZER_PATH 下有分词器文件),
+  否则按校准过的系数估算: 中日韩字符按每字 cjk_tokens_per_char 个token, 其余字符按每 other_chars_per_token 个字符一个token
+- message_tokens(): 计算单条消息的token数并缓存在消息字典上, 随对话历史一起保存, 之后不再重复计算
+- history_window(): 在token预算内保留最新的对话轮次
+"""
+import os
+import re
+import threading
+
+tokenizer_path = os.environ.get('KLLM_TOKENIZER_PATH', '/mnt/models/qwen3-4b-instruct-2507-fp8')
+# 估算系数, 按Qwen分词器在中文对话语料上校准(可用 calibrate() 重新计算)
+cjk_tokens_per_char = float(os.environ.get('KLLM_CJK_TOKENS_PER_CHAR', '0.75'))
+other_chars_per_token = float(os.environ.get('KLLM_OTHER_CHARS_PER_TOKEN', '3.5'))
+# chat模板为每条消息增加的token数(<|im_start|>role\n ... <|im_end|>\n)
+message_overhead = 4
+
+_CJK = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def get_tokenizer():
+    """懒加载本地分词器, 不可用时返回None(只尝试一次)"""
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                try:
+                    from transformers import AutoTokenizer
+                    _tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+                except Exception as e:
+                    print(f"本地分词器不可用, 使用估算token数: {e}")
+                    _tokenizer = False
+    return _tokenizer or None
+
+
+def tokenizer_name():
+    """当前计数方式的标识, 缓存在消息上的计数与之不一致时重新计算"""
+    return 'tokenizer' if get_tokenizer() is not None else f"approx:{cjk_tokens_per_char}:{other_chars_per_token}"
+
+
+def estimate_tokens(text):
+    """按字符类别估算token数"""
+    cjk = len(_CJK.findall(text))
+    return int(cjk * cjk_tokens_per_char + (len(text) - cjk) / other_chars_per_token) + 1
+
+
+def count_tokens(text):
+    if not text:
+        return 0
+    tokenizer = get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    return estimate_tokens(text)
+
+
+def message_tokens(msg):
+    """单条消息的token数(含chat模板开销), 结果缓存在 msg['tokens'] 上"""
+    name = tokenizer_name()
+    if msg.get('tokens') is None or msg.get('tokenizer') != name:
+        msg['tokens'] = count_tokens(msg.get('content', '')) + message_overhead
+        msg['tokenizer'] = name
+    return msg['tokens']
+
+
+def history_window(messages, budget, step_ratio=0.25):
+    """
+    在 budget 个token内保留最新的消息
+
+    窗口起点按 step_ratio * budget 的步长跳跃式后移, 而不是每轮挪一条:
+    历史只在末尾追加时, 起点在多轮之间保持不变, 不会每轮都打断vLLM的前缀缓存;
+    代价是窗口实际占用在 (1 - step_ratio) * budget 到 budget 之间
+
+    参数:
+    - messages: 按时间顺序的消息列表
+    - budget: 历史消息可用的token数
+    - step_ratio: 起点每次后移的步长占预算的比例
+
+    返回:
+    - 保留的消息列表(messages 的尾部切片), 以user消息开头
+    """
+    if budget <= 0 or not messages:
+        return []
+    sizes = [message_tokens(msg) for msg in messages]
+    total = sum(sizes)
+    if total <= budget:
+        return list(messages)
+    # 需要丢弃的token数向上取整到步长的整数倍
+    step = max(1, int(budget * step_ratio))
+    drop = ((total - budget) // step + 1) * step
+    start = 0
+    dropped = 0
+    while start < len(messages) and dropped < drop:
+        dropped += sizes[start]
+        start += 1
+    # 从完整的一轮开始, 避免以assistant消息开头
+    while start < len(messages) and messages[start].get('role') != 'user':
+        start += 1
+    return list(messages[start:])
+
+
+def calibrate(texts):
+    """
+    用本地分词器对样本文本计数, 拟合估算系数
+
+    返回:
+    - (cjk_tokens_per_char, other_chars_per_token), 分词器不可用时返回None
+    """
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return None
+    # 两个特征(中日韩字符数, 其他字符数)的最小二乘, 不含截距
+    sxx = sxy = syy = sxt = syt = 0.0
+    for text in texts:
+        cjk = len(_CJK.findall(text))
+        other = len(text) - cjk
+        tokens = len(tokenizer.encode(text, add_special_tokens=False))
+        sxx += cjk * cjk
+        sxy += cjk * other
+        syy += other * other
+        sxt += cjk * tokens
+        syt += other * tokens
+    det = sxx * syy - sxy * sxy
+    if det == 0:
+        return None
+    per_cjk = (sxt * syy - syt * sxy) / det
+    per_other = (syt * sxx - sxt * sxy) / det
+    return per_cjk, 1.0 / per_other if per_other > 0 else other_chars_per_token
@@ -0,0 +1,79 @@
+"""
+取消基准测试 - 模拟客户端在流式回复途中离开: 每个请求在指定时刻取消 cancel_scope(相当于worker发现心跳过期),
+对比不取消(读完整个流)时替身服务实际发出的token数、上游连接被关闭的次数, 从取消到worker结束的耗时,
+以及从取消到上游请求全部结束(准入名额归还)的耗时; 分别覆盖请求合并开/关、解码阶段与prefill阶段取消。
+prefill阶段(响应头尚未到达)取消时, worker与上游请求都应在 MAX_EXIT_MS 内结束, 而不是等到首token
+"""
+import threading
+import time
+
+import sys
+sys.path.append('/mnt/projects/llm-server')
+from src.agents import kagentv1
+from src.agents.kagentv1 import KAgent
+from src.utils import kllm
+from src.utils.resilience import cancel_scope
+from tests.server_test.mock_vllm_server import start_mock_server
+
+CLIENTS = 8
+MAX_EXIT_MS = 200
+REPLY = "谢谢你愿意和我分享这些。" * 30
+
+
+def run(agent, server, cancel_after):
+    before_sent = server.stats['sent_tokens']
+    before_aborted = server.stats['aborted']
+    exit_delays = []
+    lock = threading.Lock()
+
+    def client(i):
+        with cancel_scope() as scope:
+            if cancel_after is not None:
+                threading.Timer(cancel_after, scope.cancel, args=('abandoned',)).start()
+            for _ in agent.chat_stream(f"第{i}个客户端: 我最近工作上遇到了一些困难，想听听你的看法", [],
+                                       conversation_id=f'bench-cancel-{i}'):
+                if scope.cancelled:
+                    break
+            if cancel_after is not None:
+                with lock:
+                    exit_delays.append(time.monotonic() - cancelled_at)
+
+    cancelled_at = time.monotonic() + (cancel_after or 0)
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(CLIENTS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 请求合并时上游在后台线程中读取, 等它归还准入名额
+    limiter = kllm.get_limiter()
+    while limiter is not None and limiter.stats()['inflight'] > 0:
+        time.sleep(0.001)
+    release_ms = (time.monotonic() - cancelled_at) * 1000 if cancel_after is not None else 0.0
+    # 等替身服务在下一次写入时发现连接已关闭
+    time.sleep(server.ttft + server.token_interval * 5 + 0.1)
+    exit_ms = max(exit_delays) * 1000 if exit_delays else 0.0
+    return server.stats['sent_tokens'] - before_sent, server.stats['aborted'] - before_aborted, exit_ms, release_ms
+
+
+def main():
+    # 各轮使用相同输入, 关闭近似重复回复缓存
+    kagentv1.reply_cache = None
+    agent = KAgent()
+    for stage, ttft, cancel_after in (('解码阶段', 0.05, 0.5), ('prefill阶段', 1.5, 0.5)):
+        server = start_mock_server(reply=REPLY, ttft=ttft, token_interval=0.01)
+        kllm.set_backends([server.base_url])
+        for mode in ('local', 'off'):
+            kllm.singleflight_mode = mode
+            for label, after in (('不取消', None), ('取消', cancel_after)):
+                sent, aborted, exit_ms, release_ms = run(agent, server, after)
+                print(f"{stage:<10} 合并: {mode:<5} {label:<4} 客户端: {CLIENTS}  发出token: {sent:5}  "
+                      f"上游被关闭: {aborted:2}  取消后worker结束最长: {exit_ms:6.1f}ms  "
+                      f"上游请求结束: {release_ms:6.1f}ms")
+                if after is not None and stage == 'prefill阶段':
+                    assert exit_ms < MAX_EXIT_MS, f"prefill阶段取消后worker {exit_ms:.1f}ms 才结束"
+                    assert release_ms < MAX_EXIT_MS, f"prefill阶段取消后上游请求 {release_ms:.1f}ms 才结束"
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+快速通道基准测试 - 在本地替身服务上跑一组混合输入(问候、告别与普通对话),
+统计快速通道分流的轮数、实际发往vLLM的请求数与预留的max_tokens, 以及两类轮次的耗时
+"""
+import sys
+import time
+
+sys.path.append('/mnt/projects/llm-server')
+from src.agents import fast_path, kagentv1
+from src.agents.kagentv1 import KAgent
+from src.utils import kllm
+from src.utils.metrics import registry
+from tests.server_test.mock_vllm_server import start_mock_server
+
+TURNS = [
+    "你好",
+    "今天工作压力好大，每天加班到很晚",
+    "谢谢你的建议，我感觉好多了",
+    "再见，谢谢你的陪伴",
+    "早上好！",
+    "我打算这周末带女朋友去爬山，你有什么推荐吗？",
+    "好的，拜拜~",
+    "在吗？",
+    "我最近总是失眠，很焦虑",
+    "晚安啦",
+]
+ROUNDS = 20
+
+
+def run(agent, server):
+    before_requests = server.stats['requests']
+    before_reserved = server.stats['max_tokens']
+    fast, full = [], []
+    for _ in range(ROUNDS):
+        for user_input in TURNS:
+            absorbed = fast_path.classify(user_input)[0] is not None and fast_path.fast_path_mode != 'off'
+            start = time.perf_counter()
+            for _ in agent.chat_stream(user_input, [], conversation_id='bench-fast-path'):
+                pass
+            (fast if absorbed else full).append(time.perf_counter() - start)
+    return server.stats['requests'] - before_requests, server.stats['max_tokens'] - before_reserved, fast, full
+
+
+def main():
+    server = start_mock_server(ttft=0.05, token_interval=0.002)
+    kllm.set_backends([server.base_url])
+    # 各轮输入反复出现, 关闭近似输入缓存, 只测量本项优化
+    kagentv1.reply_cache = None
+    agent = KAgent()
+    turns = ROUNDS * len(TURNS)
+
+    for mode in ('off', 'template', 'llm'):
+        fast_path.fast_path_mode = mode
+        requests, reserved, fast, full = run(agent, server)
+        fast_ms = sum(fast) / len(fast) * 1000 if fast else 0.0
+        full_ms = sum(full) / len(full) * 1000 if full else 0.0
+        print(f"{mode:<9} 轮数: {turns}  vLLM请求: {requests:4}  预留max_tokens: {reserved:7}  "
+              f"快速通道平均: {fast_ms:6.1f}ms  完整流程平均: {full_ms:6.1f}ms")
+
+    print(f"\n本进程统计: {fast_path.stats()}")
+    print(f"metrics计数: {registry.snapshot()['counters'].get('chat_turns')}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
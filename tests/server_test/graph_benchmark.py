@@ -0,0 +1,78 @@
+"""
+执行图基准测试 - 在本地替身服务上给记忆检索和摘要读取加上模拟延迟(相当于索引较大、Redis往返较慢),
+对比各节点串行执行与并发执行时的首token耗时, 以及记忆检索超过节点超时时的降级效果, 并输出各节点耗时分位数
+"""
+import time
+
+import sys
+sys.path.append('/mnt/projects/llm-server')
+from src.agents import kagentv1
+from src.agents.kagentv1 import KAgent
+from src.utils import kllm
+from src.utils.metrics import registry, summarize_stages
+from tests.server_test.mock_vllm_server import start_mock_server
+
+INPUTS = [
+    "今天工作压力好大，每天加班到很晚",
+    "我打算这周末带女朋友去爬山，你有什么推荐吗？",
+    "我最近总是失眠，很焦虑",
+    "你还记得我在学吉他吗",
+]
+ROUNDS = 10
+SUMMARY_DELAY = 0.03
+
+
+def slow_search(search, delay):
+    def wrapped(*args, **kwargs):
+        time.sleep(delay)
+        return search(*args, **kwargs)
+    return wrapped
+
+
+def slow_summary(conversation_id, messages):
+    time.sleep(SUMMARY_DELAY)
+    return None, 0
+
+
+def run(agent):
+    ttfts = []
+    for round_index in range(ROUNDS):
+        for user_input in INPUTS:
+            start = time.perf_counter()
+            # 每轮输入不同, 不命中记忆检索缓存和近似输入缓存
+            stream = agent.chat_stream(f"{user_input}({round_index})", [], conversation_id='bench-graph')
+            next(stream)
+            ttfts.append(time.perf_counter() - start)
+            for _ in stream:
+                pass
+    ttfts.sort()
+    return ttfts[len(ttfts) // 2] * 1000, ttfts[int(len(ttfts) * 0.99)] * 1000
+
+
+def main():
+    server = start_mock_server(ttft=0.02, token_interval=0.001)
+    kllm.set_backends([server.base_url])
+    kagentv1.get_summary = slow_summary
+    # 各轮输入只差一个序号, 关闭近似输入缓存
+    kagentv1.reply_cache = None
+    search = kagentv1.memory_index.search
+
+    for label, parallel, delay in (('串行', False, 0.04), ('并发', True, 0.04), ('并发+检索超时', True, 0.5)):
+        kagentv1.memory_index.search = slow_search(search, delay)
+        agent = KAgent()
+        agent.graph.parallel = parallel
+        p50, p99 = run(agent)
+        print(f"{label:<8} 记忆检索延迟: {delay * 1000:4.0f}ms  摘要读取延迟: {SUMMARY_DELAY * 1000:.0f}ms  "
+              f"首token p50: {p50:6.1f}ms  p99: {p99:6.1f}ms")
+
+    print("\n节点耗时:")
+    for stage, summary in sorted(summarize_stages(registry.snapshot()).items()):
+        if stage.startswith('node:'):
+            print(f"  {stage:<28} count: {summary['count']:4}  p50: {summary['p50'] * 1000:7.1f}ms  "
+                  f"p99: {summary['p99'] * 1000:7.1f}ms")
+    print(f"节点结果: {registry.snapshot()['counters'].get('graph_nodes')}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+kllm连接池基准测试 - 对比每次新建连接(requests.post)与进程级keep-alive连接池的单请求延迟
+使用本地替身服务, 无需GPU
+"""
+import statistics
+import sys
+import time
+
+import requests
+
+sys.path.append('/mnt/projects/llm-server')
+from src.utils import kllm
+from tests.server_test.mock_vllm_server import start_mock_server
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * p))
+    return values[index]
+
+
+def _report(name, latencies, connections):
+    print(f"{name:<18} 平均: {statistics.mean(latencies) * 1000:7.3f}ms  "
+          f"p50: {_percentile(latencies, 0.5) * 1000:7.3f}ms  "
+          f"p99: {_percentile(latencies, 0.99) * 1000:7.3f}ms  新建连接数: {connections}")
+
+
+def bench_per_request(server, n):
+    """旧行为: 每次调用requests.post, 每次都新建TCP连接"""
+    url = f"{server.base_url}/v1/chat/completions"
+    payload = {'model': 'mock-model', 'messages': [{'role': 'user', 'content': '你好'}], 'max_tokens': 16}
+    before = server.stats['connections']
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        response = requests.post(url, json=payload)
+        response.json()
+        latencies.append(time.perf_counter() - start)
+    return latencies, server.stats['connections'] - before
+
+
+def bench_pooled(server, n):
+    """新行为: kllm.call_api复用进程级连接池"""
+    kllm.set_backends([server.base_url])
+    kllm.close_session()
+    before = server.stats['connections']
+    latencies = []
+    for _ in range(n):
+        start = time.perf_counter()
+        kllm.call_api('请回答用户的问题', '你好', 0.1, 16, 'mock-model')
+        latencies.append(time.perf_counter() - start)
+    return latencies, server.stats['connections'] - before
+
+
+def main(n=500):
+    server = start_mock_server()
+    print(f"替身服务: {server.base_url}, 每组请求数: {n}")
+    print("=" * 90)
+    # 预热
+    bench_per_request(server, 10)
+    bench_pooled(server, 10)
+
+    latencies, connections = bench_per_request(server, n)
+    _report("requests.post", latencies, connections)
+    latencies, connections = bench_pooled(server, n)
+    _report("kllm连接池", latencies, connections)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,96 @@
+"""
+记忆检索基准测试 - 在合成的一年日记(每天三类条目, 每条若干行事实)上测试建索引和检索耗时,
+并对比把全部日记放进提示词与只放检索段落的token数
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append('/mnt/projects/llm-server')
+from src.agents import kagentv1
+from src.agents.kagentv1 import KAgent
+from src.diary_system.knote import DiarySystem
+from src.diary_system.retrieval import MemoryIndex
+from src.utils.tokens import count_tokens
+
+DAYS = 365
+FACTS_PER_ENTRY = 8
+PEOPLE = ["小王", "妈妈", "女朋友", "老同事李哥", "大学室友", "新来的实习生"]
+PLACES = ["公司", "健身房", "香山", "图书馆", "咖啡店", "老家"]
+ACTIVITIES = ["爬山", "跑步", "看电影", "学做饭", "读管理类的书", "练吉他", "加班写报告", "打羽毛球"]
+FEELINGS = ["很开心", "有点焦虑", "压力很大", "觉得很放松", "有些失落", "很有成就感"]
+QUERIES = [
+    "周末想去爬山，有什么建议吗？",
+    "最近和女朋友有点矛盾",
+    "我又在加班写报告了，好累",
+    "你还记得我在学吉他吗",
+    "今天去健身房跑步了",
+    "我妈妈最近身体不太好",
+    "那个老同事李哥又找我麻烦",
+    "晚上吃什么好呢",
+]
+
+
+def fake_fact(rng, entry_type):
+    if entry_type == 'profile':
+        return rng.choice([
+            f"用户喜欢{rng.choice(ACTIVITIES)}",
+            f"用户的好朋友是{rng.choice(PEOPLE)}",
+            f"用户经常去{rng.choice(PLACES)}",
+        ])
+    if entry_type == 'event':
+        return (f"用户和{rng.choice(PEOPLE)}在{rng.choice(PLACES)}"
+                f"{rng.choice(['吵了一架', '达成了合作', '庆祝了生日', '聊了未来的打算'])}，前后{rng.randint(1, 12)}个小时")
+    return f"用户在{rng.choice(PLACES)}{rng.choice(ACTIVITIES)}了{rng.randint(10, 300)}分钟，{rng.choice(FEELINGS)}"
+
+
+def main():
+    rng = random.Random(0)
+    workdir = tempfile.mkdtemp()
+    diary = DiarySystem(os.path.join(workdir, 'diary_data.json'))
+    for day in range(DAYS):
+        date = f"2025-{day // 28 % 12 + 1:02d}-{day % 28 + 1:02d}"
+        for entry_type in ('activity', 'event', 'profile'):
+            diary.entries.append({
+                'id': len(diary.entries) + 1,
+                'type': entry_type,
+                'content': "\n".join(fake_fact(rng, entry_type) for _ in range(FACTS_PER_ENTRY)),
+                'date': date
+            })
+    start = time.perf_counter()
+    diary.save_data()
+    print(f"建索引(含写文件): {(time.perf_counter() - start) * 1000:.1f}ms  "
+          f"索引大小: {os.path.getsize(diary.index_file) / 1024:.0f}KB")
+
+    index = MemoryIndex(diary.index_file)
+    start = time.perf_counter()
+    print(f"事实条数: {len(index)}  加载索引: {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    latencies = []
+    for _ in range(50):
+        for query in QUERIES:
+            start = time.perf_counter()
+            index.search(query, k=5)
+            latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[int(len(latencies) * 0.99)] * 1000
+    print(f"检索耗时 p50: {p50:.2f}ms  p99: {p99:.2f}ms  ({len(latencies)}次)")
+
+    kagentv1.memory_index = index
+    agent = KAgent()
+    all_tokens = count_tokens("\n".join(entry['content'] for entry in diary.entries))
+    section_tokens = []
+    for query in QUERIES:
+        prompt = agent._with_memories(query)
+        section_tokens.append(count_tokens(prompt) - count_tokens(query))
+    print(f"全部日记放入提示词: {all_tokens} tokens  检索段落: 平均 {sum(section_tokens) / len(section_tokens):.0f} / "
+          f"上限 {kagentv1.memory_section_tokens} tokens")
+    print(f"\n示例: {QUERIES[0]}")
+    print(agent._with_memories(QUERIES[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+"""
+本地vLLM替身服务 - 仅依赖标准库, 用于在无GPU环境下对kllm客户端做基准测试
+实现 OpenAI 兼容的 /v1/chat/completions (流式与非流式) 和 /v1/models
+
+可选模拟 vLLM 自动前缀缓存: 按chat模板渲染提示词(每个字符算一个token), 以 block_size 为块做链式哈希,
+命中的前缀块不计prefill耗时, 首token延迟 = ttft + 未命中token数 * prefill_per_token
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = "你好！我是你的社交陪伴助手，很高兴和你聊天。今天过得怎么样？"
+
+
+class MockVLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # 支持keep-alive
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.stats_lock:
+            self.server.stats['connections'] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.server.fail:
+            self._send_json(500, {'error': 'mock failure'})
+        elif self.path == '/v1/models' or self.path == '/health':
+            self._send_json(200, {'object': 'list', 'data': [{'id': self.server.model_name}]})
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def _prefill(self, messages):
+        """模拟前缀缓存与prefill, 返回 (prompt_tokens, cached_tokens)"""
+        prompt = ''.join(f"<|im_start|>{m.get('role')}\n{m.get('content', '')}<|im_end|>\n" for m in messages)
+        block_size = self.server.block_size
+        cached = 0
+        parent = None
+        matching = True
+        blocks = []
+        # 与vLLM一样只缓存完整的块
+        for start in range(0, len(prompt) - block_size + 1, block_size):
+            parent = hash((parent, prompt[start:start + block_size]))
+            blocks.append(parent)
+        with self.server.stats_lock:
+            for block in blocks:
+                if matching and block in self.server.prefix_blocks:
+                    self.server.prefix_blocks.move_to_end(block)
+                    cached += block_size
+                else:
+                    matching = False
+                    self.server.prefix_blocks[block] = True
+            while len(self.server.prefix_blocks) > self.server.max_cached_blocks:
+                self.server.prefix_blocks.popitem(last=False)
+            self.server.stats['prompt_tokens'] += len(prompt)
+            self.server.stats['cached_tokens'] += cached
+        return len(prompt), cached
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        with self.server.stats_lock:
+            self.server.stats['requests'] += 1
+            self.server.stats['max_tokens'] += payload.get('max_tokens') or 0
+
+        if self.server.fail:
+            self._send_json(500, {'error': 'mock failure'})
+            return
+
+        reply = self.server.reply(payload) if callable(self.server.reply) else self.server.reply
+        for stop in payload.get('stop') or []:
+            if stop in reply:
+                reply = reply[:reply.index(stop)]
+        tokens = list(reply)[:payload.get('max_tokens', len(reply))]
+        finish_reason = 'length' if len(tokens) < len(reply) else 'stop'
+        if self.server.prefix_cache:
+            prompt_tokens, cached_tokens = self._prefill(payload.get('messages', []))
+        else:
+            prompt_tokens = sum(len(m.get('content', '')) for m in payload.get('messages', []))
+            cached_tokens = 0
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': len(tokens),
+            'total_tokens': prompt_tokens + len(tokens),
+            'prompt_tokens_details': {'cached_tokens': cached_tokens}
+        }
+        with self.server.stats_lock:
+            self.server.stats['completion_tokens'] += len(tokens)
+        time.sleep(self.server.ttft + (prompt_tokens - cached_tokens) * self.server.prefill_per_token)
+
+        if not payload.get('stream'):
+            time.sleep(self.server.token_interval * len(tokens))
+            self._send_json(200, {
+                'id': 'chatcmpl-mock',
+                'object': 'chat.completion',
+                'model': payload.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)}, 'finish_reason': finish_reason}],
+                'usage': usage
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for token in tokens:
+                frame = {
+                    'id': 'chatcmpl-mock',
+                    'object': 'chat.completion.chunk',
+                    'model': payload.get('model'),
+                    'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}]
+                }
+                self._write_chunk(f"data: {json.dumps(frame, ensure_ascii=False)}\n\n".encode('utf-8'))
+                with self.server.stats_lock:
+                    self.server.stats['sent_tokens'] += 1
+                time.sleep(self.server.token_interval)
+            final = {
+                'id': 'chatcmpl-mock',
+                'object': 'chat.completion.chunk',
+                'model': payload.get('model'),
+                'choices': [{'index': 0, 'delta': {}, 'finish_reason': finish_reason}],
+                'usage': usage
+            }
+            self._write_chunk(f"data: {json.dumps(final)}\n\n".encode('utf-8'))
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            with self.server.stats_lock:
+                self.server.stats['aborted'] += 1
+            self.close_connection = True
+
+
+class MockVLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # 并发压测时避免listen队列溢出
+
+
+def start_mock_server(port=0, reply=DEFAULT_REPLY, ttft=0.0, token_interval=0.0, model_name='mock-model',
+                      prefix_cache=False, prefill_per_token=0.0, block_size=16, max_cached_blocks=100000):
+    """
+    在后台线程启动替身服务
+
+    参数:
+    - port: 监听端口, 0表示随机端口
+    - reply: 固定回复内容, 每个字符作为一个token; 也可以是 reply(payload) 函数, 按请求返回回复
+    - ttft: 首token延迟(秒)
+    - token_interval: token间隔(秒)
+    - prefix_cache: 是否模拟自动前缀缓存
+    - prefill_per_token: 每个未命中缓存的提示词token的prefill耗时(秒)
+    - block_size / max_cached_blocks: 缓存块大小(token)与最多缓存的块数(LRU淘汰)
+
+    返回:
+    - server对象, server.base_url 为服务地址, server.stats 为请求/连接计数
+    """
+    server = MockVLLMServer(('127.0.0.1', port), MockVLLMHandler)
+    server.reply = reply
+    server.ttft = ttft
+    server.token_interval = token_interval
+    server.model_name = model_name
+    server.fail = False
+    server.prefix_cache = prefix_cache
+    server.prefill_per_token = prefill_per_token
+    server.block_size = block_size
+    server.max_cached_blocks = max_cached_blocks
+    server.prefix_blocks = OrderedDict()
+    server.stats = {'requests': 0, 'connections': 0, 'aborted': 0, 'prompt_tokens': 0, 'cached_tokens': 0,
+                    'max_tokens': 0, 'completion_tokens': 0, 'sent_tokens': 0}
+    server.stats_lock = threading.Lock()
+    server.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='本地vLLM替身服务')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--ttft', type=float, default=0.05)
+    parser.add_argument('--token-interval', type=float, default=0.01)
+    args = parser.parse_args()
+    server = start_mock_server(args.port, ttft=args.ttft, token_interval=args.token_interval)
+    print(f"替身服务已启动: {server.base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
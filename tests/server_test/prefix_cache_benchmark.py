@@ -0,0 +1,103 @@
+"""
+前缀缓存基准测试 - 对比KAgent旧的单条user消息布局(当前输入在前、历史在后)与新的多消息追加布局
+在开启模拟前缀缓存的本地替身服务上逐轮对话, 统计每轮的前缀缓存命中率与首token延迟
+"""
+import sys
+import time
+
+sys.path.append('/mnt/projects/llm-server')
+from src.agents.kagentv1 import KAgent, model_name
+from src.utils import kllm
+from tests.server_test.mock_vllm_server import start_mock_server
+
+USER_INPUTS = [
+    "你好，我今天感觉特别开心，刚刚得到了升职的机会！",
+    "不过新岗位要带团队，我有点担心自己做不好。",
+    "之前没有管理经验，不知道该从哪里开始。",
+    "团队里有个老同事好像不太服气，我该怎么跟他沟通？",
+    "最近加班也变多了，周末都在处理工作。",
+    "我女朋友有点不高兴，说我陪她的时间太少了。",
+    "你觉得我应该怎么平衡工作和生活？",
+    "我打算这周末带她去爬山，你有什么推荐吗？",
+    "谢谢你的建议，我感觉好多了。",
+    "对了，我还想学点管理方面的书，有推荐吗？",
+    "好的，我先从第一本开始看。",
+    "今天就聊到这里吧，晚安！",
+]
+
+
+def old_layout_stream(agent, user_input, conversation_history):
+    """旧版 KAgent.chat_stream 的提示词布局: 当前输入在前, 历史对话拼接在同一条user消息里"""
+    if not conversation_history:
+        context = f"当前用户输入: {user_input}\n历史对话: 无"
+    else:
+        history_str = "\n".join([f"{msg['role']}: {msg['content']}" for msg in conversation_history])
+        context = f"""当前用户输入: {user_input}
+历史对话:
+{history_str}"""
+    user_prompt = f"""
+## 对话上下文
+{context}
+
+## 处理要求
+请严格按照思维链步骤分析以上对话，确保情绪分析和意图识别准确。
+最终回应要自然、温暖、人性化，展现同理心。
+
+请直接输出最终回应内容，不要包含任何JSON格式或其他额外信息。
+"""
+    return kllm.call_api_stream(agent.cod_prompt, user_prompt, 0.1, 5000, model_name)
+
+
+def run_conversation(server, layout):
+    kllm.set_backends([server.base_url])
+    agent = KAgent()
+    conversation_history = []
+    rows = []
+    for user_input in USER_INPUTS:
+        before_prompt = server.stats['prompt_tokens']
+        before_cached = server.stats['cached_tokens']
+        records = []
+        with kllm.request_hooks(records.append):
+            if layout == 'old':
+                stream = old_layout_stream(agent, user_input, conversation_history)
+            else:
+                stream = agent.chat_stream(user_input, conversation_history)
+            answer = ''.join(chunk for chunk in stream if chunk)
+        prompt_tokens = server.stats['prompt_tokens'] - before_prompt
+        cached_tokens = server.stats['cached_tokens'] - before_cached
+        rows.append((prompt_tokens, cached_tokens, records[-1].ttft))
+        conversation_history.append({'role': 'user', 'content': user_input})
+        conversation_history.append({'role': 'assistant', 'content': answer})
+    return rows
+
+
+def report(name, rows):
+    print(f"\n{name}")
+    print(f"{'轮次':>4} {'提示词token':>12} {'命中token':>10} {'命中率':>8} {'TTFT':>10}")
+    for turn, (prompt_tokens, cached_tokens, ttft) in enumerate(rows, 1):
+        print(f"{turn:>4} {prompt_tokens:>12} {cached_tokens:>10} {cached_tokens / prompt_tokens:>8.1%} {ttft * 1000:>8.1f}ms")
+    total_prompt = sum(r[0] for r in rows)
+    total_cached = sum(r[1] for r in rows)
+    mean_ttft = sum(r[2] for r in rows) / len(rows)
+    print(f"合计命中率: {total_cached / total_prompt:.1%}  平均TTFT: {mean_ttft * 1000:.1f}ms")
+    return total_cached / total_prompt, mean_ttft
+
+
+def main(prefill_per_token=0.0002):
+    # prefill_per_token=0.0002 约等于每秒prefill 5000 token
+    results = {}
+    for layout, name in (('old', '旧布局: 单条user消息, 当前输入在历史之前'),
+                         ('new', '新布局: system + 历史消息 + 当前输入')):
+        server = start_mock_server(ttft=0.01, token_interval=0.0005, prefix_cache=True,
+                                   prefill_per_token=prefill_per_token)
+        start = time.time()
+        rows = run_conversation(server, layout)
+        results[layout] = report(name, rows)
+        print(f"总耗时: {time.time() - start:.2f}s")
+        server.shutdown()
+    (old_rate, old_ttft), (new_rate, new_ttft) = results['old'], results['new']
+    print(f"\n命中率 {old_rate:.1%} -> {new_rate:.1%}, 平均TTFT {old_ttft * 1000:.1f}ms -> {new_ttft * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main(float(sys.argv[1]) if len(sys.argv) > 1 else 0.0002)
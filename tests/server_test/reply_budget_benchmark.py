@@ -0,0 +1,109 @@
+"""
+回复预算基准测试 - 对比固定 max_tokens=5000 与按意图自适应预算 + 停止序列 + 时长上限
+本地替身服务按意图返回不同长度的回复, 少数请求模拟失控生成:
+续写出下一轮的角色标记(由停止序列截断), 或不断重复(由预算/时长上限截断)
+统计每个请求预留的 max_tokens、实际生成的token数与耗时分位数
+"""
+import random
+import sys
+import time
+
+sys.path.append('/mnt/projects/llm-server')
+from src.agents import kagentv1
+from src.agents.kagentv1 import KAgent
+from src.agents.reply_budget import ReplyBudget, classify_intent
+from src.utils import kllm
+from tests.server_test.mock_vllm_server import start_mock_server
+
+USER_INPUTS = [
+    "你好呀",
+    "早上好！",
+    "再见，谢谢你的陪伴",
+    "晚安啦",
+    "今天的天气真好啊",
+    "在干嘛呢",
+    "我今天感觉特别开心，刚刚得到了升职的机会！",
+    "终于把拖了很久的报告写完了，心情不错",
+    "工作压力好大，每天加班到很晚，感觉快要崩溃了...",
+    "最近总是失眠，很焦虑",
+    "你觉得我应该怎么平衡工作和生活？",
+    "有什么适合周末放松的活动推荐吗？",
+    "我女朋友说我陪她的时间太少了，我不知道该怎么跟她解释",
+]
+# 各意图的正常回复长度(字符, 替身服务中每个字符一个token)
+REPLY_CHARS = {
+    'greeting': 40, 'goodbye': 40, 'small_talk': 80, 'sharing_feelings': 150,
+    'seeking_comfort': 250, 'question': 300, 'other': 150,
+}
+ROUNDS = 240
+RUNAWAY_ROLE_RATE = 0.05
+RUNAWAY_REPEAT_RATE = 0.02
+RUNAWAY_CHARS = 3000
+
+
+def make_reply(rng):
+    def reply(payload):
+        user_input = payload['messages'][-1]['content']
+        length = int(REPLY_CHARS[classify_intent(user_input)] * rng.uniform(0.6, 1.2))
+        text = "好" * length
+        roll = rng.random()
+        if roll < RUNAWAY_ROLE_RATE:
+            text += "\n用户: 那你呢？\n助手: " + "嗯" * RUNAWAY_CHARS
+        elif roll < RUNAWAY_ROLE_RATE + RUNAWAY_REPEAT_RATE:
+            text += "哈" * RUNAWAY_CHARS
+        return text
+    return reply
+
+
+def run(server, agent, label, seed):
+    server.reply = make_reply(random.Random(seed))
+    order = random.Random(seed)
+    before_reserved = server.stats['max_tokens']
+    before_generated = server.stats['completion_tokens']
+    durations = []
+    for _ in range(ROUNDS):
+        user_input = order.choice(USER_INPUTS)
+        start = time.perf_counter()
+        for _ in agent.chat_stream(user_input, [], conversation_id=f"bench-{label}"):
+            pass
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    reserved = (server.stats['max_tokens'] - before_reserved) / ROUNDS
+    generated = (server.stats['completion_tokens'] - before_generated) / ROUNDS
+    p50 = durations[len(durations) // 2] * 1000
+    p99 = durations[min(len(durations) - 1, int(len(durations) * 0.99))] * 1000
+    print(f"{label:<6} 平均预留max_tokens: {reserved:7.0f}  平均生成token: {generated:6.0f}  "
+          f"p50: {p50:6.1f}ms  p99: {p99:7.1f}ms  总耗时: {sum(durations):.2f}s")
+    return reserved, generated, p99
+
+
+def main():
+    server = start_mock_server(token_interval=0.0005)
+    kllm.set_backends([server.base_url])
+    # 各轮输入反复出现, 关闭近似输入缓存, 只测量本项优化
+    kagentv1.reply_cache = None
+    agent = KAgent()
+
+    # 旧行为: 固定预算, 无停止序列, 不限时长
+    kagentv1.adaptive_reply_budget = False
+    stop_sequences = kagentv1.stop_sequences
+    kagentv1.stop_sequences = []
+    kagentv1.reply_cutoff_seconds = 1e9
+    fixed = run(server, agent, "固定", seed=1)
+
+    kagentv1.adaptive_reply_budget = True
+    kagentv1.stop_sequences = stop_sequences
+    kagentv1.reply_cutoff_seconds = 1.0
+    # 丢弃固定预算阶段的样本(不用Redis), 先学习各意图的回复长度
+    kagentv1.reply_budget = ReplyBudget(kagentv1.chat_max_tokens)
+    run(server, agent, "学习", seed=2)
+    adaptive = run(server, agent, "自适应", seed=1)
+
+    print(f"\n各意图预算: { {k: v['budget'] for k, v in kagentv1.reply_budget.stats().items()} }")
+    print(f"平均预留max_tokens {fixed[0]:.0f} -> {adaptive[0]:.0f}, "
+          f"平均生成token {fixed[1]:.0f} -> {adaptive[1]:.0f}, p99 {fixed[2]:.1f}ms -> {adaptive[2]:.1f}ms")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
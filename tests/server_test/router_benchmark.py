@@ -0,0 +1,63 @@
+"""
+多后端路由测试 - 启动多个本地替身服务(速度不同, 其中一个中途故障), 并发调用kllm,
+观察最少在途请求路由的分配结果以及故障后端的摘除与恢复
+"""
+import concurrent.futures
+import sys
+import time
+
+sys.path.append('/mnt/projects/llm-server')
+from src.utils import kllm
+from tests.server_test.mock_vllm_server import start_mock_server
+
+
+def run_batch(n, concurrency):
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(
+            lambda i: kllm.call_api('请回答用户的问题', f"问题{i}", 0.1, 16, 'mock-model'),
+            range(n)
+        ))
+    return results, time.time() - start
+
+
+def print_stats(servers):
+    for server, stats in zip(servers, kllm.backend_stats()):
+        print(f"  {stats['url']:<26} 收到请求: {server.stats['requests']:4}  "
+              f"健康: {str(stats['healthy']):5}  在途: {stats['outstanding']}  累计失败: {stats['total_failures']}")
+
+
+def main(n=300, concurrency=32):
+    # 一快两慢: 快的后端应分到更多请求
+    servers = [
+        start_mock_server(ttft=0.01, token_interval=0.001),
+        start_mock_server(ttft=0.05, token_interval=0.003),
+        start_mock_server(ttft=0.05, token_interval=0.003),
+    ]
+    kllm.set_backends([s.base_url for s in servers])
+    kllm.get_router().health_interval = 1
+
+    print(f"阶段1: 3个后端全部正常, {n} 个请求, 并发 {concurrency}")
+    results, elapsed = run_batch(n, concurrency)
+    print(f"  成功: {sum(r is not None for r in results)}/{n}, 耗时: {elapsed:.2f}s")
+    print_stats(servers)
+
+    print("\n阶段2: 后端1开始返回500")
+    servers[1].fail = True
+    results, elapsed = run_batch(n, concurrency)
+    print(f"  成功: {sum(r is not None for r in results)}/{n}, 耗时: {elapsed:.2f}s")
+    print_stats(servers)
+
+    print("\n阶段3: 后端1恢复, 等待健康检查重新加入")
+    servers[1].fail = False
+    time.sleep(2.5)
+    results, elapsed = run_batch(n, concurrency)
+    print(f"  成功: {sum(r is not None for r in results)}/{n}, 耗时: {elapsed:.2f}s")
+    print_stats(servers)
+
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+流式传输基准测试 - 按Redis协议编码计算一条回复在两种传输方式下的写入与读取字节数:
+- 结果后端: 每段都 SET 完整的 current_text 与 chunks, 每次轮询 GET 完整结果并反序列化
+- 增量Stream: 每段 XADD 一条增量, 轮询按偏移量 XRANGE 读取新增条目
+客户端每 POLL_EVERY 段轮询一次(约300ms轮询、40 token/s); 不需要运行中的Redis
+"""
+import json
+import time
+from datetime import datetime
+
+from redis.connection import Connection
+
+REPLY = ("听起来你最近真的承受了很多压力，每天加班到很晚，身体和情绪都会被慢慢消耗。"
+         "先给自己一点肯定吧，能坚持到现在已经很不容易了。") * 8
+POLL_EVERY = 12
+TASK_ID = 'b3f1c2d4-5e6f-4a7b-8c9d-0e1f2a3b4c5d'
+
+_packer = Connection()
+
+
+def command_bytes(*args):
+    return sum(len(part) for part in _packer.pack_command(*args))
+
+
+def resp_bytes(value):
+    """Redis响应的RESP编码长度"""
+    if value is None:
+        return 5
+    if isinstance(value, (list, tuple)):
+        return len(f"*{len(value)}\r\n") + sum(resp_bytes(item) for item in value)
+    data = value.encode('utf-8') if isinstance(value, str) else value
+    return len(f"${len(data)}\r\n") + len(data) + 2
+
+
+def tokenize(text):
+    """按1~3个字切分, 近似vLLM的增量粒度"""
+    chunks, i, step = [], 0, 0
+    while i < len(text):
+        size = 1 + step % 3
+        chunks.append(text[i:i + size])
+        i += size
+        step += 1
+    return chunks
+
+
+def backend_meta(result):
+    """Celery结果后端保存的元数据(JSON)"""
+    return json.dumps({'status': 'STREAMING', 'result': result, 'traceback': None, 'children': [],
+                       'date_done': None, 'task_id': TASK_ID}, ensure_ascii=False)
+
+
+def result_backend(chunks):
+    key = f"celery-task-meta-{TASK_ID}"
+    written = read = 0
+    decode = 0.0
+    for i in range(1, len(chunks) + 1):
+        meta = backend_meta({
+            'current_text': ''.join(chunks[:i]),
+            'chunks': chunks[:i],
+            'last_update': datetime.now().isoformat(),
+            'status': 'streaming'
+        })
+        written += command_bytes('SET', key, meta, 'PX', 86400000)
+        if i % POLL_EVERY == 0 or i == len(chunks):
+            read += command_bytes('GET', key) + resp_bytes(meta)
+            start = time.perf_counter()
+            json.loads(meta)
+            decode += time.perf_counter() - start
+    return written, read, decode
+
+
+def stream_transport(chunks):
+    key = f"kchat:stream:{TASK_ID}:tokens"
+    meta_key = f"celery-task-meta-{TASK_ID}"
+    start_meta = backend_meta({'last_update': datetime.now().isoformat(), 'status': 'streaming'})
+    written = command_bytes('SET', meta_key, start_meta, 'PX', 86400000)
+    read = 0
+    decode = 0.0
+    offset = 0
+    for i in range(1, len(chunks) + 1):
+        written += command_bytes('XADD', key, f"0-{i}", 'd', chunks[i - 1])
+        if i == 1:
+            written += command_bytes('EXPIRE', key, 3600)
+        if i % POLL_EVERY == 0 or i == len(chunks):
+            # 每次轮询: GET状态(只有开始标记) + XRANGE新增条目
+            entries = [[f"0-{n}", ['d', chunks[n - 1]]] for n in range(offset + 1, i + 1)]
+            read += command_bytes('GET', meta_key) + resp_bytes(start_meta)
+            read += command_bytes('XRANGE', key, f"(0-{offset}", '+') + resp_bytes(entries)
+            start = time.perf_counter()
+            json.loads(start_meta)
+            ''.join(fields[1] for _, fields in entries)
+            decode += time.perf_counter() - start
+            offset = i
+    written += command_bytes('XADD', key, f"0-{len(chunks) + 1}", 'done', 'completed')
+    written += command_bytes('EXPIRE', key, 3600)
+    return written, read, decode
+
+
+def main():
+    for length in (200, len(REPLY)):
+        chunks = tokenize(REPLY[:length])
+        final = json.dumps({'status': 'SUCCESS', 'result': {'status': 'success', 'answer': ''.join(chunks)},
+                            'traceback': None, 'children': [], 'date_done': datetime.now().isoformat(),
+                            'task_id': TASK_ID}, ensure_ascii=False)
+        final_bytes = command_bytes('SET', f"celery-task-meta-{TASK_ID}", final, 'PX', 86400000)
+        print(f"回复 {length} 字 / {len(chunks)} 段, 每 {POLL_EVERY} 段轮询一次, 最终结果 {final_bytes / 1024:.1f}KB")
+        for label, run in (('结果后端', result_backend), ('增量Stream', stream_transport)):
+            written, read, decode = run(chunks)
+            print(f"  {label:<10} 写入: {written / 1024:8.1f}KB  读取: {read / 1024:7.1f}KB  "
+                  f"轮询反序列化: {decode * 1000:6.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,6 @@
 import sys
 sys.path.append('/mnt/projects/llm-server')
-from src.utils.kllm import call_api
+from src.utils.kllm import call_api_batch
 import json
 
 system_prompt = """
@@ -42,14 +42,22 @@ conversation = [
 # 另存对话列表，避免修改原数据
 new_conversation = [item.copy() for item in conversation]
 
-for item in new_conversation:
-    # 调用 call_api 函数分析当前 content 的情绪
-    emotion_response = call_api(system_prompt=system_prompt, user_prompt=item["content"], temperature=0.1, max_tokens=32768, model_name="Qwen2.5-72B-Instruct-GGUF")
-    print(emotion_response)
-    emotion_response = json.loads(emotion_response)
+# 各条消息的情绪分析互不依赖, 并发调用
+batch = call_api_batch([
+    {"system_prompt": system_prompt, "user_prompt": item["content"], "temperature": 0.1, "max_tokens": 32768, "model_name": "Qwen2.5-72B-Instruct-GGUF"}
+    for item in new_conversation
+])
+for result in batch:
+    item = new_conversation[result["index"]]
+    if result["error"]:
+        print(f"第{result['index']}条情绪分析失败: {result['error']}")
+        continue
+    print(result["content"])
+    emotion_response = json.loads(result["content"])
     item["emotion"] = emotion_response["emotion"]
     item["valence"] = emotion_response["valence"]
     item["arousal"] = emotion_response["arousal"]
+print(f"共 {len(new_conversation)} 条, 失败 {batch.failed} 条, 总耗时: {batch.wall_time:.3f}s")
 
 # 将对话数据另存到一个json文件中
 output_file_path = '/mnt/projects/llm-server/tests/unit_test/conversation_with_emotion.json'